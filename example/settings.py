@@ -69,3 +69,94 @@ VIMEO_CONSUMER = ('consumer key', 'secret')
 
 # create an app at http://www.tumblr.com/oauth/apps and set this setting:
 TUMBLR_CONSUMER = ('oauth consumer key', 'secret')
+
+
+#
+# polling settings
+#
+
+# limit how many accounts on each service `fetchnewcontent --workers N` polls at once
+# (services not listed here can use all N workers):
+#POLL_SERVICE_CONCURRENCY = {
+#    'twitter.com': 4,
+#    'tumblr.com': 2,
+#}
+
+# bound how often accounts are polled on each service, as (shortest, longest)
+# minutes between polls; busy accounts are polled more often than quiet ones:
+#POLL_INTERVALS = {
+#    'twitter.com': (2, 60),
+#    'vimeo.com': (30, 720),
+#}
+# aim to find about this many new stream items each time we poll an account:
+#POLL_TARGET_YIELD = 10
+# spread each account's polls across its interval, so polls may come as early
+# as this fraction of the interval (0 polls every account exactly on time):
+#POLL_JITTER = 0.5
+
+# how long (in seconds) a poller may keep an account claimed before other
+# pollers assume it crashed and take the account over, on top of how long
+# the poll itself may take:
+#POLL_LEASE_SECONDS = 600
+
+# after this many service errors in a row (timeouts, 5xx responses and such),
+# stop polling a service's accounts for POLL_BREAKER_COOLDOWN seconds, then
+# try one account to see if the service has recovered:
+#POLL_BREAKER_THRESHOLD = 5
+#POLL_BREAKER_COOLDOWN = 300
+
+# when a reader views their home page, ask `runpoller` to poll right away
+# those of their accounts that haven't been polled in this many minutes:
+#POLL_STALE_MINUTES = 10
+
+# polls of an account that keep failing (say, because its token was revoked)
+# are retried less and less often, but at least this often:
+#POLL_MAX_BACKOFF_HOURS = 24
+
+# abandon polling an account (keeping what was found so far) if it takes
+# longer than this many seconds:
+#POLL_TIMEOUT = 120
+
+# when a reader comes back after we stopped polling their accounts, page back
+# through up to this many pages of each account to catch them up:
+#POLL_CATCHUP_PAGES = 5
+
+# when a reader connects an account, page back through up to this many pages
+# of its history in the background so their stream isn't empty:
+#POLL_BACKFILL_PAGES = 5
+
+# parse HTML in this many worker processes, so pollers with several worker
+# threads can use more than one core (see the parsebench command):
+#POLL_PARSE_PROCESSES = 4
+
+# keep up to this many idle connections open to each host the pollers make
+# requests to, closing them after they've been idle this many seconds:
+#POLL_HTTP_POOL_SIZE = 4
+#POLL_HTTP_IDLE_SECONDS = 30
+
+# keep responses to the pollers' requests for web pages, feeds and oEmbed data
+# (as their Cache-Control headers allow) in this directory, using up to this
+# many megabytes. Several pollers can share the directory, but keep it private,
+# as some cached URLs include account credentials:
+#POLL_HTTP_CACHE_DIR = '/var/cache/leapfrog/http'
+#POLL_HTTP_CACHE_MB = 100
+
+# make at most this many requests to each of these hosts in this many seconds
+# (as a sustained rate, in bursts of up to that many requests), and to any
+# other host at POLL_RATE_LIMIT_DEFAULT. Hosts that answer 429 Too Many
+# Requests or run out their X-RateLimit-Remaining are left alone until they
+# say to try again. Requests that would wait longer than POLL_RATE_MAX_WAIT
+# seconds are given up on, and the account polled again later:
+#POLL_RATE_LIMITS = {
+#    'api.twitter.com': (20, 1),
+#    'api.flickr.com': (3600, 3600),
+#}
+#POLL_RATE_LIMIT_DEFAULT = (10, 1)
+#POLL_RATE_MAX_WAIT = 10
+
+# when a post links to several pages, fetch up to this many of them at once
+# (and up to POLL_RESOLVE_PER_HOST from any one host), giving up on any that
+# take longer than POLL_RESOLVE_TIMEOUT seconds:
+#POLL_RESOLVE_THREADS = 8
+#POLL_RESOLVE_PER_HOST = 4
+#POLL_RESOLVE_TIMEOUT = 30
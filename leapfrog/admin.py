@@ -4,10 +4,10 @@ from leapfrog import models
 
 
 class AccountAdmin(admin.ModelAdmin):
-    list_display = ('display_name', 'service', 'ident')
+    list_display = ('display_name', 'service', 'ident', 'last_success', 'failure_count', 'failure_reason')
     list_filter = ('service',)
     search_fields = ('display_name', 'ident')
-    raw_id_fields = ('person',)
+    raw_id_fields = ('person', 'poll_run')
 
 admin.site.register(models.Account, AccountAdmin)
 
@@ -52,4 +52,11 @@ class PersonAdmin(admin.ModelAdmin):
 admin.site.register(models.Person, PersonAdmin)
 
 
+class PollRunAdmin(admin.ModelAdmin):
+    list_display = ('command', 'owner', 'started', 'finished', 'status', 'accounts')
+    list_filter = ('command', 'status')
+
+admin.site.register(models.PollRun, PollRunAdmin)
+
+
 admin.site.register(models.Media)
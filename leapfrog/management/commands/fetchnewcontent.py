@@ -1,29 +1,16 @@
 from datetime import datetime, timedelta
 import logging
-from optparse import make_option
+from optparse import make_option, SUPPRESS_HELP
+import sys
 
 from django.core.management.base import NoArgsCommand, CommandError
 from sentry.client.base import SentryClient
 
-from leapfrog.models import *
-from leapfrog.poll import facebook
-from leapfrog.poll import flickr
-from leapfrog.poll import mlkshk
-from leapfrog.poll import tumblr
-from leapfrog.poll import twitter
-from leapfrog.poll import typepad
-from leapfrog.poll import vimeo
+from leapfrog.poll import archive
+from leapfrog.poll.runner import due_accounts, by_priority, parse_shard, take_poll_requests, resume_dead_runs, restart_process, PollRunner
 
 
-pollers = {
-    'facebook.com': facebook.poll_facebook,
-    'flickr.com': flickr.poll_flickr,
-    'mlkshk.com': mlkshk.poll_mlkshk,
-    'tumblr.com': tumblr.poll_tumblr,
-    'twitter.com': twitter.poll_twitter,
-    'typepad.com': typepad.poll_typepad,
-    'vimeo.com': vimeo.poll_vimeo,
-}
+run_started_format = '%Y-%m-%dT%H:%M:%S'
 
 
 class Command(NoArgsCommand):
@@ -39,58 +26,142 @@ class Command(NoArgsCommand):
             dest='service',
             help='Update only accounts on this service',
         ),
+        make_option('--workers',
+            dest='workers',
+            type='int',
+            default=1,
+            help='Poll this many accounts at once (default 1)',
+        ),
+        make_option('--shard',
+            dest='shard',
+            metavar='INDEX/COUNT',
+            help='Poll only the accounts in this shard of the accounts, counting from 0 (e.g. 0/3)',
+        ),
+        make_option('--max-seconds',
+            dest='max_seconds',
+            type='int',
+            help='Stop starting new polls after this many seconds, polling the accounts of recently active readers first',
+        ),
+        make_option('--max-accounts',
+            dest='max_accounts',
+            type='int',
+            help='Restart in a fresh process after polling this many accounts',
+        ),
+        make_option('--max-rss',
+            dest='max_rss',
+            type='int',
+            metavar='MB',
+            help='Restart in a fresh process once using more than this many megabytes of memory',
+        ),
+        make_option('--parse-processes',
+            dest='parse_processes',
+            type='int',
+            help='Parse HTML in this many worker processes (default: the POLL_PARSE_PROCESSES setting, or none)',
+        ),
+        make_option('--record',
+            dest='record',
+            metavar='DIR',
+            help='Record every HTTP response the pollers get in this directory, to --replay later',
+        ),
+        make_option('--replay',
+            dest='replay',
+            metavar='DIR',
+            help='Answer the pollers\' HTTP requests from the responses recorded in this directory, without using the network',
+        ),
+        # When restarting, the fresh process carries on the same run.
+        make_option('--run-started',
+            dest='run_started',
+            help=SUPPRESS_HELP,
+        ),
     )
 
     def fetch_new_content(self, **options):
-        update_horizon = datetime.utcnow() - timedelta(minutes=15)
-        last_viewed_horizon = datetime.utcnow() - timedelta(days=5)
+        """Polls the due accounts, returning whether the runner stopped to
+        recycle the process."""
+        now = datetime.utcnow()
+        started = options['run_started']
+        # Pick up where any runs that died left off.
+        resume_dead_runs(now)
+        accounts = due_accounts(now, options['service'], options['shard'], options['force'])
+        if options['force']:
+            # Don't poll accounts again that we polled earlier in the run.
+            accounts = accounts.filter(last_updated__lt=started)
+        accounts = by_priority(accounts)
+
+        deadline = None
+        if options['max_seconds'] is not None:
+            deadline = started + timedelta(seconds=options['max_seconds'])
+
+        runner = PollRunner(workers=options['workers'], force=options['force'], deadline=deadline,
+            max_accounts=options['max_accounts'], max_rss=options['max_rss'], command='fetchnewcontent',
+            parse_processes=options['parse_processes'])
+        try:
+            # Poll the accounts readers asked for first.
+            requests = take_poll_requests(options['service'], options['shard'])
+            for request in requests:
+                runner.submit(request.account, urgent=True, pages=request.pages)
+            if requests:
+                accounts = accounts.exclude(pk__in=[request.account_id for request in requests])
+
+            for account in accounts.iterator():
+                if not runner.submit(account):
+                    if not runner.recycling:
+                        logging.info("Ran out of time to poll accounts after %d seconds", options['max_seconds'])
+                    break
+        finally:
+            runner.finish()
+
+            # Always log the run's summary, but only show it (as when run
+            # from cron) when something went wrong or it's asked for.
+            tripped = any(breaker.trips for breaker in runner.breakers.itervalues())
+            show = tripped or runner.outcomes.get('out-of-time') or int(options.get('verbosity', 1)) >= 2
+            for line in runner.summary():
+                logging.info(line)
+                if show:
+                    print line
+
+        return runner.recycling
 
-        users = User.objects.all()
-        for user in users:
+    def handle_noargs(self, **options):
+        if options['workers'] < 1:
+            raise CommandError("--workers must be at least 1")
+        if options['max_seconds'] is not None and options['max_seconds'] < 1:
+            raise CommandError("--max-seconds must be at least 1")
+        if options['max_accounts'] is not None and options['max_accounts'] < 1:
+            raise CommandError("--max-accounts must be at least 1")
+        if options['parse_processes'] is not None and options['parse_processes'] < 0:
+            raise CommandError("--parse-processes must not be negative")
+        if options['run_started']:
+            try:
+                options['run_started'] = datetime.strptime(options['run_started'], run_started_format)
+            except ValueError:
+                raise CommandError("--run-started %r is not a time" % options['run_started'])
+        else:
+            options['run_started'] = datetime.utcnow()
+        if options['shard']:
             try:
-                person = user.person
-            except Person.DoesNotExist:
-                continue
-
-            # Don't update accounts if someone hasn't viewed the site in some days.
-            if person.last_viewed_home < last_viewed_horizon:
-                logging.getLogger(__name__).debug("User %s hasn't viewed the site in a while; skipping", user.username)
-                continue
-
-            for account in person.accounts.all():
-                log = logging.getLogger('%s.%s' % (__name__, account.service))
-
-                try:
-                    poller = pollers[account.service]
-                except KeyError:
-                    log.debug("Account service %s has no poller, skipping", account.service)
-                    continue
-
-                if options['service'] and account.service != options['service']:
-                    log.debug("Account is for service %s but we're only polling %s, skipping", account.service, options['service'])
-                    continue
-
-                if not options['force'] and account.last_updated > update_horizon:
-                    log.debug("Account %s %s was updated fewer than 15 minutes ago, skipping", account.service, account.display_name)
-                    continue
-
-                # Mark the account as updated even if the update fails later.
-                log.debug("Polling account %s %s", account.service, account.display_name)
-                account.last_updated = datetime.utcnow()
-                account.save()
-
-                try:
-                    poller(account)
-                except Exception, exc:
-                    log.exception(exc)
-                    SentryClient().create_from_exception(view='%s.%s' % (__name__, account.service))
-                else:
-                    account.last_success = datetime.utcnow()
-                    account.save()
+                options['shard'] = parse_shard(options['shard'])
+            except ValueError, exc:
+                raise CommandError(str(exc))
+        if options['record'] and options['replay']:
+            raise CommandError("--record and --replay can't be used together")
+        if options['record']:
+            archive.start_recording(options['record'])
+        elif options['replay']:
+            try:
+                archive.start_replaying(options['replay'])
+            except ValueError, exc:
+                raise CommandError(str(exc))
 
-    def handle_noargs(self, **options):
         try:
-            self.fetch_new_content(**options)
+            recycle = self.fetch_new_content(**options)
         except Exception, exc:
             logging.exception(exc)
             SentryClient().create_from_exception(view=__name__)
+            return
+
+        if recycle:
+            # Carry on with the rest of the run in a fresh process.
+            argv = [arg for arg in sys.argv if not arg.startswith('--run-started=')]
+            argv.append('--run-started=%s' % options['run_started'].strftime(run_started_format))
+            restart_process(argv)
@@ -2,12 +2,14 @@ from django.core.management.base import BaseCommand, CommandError
 
 from leapfrog.models import *
 from leapfrog.poll.embedlam import object_for_url
+from leapfrog.poll.metrics import install_http_hooks
 
 
 class Command(BaseCommand):
 
     def handle(self, *args, **options):
         url = args[0]
+        install_http_hooks()
         obj = object_for_url(url)
 
         if obj:
@@ -0,0 +1,110 @@
+from __future__ import with_statement
+
+from optparse import make_option
+import os
+import Queue
+import threading
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from leapfrog.models import Object
+from leapfrog.poll.embedlam import page_data
+from leapfrog.poll.parse import parse, start_pool, stop_pool, strip_scripts
+
+
+class Command(BaseCommand):
+
+    args = '[file ...]'
+    help = 'Measure how fast HTML is parsed with different numbers of parser processes'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--processes',
+            dest='processes',
+            default='0,1,2,4',
+            help='Comma-separated numbers of parser processes to try, where 0 parses in this process (default 0,1,2,4)',
+        ),
+        make_option('--count',
+            dest='count',
+            type='int',
+            default=200,
+            help='If no HTML files are given, parse the bodies of this many recent objects (default 200)',
+        ),
+        make_option('--repeat',
+            dest='repeat',
+            type='int',
+            default=1,
+            help='Parse each document this many times in each trial (default 1)',
+        ),
+    )
+
+    def handle(self, *args, **options):
+        try:
+            counts = [int(count) for count in options['processes'].split(',')]
+        except ValueError:
+            raise CommandError("--processes must be a comma-separated list of numbers")
+        if any(count < 0 for count in counts):
+            raise CommandError("--processes must not be negative")
+        if options['repeat'] < 1:
+            raise CommandError("--repeat must be at least 1")
+
+        if args:
+            # Parse whole pages as embedlam does.
+            docs = list()
+            for filename in args:
+                url = 'file://%s' % os.path.abspath(filename)
+                with open(filename) as f:
+                    docs.append((page_data, (f.read(), url, url)))
+        else:
+            # Sanitize object bodies as saving them does.
+            bodies = Object.objects.exclude(body='').exclude(body=None).order_by('-time')
+            bodies = bodies.values_list('body', flat=True)[:options['count']]
+            docs = [(strip_scripts, (body,)) for body in bodies]
+        if not docs:
+            raise CommandError("No documents to parse")
+        docs = docs * options['repeat']
+        kilobytes = sum(len(func_args[0]) for func, func_args in docs) / 1024.0
+
+        print "Parsing %d documents (%.1f KB):" % (len(docs), kilobytes)
+        print "%9s %8s %9s %9s %8s %7s" % ('processes', 'seconds', 'docs/sec', 'KB/sec', 'speedup', 'errors')
+        baseline = None
+        for count in counts:
+            start_pool(count)
+            try:
+                elapsed, errors = self.trial(docs, max(count, 1))
+            finally:
+                stop_pool()
+            if baseline is None:
+                baseline = elapsed
+            print "%9d %8.2f %9.1f %9.1f %7.2fx %7d" % (count, elapsed, len(docs) / elapsed,
+                kilobytes / elapsed, baseline / elapsed, errors)
+
+    def trial(self, docs, threads):
+        """Parses the documents from as many threads as there are parser
+        processes (as a runner's worker threads would), returning how many
+        seconds it took and how many documents couldn't be parsed."""
+        queue = Queue.Queue()
+        for doc in docs:
+            queue.put(doc)
+        errors = [0]
+        lock = threading.Lock()
+
+        def work():
+            while True:
+                try:
+                    func, args = queue.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    parse(func, *args)
+                except ValueError:
+                    with lock:
+                        errors[0] += 1
+
+        start = time.time()
+        workers = [threading.Thread(target=work) for i in range(threads)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        return max(time.time() - start, 1e-6), errors[0]
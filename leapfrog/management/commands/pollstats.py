@@ -0,0 +1,100 @@
+from datetime import datetime, timedelta
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand, CommandError
+from django.db.models import Count
+
+from leapfrog.models import Account, PollMetric
+
+
+def percentile(values, fraction):
+    """Returns the value `fraction` of the way through the sorted list of
+    values (by the nearest rank)."""
+    if not values:
+        return 0.0
+    index = int(round(fraction * (len(values) - 1)))
+    return values[index]
+
+
+class Command(NoArgsCommand):
+
+    help = 'Show how long polls have taken and how much they found'
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--hours',
+            dest='hours',
+            type='int',
+            default=24,
+            help='Show stats for polls in this many past hours (default 24)',
+        ),
+        make_option('--service',
+            dest='service',
+            help='Show stats only for polls of accounts on this service',
+        ),
+        make_option('--prune-days',
+            dest='prune_days',
+            type='int',
+            help='First delete the metrics of polls older than this many days',
+        ),
+    )
+
+    def handle_noargs(self, **options):
+        if options['hours'] < 1:
+            raise CommandError("--hours must be at least 1")
+
+        now = datetime.utcnow()
+        if options['prune_days'] is not None:
+            PollMetric.objects.filter(started__lt=now - timedelta(days=options['prune_days'])).delete()
+
+        metrics = PollMetric.objects.filter(started__gte=now - timedelta(hours=options['hours']))
+        if options['service']:
+            metrics = metrics.filter(service=options['service'])
+        metrics = metrics.values_list('service', 'wall_time', 'http_requests', 'http_bytes',
+            'object_count', 'stream_items', 'outcome')
+
+        stats = dict()
+        for service, wall_time, requests, bytes, objects, stream_items, outcome in metrics.iterator():
+            stat = stats.setdefault(service, {
+                'times': [],
+                'outcomes': {},
+                'requests': 0,
+                'bytes': 0,
+                'objects': 0,
+                'stream_items': 0,
+            })
+            stat['times'].append(wall_time)
+            stat['outcomes'][outcome] = stat['outcomes'].get(outcome, 0) + 1
+            stat['requests'] += requests
+            stat['bytes'] += bytes
+            stat['objects'] += objects
+            stat['stream_items'] += stream_items
+
+        if not stats:
+            print "No polls in the last %d hours" % options['hours']
+            return
+
+        hours = float(options['hours'])
+        print "Polls in the last %d hours (times in seconds):" % options['hours']
+        print "%-14s %6s %7s %7s %7s %7s %9s %9s %8s %8s %8s" % ('service', 'polls', 'p50', 'p90', 'p99', 'max',
+            'reqs/poll', 'KB/poll', 'objects', 'items', 'items/h')
+        for service, stat in sorted(stats.iteritems()):
+            times = sorted(stat['times'])
+            polls = len(times)
+            print "%-14s %6d %7.2f %7.2f %7.2f %7.2f %9.1f %9.1f %8d %8d %8.1f" % (service, polls,
+                percentile(times, 0.5), percentile(times, 0.9), percentile(times, 0.99), times[-1],
+                stat['requests'] / float(polls), stat['bytes'] / 1024.0 / polls,
+                stat['objects'], stat['stream_items'], stat['stream_items'] / hours)
+            print "%-14s %s" % ('', ', '.join('%d %s' % (count, outcome) for outcome, count in sorted(stat['outcomes'].iteritems())))
+
+        # Show which accounts keep running out of time.
+        timeouts = PollMetric.objects.filter(started__gte=now - timedelta(hours=options['hours']), outcome='timeout')
+        if options['service']:
+            timeouts = timeouts.filter(service=options['service'])
+        timeouts = timeouts.values('account').annotate(count=Count('id')).order_by('-count')[:10]
+        timeouts = list(timeouts)
+        if timeouts:
+            accounts = Account.objects.in_bulk([row['account'] for row in timeouts])
+            print
+            print "Accounts whose polls timed out most:"
+            for row in timeouts:
+                print "%6d  %s" % (row['count'], accounts.get(row['account'], row['account']))
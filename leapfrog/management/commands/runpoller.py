@@ -0,0 +1,208 @@
+from datetime import datetime, timedelta
+import heapq
+import logging
+from optparse import make_option
+import time
+
+from django.core.management.base import NoArgsCommand, CommandError
+from django.db import connection
+from django.db.models import Q
+
+from leapfrog.models import Account
+from leapfrog.poll.runner import due_accounts, total_seconds, parse_shard, take_poll_requests, resume_dead_runs, restart_process, PollRunner
+
+
+log = logging.getLogger(__name__)
+
+
+class Command(NoArgsCommand):
+
+    help = 'Keep polling accounts as they come due, until interrupted'
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--service',
+            dest='service',
+            help='Poll only accounts on this service',
+        ),
+        make_option('--workers',
+            dest='workers',
+            type='int',
+            default=1,
+            help='Poll this many accounts at once (default 1)',
+        ),
+        make_option('--shard',
+            dest='shard',
+            metavar='INDEX/COUNT',
+            help='Poll only the accounts in this shard of the accounts, counting from 0 (e.g. 0/3)',
+        ),
+        make_option('--batch',
+            dest='batch',
+            type='int',
+            default=50,
+            help='Load at most this many accounts into the queue at a time (default 50)',
+        ),
+        make_option('--lookahead',
+            dest='lookahead',
+            type='int',
+            default=60,
+            help='Queue accounts that will be due within this many seconds (default 60)',
+        ),
+        make_option('--refill-seconds',
+            dest='refill_seconds',
+            type='int',
+            default=30,
+            help='Look for more due accounts at least this often (default 30)',
+        ),
+        make_option('--request-seconds',
+            dest='request_seconds',
+            type='int',
+            default=2,
+            help='Look for accounts readers asked to have polled this often (default 2)',
+        ),
+        make_option('--max-accounts',
+            dest='max_accounts',
+            type='int',
+            help='Restart in a fresh process after polling this many accounts',
+        ),
+        make_option('--max-rss',
+            dest='max_rss',
+            type='int',
+            metavar='MB',
+            help='Restart in a fresh process once using more than this many megabytes of memory',
+        ),
+        make_option('--parse-processes',
+            dest='parse_processes',
+            type='int',
+            help='Parse HTML in this many worker processes (default: the POLL_PARSE_PROCESSES setting, or none)',
+        ),
+    )
+
+    def handle_noargs(self, **options):
+        if options['workers'] < 1:
+            raise CommandError("--workers must be at least 1")
+        if options['max_accounts'] is not None and options['max_accounts'] < 1:
+            raise CommandError("--max-accounts must be at least 1")
+        if options['parse_processes'] is not None and options['parse_processes'] < 0:
+            raise CommandError("--parse-processes must not be negative")
+        if options['shard']:
+            try:
+                options['shard'] = parse_shard(options['shard'])
+            except ValueError, exc:
+                raise CommandError(str(exc))
+
+        self.options = options
+        # The queue is a heap of (due time, account ID) pairs.
+        self.queue = list()
+        self.queued = set()
+
+        runner = PollRunner(workers=options['workers'], max_accounts=options['max_accounts'],
+            max_rss=options['max_rss'], command='runpoller', parse_processes=options['parse_processes'])
+        interrupted = False
+        try:
+            self.run(runner)
+        except KeyboardInterrupt:
+            log.info("Interrupted; waiting for polls in progress to finish")
+            interrupted = True
+        finally:
+            runner.finish('interrupted' if interrupted else None)
+            for line in runner.summary():
+                log.info(line)
+
+        if runner.recycling and not interrupted:
+            # The queued accounts are still due, so the fresh process will find them.
+            restart_process()
+
+    def run(self, runner):
+        refill_interval = timedelta(seconds=self.options['refill_seconds'])
+        next_refill = datetime.utcnow()
+
+        while not runner.recycling:
+            now = datetime.utcnow()
+            # Readers are waiting on these, so poll them ahead of the routine ones.
+            self.poll_requested(runner)
+
+            if now >= next_refill:
+                # Pick up where any runs that died left off.
+                resume_dead_runs(now)
+                if self.refill(runner, now):
+                    # There may be more where those came from, so check again soon.
+                    next_refill = now
+                else:
+                    next_refill = now + refill_interval
+
+            self.poll_due(runner, now)
+
+            # Don't hold a connection (or a stale transaction) open while we sleep.
+            connection.close()
+
+            wake = min(next_refill, self.next_request_check)
+            if self.queue:
+                wake = min(wake, self.queue[0][0])
+            delay = total_seconds(wake - datetime.utcnow())
+            if delay > 0:
+                time.sleep(delay)
+
+    def refill(self, runner, now):
+        """Adds the next batch of accounts that will be due soon to the queue,
+        returning whether the batch was full."""
+        batch = self.options['batch']
+        due_horizon = now + timedelta(seconds=self.options['lookahead'])
+
+        accounts = due_accounts(due_horizon, self.options['service'], self.options['shard'])
+        # Don't bother queueing accounts other pollers have claimed.
+        accounts = accounts.filter(Q(lease_expires__isnull=True) | Q(lease_expires__lte=due_horizon))
+        skip = self.queued | runner.active_ids()
+        if skip:
+            accounts = accounts.exclude(pk__in=skip)
+        accounts = accounts.order_by('next_poll').values_list('pk', 'next_poll')[:batch]
+
+        count = 0
+        for pk, next_poll in accounts:
+            heapq.heappush(self.queue, (next_poll, pk))
+            self.queued.add(pk)
+            count += 1
+
+        if count:
+            log.debug("Queued %d more accounts to poll", count)
+        return count >= batch
+
+    def poll_requested(self, runner):
+        self.next_request_check = datetime.utcnow() + timedelta(seconds=self.options['request_seconds'])
+        requests = take_poll_requests(self.options['service'], self.options['shard'], limit=self.options['batch'])
+        if requests:
+            log.debug("Polling %d accounts readers asked for", len(requests))
+        for request in requests:
+            runner.submit(request.account, urgent=True, pages=request.pages)
+
+    def poll_due(self, runner, now):
+        due_ids = list()
+        while self.queue and self.queue[0][0] <= now:
+            due, pk = heapq.heappop(self.queue)
+            self.queued.discard(pk)
+            due_ids.append(pk)
+        if not due_ids:
+            return
+
+        # Load the accounts fresh, in case they changed since we queued them.
+        accounts = Account.objects.in_bulk(due_ids)
+        for pk in due_ids:
+            # With one worker, each account is polled before the next is
+            # submitted, so keep polling the accounts readers ask for first.
+            if datetime.utcnow() >= self.next_request_check:
+                self.poll_requested(runner)
+
+            account = accounts.get(pk)
+            if account is None:
+                continue
+            if account.next_poll > now:
+                log.debug("Account %s %s is no longer due, skipping", account.service, account.display_name)
+                continue
+
+            breaker = runner.breaker_for(account.service)
+            if breaker.is_open(now):
+                # Try again once the service's breaker lets polls through.
+                retry_at = max(breaker.retry_at, now + timedelta(seconds=1))
+                heapq.heappush(self.queue, (retry_at, pk))
+                self.queued.add(pk)
+                continue
+            runner.submit(account)
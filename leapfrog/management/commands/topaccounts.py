@@ -0,0 +1,75 @@
+from datetime import datetime, timedelta
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand, CommandError
+from django.db.models import Count, Sum
+
+from leapfrog.models import Account, PollMetric
+
+
+costs = {
+    'requests': 'http_requests',
+    'bytes': 'http_bytes',
+    'time': 'processing_time',
+    'writes': 'db_writes',
+}
+
+
+class Command(NoArgsCommand):
+
+    help = 'List the accounts that cost the most to poll for each stream item they find'
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--hours',
+            dest='hours',
+            type='int',
+            default=24 * 7,
+            help='Count the costs of polls in this many past hours (default 168)',
+        ),
+        make_option('--service',
+            dest='service',
+            help='List only accounts on this service',
+        ),
+        make_option('--by',
+            dest='by',
+            default='requests',
+            choices=sorted(costs.keys()),
+            help='Rank accounts by this cost per stream item: %s (default requests)' % ', '.join(sorted(costs.keys())),
+        ),
+        make_option('--limit',
+            dest='limit',
+            type='int',
+            default=20,
+            help='List this many accounts (default 20)',
+        ),
+    )
+
+    def handle_noargs(self, **options):
+        if options['hours'] < 1:
+            raise CommandError("--hours must be at least 1")
+
+        metrics = PollMetric.objects.filter(started__gte=datetime.utcnow() - timedelta(hours=options['hours']))
+        if options['service']:
+            metrics = metrics.filter(service=options['service'])
+        totals = list(metrics.values('account').annotate(polls=Count('id'),
+            http_requests=Sum('http_requests'), http_bytes=Sum('http_bytes'),
+            processing_time=Sum('processing_time'), db_writes=Sum('db_writes'),
+            stream_items=Sum('stream_items')))
+        if not totals:
+            print "No polls in the last %d hours" % options['hours']
+            return
+
+        # Accounts that found nothing cost as much per item as if they'd found one.
+        cost = costs[options['by']]
+        totals.sort(key=lambda row: row[cost] / float(max(row['stream_items'], 1)), reverse=True)
+        totals = totals[:options['limit']]
+        accounts = Account.objects.in_bulk([row['account'] for row in totals])
+
+        print "Accounts by %s per stream item over the last %d hours:" % (options['by'], options['hours'])
+        print "%-40s %6s %8s %9s %8s %7s %6s %9s" % ('account', 'polls', 'requests', 'KB', 'time', 'writes', 'items', 'per item')
+        for row in totals:
+            account = accounts.get(row['account'])
+            name = unicode(account) if account is not None else unicode(row['account'])
+            print "%-40s %6d %8d %9.1f %8.2f %7d %6d %9.2f" % (name[:40].encode('utf8'), row['polls'],
+                row['http_requests'], row['http_bytes'] / 1024.0, row['processing_time'], row['db_writes'],
+                row['stream_items'], row[cost] / float(max(row['stream_items'], 1)))
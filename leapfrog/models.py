@@ -1,10 +1,11 @@
 from datetime import datetime
 from urlparse import urlparse, urljoin
 
-from BeautifulSoup import BeautifulSoup
 from django.db import models
 from django.contrib.auth.models import User
 
+from leapfrog.poll.parse import parse, strip_scripts
+
 
 class Media(models.Model):
 
@@ -32,7 +33,7 @@ class Person(models.Model):
     avatar = models.ForeignKey(Media, blank=True, null=True)
     avatar_source = models.CharField(max_length=20, blank=True)
     permalink_url = models.CharField(max_length=100, blank=True)
-    last_viewed_home = models.DateTimeField(default=datetime.utcnow)
+    last_viewed_home = models.DateTimeField(default=datetime.utcnow, db_index=True)
 
     def __unicode__(self):
         return unicode(self.display_name)
@@ -41,13 +42,47 @@ class Person(models.Model):
         db_table = 'leapfrog_person'
 
 
+class PollRun(models.Model):
+
+    # The host and process ID doing the run.
+    owner = models.CharField(max_length=100)
+    command = models.CharField(max_length=30)
+    started = models.DateTimeField(default=datetime.utcnow)
+    last_seen = models.DateTimeField(default=datetime.utcnow)
+    finished = models.DateTimeField(null=True, blank=True, db_index=True)
+    status = models.CharField(max_length=20, blank=True)
+    # How many accounts the run polled.
+    accounts = models.IntegerField(default=0)
+
+    def __unicode__(self):
+        return u'%s run by %s at %s' % (self.command, self.owner, self.started)
+
+    class Meta:
+        db_table = 'leapfrog_pollrun'
+
+
 class Account(models.Model):
 
     service = models.CharField(max_length=20)
     ident = models.CharField(max_length=100)
     display_name = models.CharField(max_length=100)
-    last_updated = models.DateTimeField(default=datetime(year=2000, month=1, day=1))
+    last_updated = models.DateTimeField(default=datetime(year=2000, month=1, day=1), db_index=True)
     last_success = models.DateTimeField(default=datetime.utcnow)
+    next_poll = models.DateTimeField(default=datetime(year=2000, month=1, day=1), db_index=True)
+    # Average new stream items per hour found polling this account.
+    poll_yield = models.FloatField(null=True, blank=True)
+    # Which poller process has claimed this account, and until when.
+    lease_owner = models.CharField(max_length=100, blank=True)
+    lease_expires = models.DateTimeField(null=True, blank=True)
+    # How many polls of this account have failed in a row, and why the last did.
+    failure_count = models.IntegerField(default=0)
+    failure_reason = models.CharField(max_length=255, blank=True)
+    # How far the latest poll run to claim this account got with it.
+    poll_state = models.CharField(max_length=10, blank=True, db_index=True)
+    poll_run = models.ForeignKey(PollRun, null=True, blank=True, related_name='accounts_polled')
+    # Where the latest successful poll got to in the account's feed, so the
+    # next poll only asks for newer items (a tweet ID, a timestamp, etc).
+    poll_cursor = models.CharField(max_length=100, blank=True)
     authinfo = models.CharField(max_length=600, blank=True)
     person = models.ForeignKey(Person, related_name='accounts')
 
@@ -63,6 +98,49 @@ class Account(models.Model):
         db_table = 'leapfrog_account'
 
 
+class PollRequest(models.Model):
+
+    account = models.ForeignKey(Account, related_name='poll_requests')
+    requested = models.DateTimeField(default=datetime.utcnow, db_index=True)
+    # How many pages back to read, if more than the poller usually reads.
+    pages = models.IntegerField(null=True, blank=True)
+    # Why the poll was asked for: 'poll' when the reader came back to a stale
+    # stream, 'catchup' when they came back after we stopped polling them, or
+    # 'backfill' when they just connected the account.
+    kind = models.CharField(max_length=20, default='poll')
+    # When a poller took the request, if one has.
+    started = models.DateTimeField(null=True, blank=True)
+
+    def __unicode__(self):
+        return u'poll of %s requested at %s' % (self.account, self.requested)
+
+    class Meta:
+        db_table = 'leapfrog_pollrequest'
+
+
+class PollMetric(models.Model):
+
+    service = models.CharField(max_length=20)
+    account = models.ForeignKey(Account, related_name='poll_metrics')
+    started = models.DateTimeField(default=datetime.utcnow, db_index=True)
+    # Seconds the poll took, and how many of them were spent on our end
+    # (parsing and saving) rather than waiting for HTTP responses.
+    wall_time = models.FloatField()
+    processing_time = models.FloatField(default=0.0)
+    http_requests = models.IntegerField(default=0)
+    http_bytes = models.IntegerField(default=0)
+    db_writes = models.IntegerField(default=0)
+    object_count = models.IntegerField(default=0)
+    stream_items = models.IntegerField(default=0)
+    outcome = models.CharField(max_length=20)
+
+    def __unicode__(self):
+        return u'%s poll of %s at %s' % (self.outcome, self.account, self.started)
+
+    class Meta:
+        db_table = 'leapfrog_pollmetric'
+
+
 class Object(models.Model):
 
     RENDER_MODE_CHOICES = (
@@ -98,10 +176,7 @@ class Object(models.Model):
 
     def save(self, **kwargs):
         if self.body:
-            soup = BeautifulSoup(self.body)
-            for script_node in soup.findAll('script'):
-                script_node.extract()
-            self.body = str(soup).decode('utf8').strip()
+            self.body = parse(strip_scripts, self.body)
         return super(Object, self).save(**kwargs)
 
     @property
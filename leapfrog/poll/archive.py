@@ -0,0 +1,178 @@
+from __future__ import with_statement
+
+import errno
+from hashlib import sha1
+import json
+import logging
+import os
+import socket
+import threading
+from urllib import urlencode
+from urlparse import parse_qsl, urlparse, urlunparse
+
+import httplib2
+
+
+log = logging.getLogger(__name__)
+
+# OAuth parameters that are different every time the same request is
+# signed, so they're left out of archive keys.
+volatile_params = ('oauth_nonce', 'oauth_timestamp', 'oauth_signature')
+
+
+class NotRecorded(socket.error):
+
+    """Raised when replaying a request that isn't in the archive.
+
+    This is a `socket.error` so pollers treat it as if the service
+    couldn't be reached, as it can't be in an archive.
+
+    """
+
+    pass
+
+
+def normalize_query(query):
+    """Returns the query string (or form-encoded body) with its volatile
+    parameters removed and the rest in order."""
+    pairs = parse_qsl(query, keep_blank_values=True)
+    pairs = sorted(pair for pair in pairs if pair[0] not in volatile_params)
+    return urlencode(pairs)
+
+
+def archive_key(method, uri, body=None):
+    """Returns the key to archive the request with: a hash of its method,
+    its URL and its body, less any volatile OAuth parameters."""
+    scheme, netloc, path, params, query, fragment = urlparse(uri)
+    uri = urlunparse((scheme, netloc, path, params, normalize_query(query), ''))
+    if isinstance(uri, unicode):
+        uri = uri.encode('utf8')
+    body = body or ''
+    if isinstance(body, unicode):
+        body = body.encode('utf8')
+    try:
+        parse_qsl(body, keep_blank_values=True, strict_parsing=True)
+    except ValueError:
+        # It's not a form, so use it as is.
+        pass
+    else:
+        body = normalize_query(body)
+    return sha1('\n'.join((method.upper(), uri, body))).hexdigest()
+
+
+class HTTPArchive(object):
+
+    """A directory of recorded HTTP responses.
+
+    Each response is saved as a ``.json`` file of the request and the
+    response's headers, and a ``.body`` file of its content, named for its
+    `archive_key()` and how many times the same request was made before
+    it. When replaying, each repeat of a request is answered with the next
+    of its responses, or with its last response once they run out.
+
+    As the archived requests include the accounts' credentials, keep the
+    directory as private as the database.
+
+    """
+
+    def __init__(self, directory, replaying=False):
+        self.directory = directory
+        self.replaying = replaying
+        self.counts = dict()
+        self.lock = threading.Lock()
+        if not replaying and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def path(self, key, index, ext):
+        return os.path.join(self.directory, '%s-%d.%s' % (key, index, ext))
+
+    def record(self, method, uri, body, resp, content):
+        """Saves the response to the request in the archive."""
+        key = archive_key(method, uri, body)
+        with self.lock:
+            index = self.counts.get(key, 0)
+            while True:
+                # Another process may be recording to the same directory.
+                try:
+                    fd = os.open(self.path(key, index, 'json'), os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0600)
+                except OSError, exc:
+                    if exc.errno != errno.EEXIST:
+                        raise
+                    index += 1
+                    continue
+                break
+            self.counts[key] = index + 1
+
+        body_fd = os.open(self.path(key, index, 'body'), os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+        with os.fdopen(body_fd, 'wb') as f:
+            f.write(content or '')
+        headers = dict(resp)
+        headers['status'] = str(resp.status)
+        headers['reason'] = resp.reason
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'method': method, 'uri': uri, 'headers': headers}, f, indent=4)
+
+    def replay(self, method, uri, body):
+        """Returns the archived response to the request, as an
+        `httplib2.Response` and its content, raising `NotRecorded` if it
+        isn't in the archive."""
+        key = archive_key(method, uri, body)
+        with self.lock:
+            index = self.counts.get(key, 0)
+            if os.path.exists(self.path(key, index, 'json')):
+                self.counts[key] = index + 1
+            elif index > 0:
+                index -= 1
+            else:
+                raise NotRecorded("No response to %s %s is archived in %s" % (method, uri, self.directory))
+
+        with open(self.path(key, index, 'json')) as f:
+            recorded = json.load(f)
+        with open(self.path(key, index, 'body'), 'rb') as f:
+            content = f.read()
+        return httplib2.Response(recorded['headers']), content
+
+
+archive = None
+local = threading.local()
+
+
+def start_recording(directory):
+    """Records all the HTTP responses made through `httplib2` in the
+    archive directory (once `leapfrog.poll.metrics.install_http_hooks()`
+    has been called)."""
+    global archive
+    archive = HTTPArchive(directory)
+
+
+def start_replaying(directory):
+    """Answers all the HTTP requests made through `httplib2` from the
+    archive directory, without using the network."""
+    global archive
+    if not os.path.isdir(directory):
+        raise ValueError("Archive directory %s does not exist" % directory)
+    archive = HTTPArchive(directory, replaying=True)
+
+
+def archived_request(request, http, uri, method='GET', body=None, headers=None, *args, **kwargs):
+    """Makes the HTTP request with `request` (`httplib2.Http.request` or
+    the like), recording or replaying it if there's an archive.
+
+    httplib2 follows redirects by calling `request` again, so only the
+    outermost request is recorded, with the final response.
+
+    """
+    if archive is None or getattr(local, 'depth', 0):
+        return request(http, uri, method, body, headers, *args, **kwargs)
+
+    if archive.replaying:
+        log.debug("Replaying %s %s", method, uri)
+        return archive.replay(method, uri, body)
+
+    local.depth = 1
+    try:
+        resp, content = request(http, uri, method, body, headers, *args, **kwargs)
+    finally:
+        local.depth = 0
+    archive.record(method, uri, body, resp, content)
+    return resp, content
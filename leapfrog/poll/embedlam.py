@@ -16,7 +16,9 @@ import httplib2
 
 from leapfrog.models import Account, Object, Person, Media
 import leapfrog.poll.flickr
+import leapfrog.poll.httpclient
 import leapfrog.poll.mlkshk
+import leapfrog.poll.parse
 import leapfrog.poll.tumblr
 import leapfrog.poll.twitter
 import leapfrog.poll.typepad
@@ -157,18 +159,82 @@ def title_from_html_head(head):
     return title
 
 
-def object_from_html_head(url, orig_url, head):
-    title = title_from_html_head(head)
+def page_data(content, url, orig_url):
+    """Returns the values we make objects from in the head of the HTML page
+    `content`, as a dict of strings, or `None` if the page has no head.
+
+    The page is the one at `url`, fetched (perhaps through redirects) by
+    requesting `orig_url`. Its ``url`` value is its canonical URL, if it
+    declares one at the same host.
+
+    This only parses the page, so `Page` can have it done in a parser
+    process with `leapfrog.poll.parse.parse()`.
+
+    """
+    try:
+        soup = BeautifulSoup(content)
+    except HTMLParseError, exc:
+        raise ValueError("Could not parse HTML response for %s: %s" % (url, str(exc)))
+    head = soup.head
+    if head is None:
+        return None
+
+    def value(elems, default=None, base_url=None):
+        # Don't return NavigableStrings, which drag the whole tree along.
+        value = value_for_meta_elems(elems, default, base_url)
+        return unicode(value) if value is not None else None
+
+    data = {'url': url}
+
+    # What's the real URL?
+    og_url_elem = head.find("meta", property="og:url")
+    canon_elem = head.find('link', rel='canonical')
+    canon_url = value((og_url_elem, canon_elem), base_url=url)
+
+    if canon_url is not None:
+        # Only allow this canonicalization if it's at the same domain as the original URL.
+        orig_host = urlparse(url)[1]
+        canon_host = urlparse(canon_url)[1]
+        if orig_host == canon_host:
+            log.debug('Decided canonical URL for %s is %s, so using that', url, canon_url)
+            data['url'] = canon_url
+
+    data['title'] = unicode(title_from_html_head(head))
 
     old_facebook_video_elem = head.find('link', rel='video_src')
-    video_url = value_for_meta_elems((old_facebook_video_elem,), base_url=orig_url)
+    data['video_url'] = value((old_facebook_video_elem,), base_url=orig_url)
+    video_height_elem = head.find('meta', attrs={'name': 'video_height'})
+    data['video_height'] = value((video_height_elem,), '')
+    video_width_elem = head.find('meta', attrs={'name': 'video_width'})
+    data['video_width'] = value((video_width_elem,), '')
+    video_type_elem = head.find('meta', attrs={'name': 'video_type'})
+    data['video_type'] = value((video_type_elem,), '')
 
     og_image_elem = head.find("meta", property="og:image")
     old_facebook_image_elem = head.find("link", rel="image_src")
-    image_url = value_for_meta_elems((og_image_elem, old_facebook_image_elem), base_url=orig_url)
+    data['image_url'] = value((og_image_elem, old_facebook_image_elem), base_url=orig_url)
 
     og_summary_elem = head.find("meta", property="og:description")
-    summary = value_for_meta_elems((og_summary_elem,), "")
+    data['summary'] = value((og_summary_elem,), "")
+
+    # Does it support OEmbed?
+    oembed_node = head.find(rel='alternate', type='application/json+oembed')
+    # TODO: support xml?
+    data['oembed_url'] = value((oembed_node,))
+
+    # Does it have a feed declared?
+    atom_feed_link = head.find(rel='alternate', type='application/atom+xml')
+    rss_feed_link = head.find(rel='alternate', type='application/rss+xml')
+    data['feed_url'] = value((atom_feed_link, rss_feed_link), base_url=orig_url)
+
+    return data
+
+
+def object_from_html_head(url, head):
+    title = head['title']
+    video_url = head['video_url']
+    image_url = head['image_url']
+    summary = head['summary']
 
     if not video_url and not image_url and not summary:
         log.debug("Found neither an image URL nor a summary for %s, so returning no object", url)
@@ -178,12 +244,9 @@ def object_from_html_head(url, orig_url, head):
     if video_url:
         embed_code_parts = ["<embed", 'src="%s"' % video_url, 'allowfullscreen="true" wmode="transparent"']
 
-        video_height_elem = head.find('meta', attrs={'name': 'video_height'})
-        video_height = value_for_meta_elems((video_height_elem,), '')
-        video_width_elem = head.find('meta', attrs={'name': 'video_width'})
-        video_width = value_for_meta_elems((video_width_elem,), '')
-        video_type_elem = head.find('meta', attrs={'name': 'video_type'})
-        video_type = value_for_meta_elems((video_type_elem,), '')
+        video_height = head['video_height']
+        video_width = head['video_width']
+        video_type = head['video_type']
 
         if video_height:
             embed_code_parts.append('height="%s"' % video_height)
@@ -236,8 +299,19 @@ def object_from_html_head(url, orig_url, head):
 
 
 def object_from_feed_entry(feed_url, item_url):
+    # Fetch the feed ourselves, so the request is counted and archived like
+    # the rest.
+    try:
+        resp, content = EmbedlamUserAgent().request(feed_url)
+    except RequestError, exc:
+        log.debug("Couldn't fetch feed %s: %s", feed_url, str(exc))
+        return None
+    if resp.status != 200:
+        log.debug("Unexpected response fetching feed %s: %d %s", feed_url, resp.status, resp.reason)
+        return None
+
     try:
-        feed = feedparser.parse(feed_url)
+        feed = feedparser.parse(content)
     except IndexError, exc:
         log.debug("Got a %s parsing feed %s: %s", type(exc).__name__, feed_url, str(exc))
         return None
@@ -338,25 +412,64 @@ class RequestError(ValueError):
     pass
 
 
+class ServerError(RequestError):
+
+    """An error indicating the remote service itself is down or failing,
+    rather than that there's something wrong with the particular request."""
+
+    pass
+
+
 class EmbedlamUserAgent(httplib2.Http):
 
     def __init__(self, cache=None, timeout=10, proxy_info=None):
+        if cache is None:
+            # Share the response cache, so links shared by many accounts
+            # aren't downloaded again for each one.
+            cache = leapfrog.poll.httpclient.get_cache()
         super(EmbedlamUserAgent, self).__init__(cache, timeout, proxy_info, disable_ssl_certificate_validation=True)
+        self.fetches = 0
+        self.request_depth = 0
+
+    def _conn_request(self, conn, request_uri, method, body, headers):
+        # Count the requests httplib2 makes over the network, rather than
+        # answering from the cache.
+        self.fetches += 1
+        return super(EmbedlamUserAgent, self)._conn_request(conn, request_uri, method, body, headers)
+
+    def cached_request(self, *args):
+        """Makes the request as `httplib2.Http.request` does, counting how
+        the response cache did for it (see
+        `leapfrog.poll.httpclient.ResponseCache.count_response()`).
+
+        httplib2 follows redirects by calling `request()` again, so only
+        the outermost request, with the final response, is counted.
+
+        """
+        fetches = self.fetches
+        self.request_depth += 1
+        try:
+            resp, cont = super(EmbedlamUserAgent, self).request(*args)
+        finally:
+            self.request_depth -= 1
+        if self.request_depth == 0 and isinstance(self.cache, leapfrog.poll.httpclient.ResponseCache):
+            self.cache.count_response(resp, self.fetches > fetches)
+        return resp, cont
 
     def request(self, uri, method='GET', body=None, headers=None, redirections=httplib2.DEFAULT_MAX_REDIRECTS, connection_type=None):
         headers = {} if headers is None else dict(headers)
         headers['user-agent'] = 'leapfrog/1.0'
         try:
             try:
-                resp, cont = super(EmbedlamUserAgent, self).request(uri, method, body, headers, redirections, connection_type)
+                resp, cont = self.cached_request(uri, method, body, headers, redirections, connection_type)
             except httplib2.FailedToDecompressContent:
                 # Try asking again with no compression.
                 headers['Accept-Encoding'] = 'identity'
-                resp, cont = super(EmbedlamUserAgent, self).request(uri, method, body, headers, redirections, connection_type)
+                resp, cont = self.cached_request(uri, method, body, headers, redirections, connection_type)
         except socket.timeout:
-            raise RequestError("Request to %s timed out" % uri)
+            raise ServerError("Request to %s timed out" % uri)
         except socket.error, exc:
-            raise RequestError("Request to %s could not complete: %s" % (uri, str(exc)))
+            raise ServerError("Request to %s could not complete: %s" % (uri, str(exc)))
         except httplib2.RedirectLimit:
             raise RequestError("%s redirected too many times" % uri)
         except httplib2.ServerNotFoundError, exc:
@@ -364,16 +477,16 @@ class EmbedlamUserAgent(httplib2.Http):
         except httplib2.RelativeURIError:
             raise RequestError("httplib2 won't resolve relative URL %r" % uri)
         except httplib.BadStatusLine:
-            raise RequestError("%s returned an empty response (probably)" % uri)
+            raise ServerError("%s returned an empty response (probably)" % uri)
         except httplib.IncompleteRead:
-            raise RequestError("Got an incomplete read trying to load %s" % uri)
+            raise ServerError("Got an incomplete read trying to load %s" % uri)
         except httplib.InvalidURL:
             raise RequestError("Invalid URL %r according to httplib" % uri)
         except ssl.SSLError, exc:
             raise RequestError("Error occurred fetching %s over SSL: %s" % (uri, str(exc)))
 
         if resp.status >= 500:
-            raise RequestError("Server Error %d fetching %s", resp.status, uri)
+            raise ServerError("Server Error %d fetching %s" % (resp.status, uri))
 
         return resp, cont
 
@@ -385,6 +498,7 @@ class Page(object):
         self.orig_url = url
         self.url = url
         self.type = 'html'
+        self.head = None
 
         # These we can already ask about by URL, so don't bother fetching about them.
         if re.match(r'http:// (?: [^/]* flickr\.com/photos/[^/]+/\d+ | twitpic\.com/\w+ | twitter\.com/ (?: \#!/ )? [^/]+/ status/ (\d+) | vimeo\.com/ \d+ )', url, re.MULTILINE | re.DOTALL | re.VERBOSE):
@@ -397,7 +511,11 @@ class Page(object):
 
         # Fetch the resource and soupify it.
         h = EmbedlamUserAgent()
-        resp, content = h.request(url, redirections=max_redirects)
+        try:
+            resp, content = h.request(url, redirections=max_redirects)
+        except leapfrog.poll.httpclient.Throttled, exc:
+            # One rate limited link shouldn't put off the whole poll.
+            raise RequestError("Couldn't discover %s: %s" % (url, str(exc)))
 
         if resp.status == 404:
             raise RequestError("404 Not Found discovering %s" % url)
@@ -408,7 +526,8 @@ class Page(object):
         if resp.status == 400 and resp.reason == 'BAD_REQUEST' and url.startswith('http://bit.ly/'):
             raise RequestError("Spurious 400 Bad Request from bit.ly requesting %s" % url)
         if resp.status == 429:
-            raise RequestError("429 Too Many Requests from bitly (?) requesting %s" % url)
+            # The rate limiter will hold off on the host for a while.
+            raise RequestError("429 Too Many Requests from %s requesting %s" % (urlparse(url).hostname, url))
         if resp.status != 200:
             raise ValueError("Unexpected response discovering %s: %d %s" % (url, resp.status, resp.reason))
         url = resp['content-location']
@@ -432,44 +551,32 @@ class Page(object):
             # hmm
             raise RequestError("Unsupported content type %s/%s for resource %s" % (content_type[0], content_type[1], url))
 
-        try:
-            soup = BeautifulSoup(content)
-        except HTMLParseError, exc:
-            raise ValueError("Could not parse HTML response for %s: %s" % (url, str(exc)))
-        head = soup.head
+        head = leapfrog.poll.parse.parse(page_data, content, url, self.orig_url)
         if head is None:
             raise RequestError('Could not discover against HTML target %s with no head' % url)
 
-        # What's the real URL?
-        orig_url = url
-        og_url_elem = head.find("meta", property="og:url")
-        canon_elem = head.find('link', rel='canonical')
-        canon_url = value_for_meta_elems((og_url_elem, canon_elem), base_url=orig_url)
-
-        if canon_url is not None:
-            # Only allow this canonicalization if it's at the same domain as the original URL.
-            orig_host = urlparse(url)[1]
-            canon_host = urlparse(canon_url)[1]
-            if orig_host == canon_host:
-                log.debug('Decided canonical URL for %s is %s, so using that', url, canon_url)
-                url = canon_url
-
-        self.url = url
+        self.url = head['url']
         self.content = content
-        self.soup = soup
+        self.head = head
 
     @property
     def title(self):
-        try:
-            return title_from_html_head(self.soup.head)
-        except AttributeError:
+        if self.head is None:
             return None
+        return self.head['title']
 
     @property
     def permalink_url(self):
         return self.url
 
     def to_object(self):
+        try:
+            return self.find_object()
+        except leapfrog.poll.httpclient.Throttled, exc:
+            # One rate limited link shouldn't put off the whole poll.
+            raise RequestError("Couldn't make an object for %s: %s" % (self.url, str(exc)))
+
+    def find_object(self):
         url = self.url
 
         # If this URL points directly at an image then let's make a photo object
@@ -515,24 +622,19 @@ class Page(object):
         except Object.DoesNotExist:
             pass  # time to make the donuts
 
-        try:
-            head = self.soup.head
-        except AttributeError:
+        head = self.head
+        if head is None:
             raise ValueError("Thought URL %s would be handled specially but it wasn't" % self.url)
 
         # Does it support OEmbed?
-        oembed_node = head.find(rel='alternate', type='application/json+oembed')
-        # TODO: support xml?
-        if oembed_node is not None:
+        if head['oembed_url'] is not None:
             log.debug('Finding object for %s through OEmbed', url)
-            oembed_url = urljoin(url, oembed_node['href'])
+            oembed_url = urljoin(url, head['oembed_url'])
             return object_from_oembed(oembed_url, url, discovered=True)
 
         # Does it have a feed declared? If so, let's go hunting in the feed for
         # an entry corresponding to this page.
-        atom_feed_link = head.find(rel='alternate', type='application/atom+xml')
-        rss_feed_link = head.find(rel='alternate', type='application/rss+xml')
-        feed_url = value_for_meta_elems((atom_feed_link, rss_feed_link), base_url=self.orig_url)
+        feed_url = head['feed_url']
         if feed_url:
             object = object_from_feed_entry(feed_url, url)
             if object:
@@ -540,7 +642,7 @@ class Page(object):
                 return object
 
         log.debug('Finding object for %s from the existing HTML head data', url)
-        return object_from_html_head(url, self.orig_url, head)
+        return object_from_html_head(url, head)
 
 
 def object_for_url(url):
@@ -1,3 +1,4 @@
+import calendar
 from datetime import datetime
 import json
 import logging
@@ -12,68 +13,90 @@ from urlparse import urlunparse
 
 from leapfrog.models import Object, Account, Person, UserStream, Media, UserReplyStream
 import leapfrog.poll.embedlam
+from leapfrog.poll.stages import Stages, newest_saved, run_stages
 
 
 log = logging.getLogger(__name__)
 
 
-def poll_facebook(account):
-    user = account.person.user
-    if user is None:
-        log.debug("No user attached to account %r. Skipping.", account)
-        return
-
+def fetch_facebook(account, cursor):
+    """Returns the raw page of the Facebook account's news feed at the
+    paging URL `cursor` (or the latest page, if `cursor` is `None`)."""
     access_token = account.authinfo
     if not access_token:
         log.error("Account %r has no authinfo. Ignoring.", account)
         # Nothing to do!
-        return
-
-    # Now find out who this user is
-    query = { 'access_token': access_token }
-    url = urlunparse(('https', 'graph.facebook.com', 'me/home', None, urlencode(query), None))
+        return None
+
+    url = cursor
+    if url is None:
+        # Now find out who this user is
+        query = { 'access_token': access_token }
+        if account.poll_cursor:
+            # Only ask for the items posted since the last poll.
+            query['since'] = account.poll_cursor
+        url = urlunparse(('https', 'graph.facebook.com', 'me/home', None, urlencode(query), None))
     log.debug("Fetching news feed for %r from %s", account, url)
     h = leapfrog.poll.embedlam.EmbedlamUserAgent()
-    try:
-        resp, content = h.request(url, method='GET')
-    except leapfrog.poll.embedlam.RequestError, exc:
-        log.info("Expected error asking for %s's feed: %s", str(exc))
-        return
+    resp, content = h.request(url, method='GET')
+    return content
+
+
+def normalize_facebook(account, content, cursor):
+    """Returns the links and videos in a raw page of a news feed, oldest
+    first, and the URL of the page before it."""
     try:
         feed = json.loads(content)
     except ValueError:
         log.info("Facebook returned non-JSON content for %s's feed: %r", account.display_name, content)
-        return
+        return [], None
 
     if 'error' in feed:
-        if feed['error']['type'] == 'OAuthException':
-            # User probably changed their password. Ignore it.
-            log.debug("Facebook returned OAuthException I'm ignoring: %s", feed['error']['message'])
-            return
-        log.error("Facebook returned %s: %s", feed['error']['type'], feed['error']['message'])
-        return
+        # For an OAuthException, the user probably changed their password.
+        raise leapfrog.poll.embedlam.RequestError("Facebook returned %s asking for %s's feed: %s"
+            % (feed['error']['type'], account.display_name, feed['error']['message']))
     if 'data' not in feed:
         log.info("Facebook returned data-free feed for %s (%s): %r", account.display_name, account.ident, feed)
-        return
+        return [], None
 
     items = feed["data"]
+    if not items:
+        return [], None
 
+    records = list()
     for item in reversed(items):
+        # we only care about "link" and "video".
+        # "video" is just a funny case of link in facebook anyway.
+        # This specifically ignores "status", since I don't think
+        # Facebook statuses really qualify as interesting content
+        # by the definition this application uses.
+        type = item.get("type")
+        if type != "link" and type != "video":
+            log.debug("Ignoring %s because it's a %s", item.get("id"), type)
+            continue
+        records.append(item)
+
+    try:
+        next_url = feed['paging']['next']
+    except KeyError:
+        next_url = None
+    return records, next_url
+
+
+def persist_facebook(account, items):
+    """Saves the links and videos to the Facebook account's user's stream,
+    returning whether any were already there and the items that couldn't be
+    saved."""
+    user = account.person.user
+
+    overlap = False
+    failed = list()
+    for item in items:
 
         try:
             id = item["id"]
-
-            # we only care about "link" and "video".
-            # "video" is just a funny case of link in facebook anyway.
-            # This specifically ignores "status", since I don't think
-            # Facebook statuses really qualify as interesting content
-            # by the definition this application uses.
             type = item["type"]
 
-            if type != "link" and type != "video":
-                log.debug("Ignoring %s because it's a %s", id, type)
-                continue
-
             log.debug("Trying to make an object for this Facebook %s item %s", type, id)
 
             (orig_obj, actor) = object_for_facebook_item(item, requesting_account=account)
@@ -99,6 +122,8 @@ def poll_facebook(account):
             log.debug("Creating a UserStream row for object %r which is a %s by %r", obj, why_verb, actor)
             streamitem, created = UserStream.objects.get_or_create(user=user, obj=obj,
                 defaults={'why_account': actor, 'why_verb': why_verb, 'time': orig_obj.time})
+            if not created:
+                overlap = True
 
             # Now walk up again creating UserReplyStream rows as necessary
             reply_obj = orig_obj
@@ -111,6 +136,34 @@ def poll_facebook(account):
         except Exception, exc:
             from sentry.client.base import SentryClient
             SentryClient().create_from_exception(view=__name__)
+            failed.append(item)
+
+    return overlap, failed
+
+
+def mark_facebook(account, items, failed):
+    """Returns when the newest item saved before any that failed was posted,
+    as a Unix timestamp, to ask only for the items since then next time."""
+    created = lambda item: datetime.strptime(item['created_time'], '%Y-%m-%dT%H:%M:%S+0000')
+    item = newest_saved(items, failed, created)
+    if item is None:
+        return None
+    return str(calendar.timegm(created(item).timetuple()))
+
+
+stages = Stages(fetch_facebook, normalize_facebook, persist_facebook, mark=mark_facebook)
+
+
+def poll_facebook(account, pages=None):
+    """Adds the new links and videos in the Facebook account's news feed to
+    its user's stream.
+
+    Only the latest page of the feed is read, unless `pages` asks to page
+    back through up to that many pages, stopping at the first page with
+    items already in the stream.
+
+    """
+    run_stages(stages, account, pages)
 
 
 def account_for_facebook_user(fb_user, person=None):
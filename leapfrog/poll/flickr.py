@@ -13,6 +13,7 @@ import httplib2
 
 from leapfrog.models import Account, Media, Person, Object, UserStream
 import leapfrog.poll.embedlam
+from leapfrog.poll.stages import Stages, newest_saved, run_stages
 
 
 log = logging.getLogger(__name__)
@@ -188,29 +189,62 @@ def object_from_url(url):
     return obj
 
 
-def poll_flickr(account):
+def fetch_flickr(account, cursor):
+    """Returns the latest photos from the Flickr account's contacts."""
+    return call_flickr('flickr.photos.getContactsPhotos', sign=True, auth_token=account.authinfo)
+
+
+def normalize_flickr(account, recent, cursor):
+    """Returns records for the photos in the contacts' photos that are newer
+    than the last poll.
+
+    flickr.photos.getContactsPhotos only gives the latest photos, so there
+    are no more pages to read. It can't be asked for only the photos since
+    some time either, but as Flickr's photo IDs only go up, the ones we saw
+    last time are easy to skip.
+
+    """
+    records = [{'id': slim_photodata['id']} for slim_photodata in recent['photos']['photo']]
+    if account.poll_cursor:
+        last_id = int(account.poll_cursor)
+        records = [record for record in records if int(record['id']) > last_id]
+    return records, None
+
+
+def fetch_flickr_details(account, records):
+    """Asks Flickr about the photos in the records we haven't seen before,
+    for `persist_flickr` to make objects from."""
+    seen = set(Object.objects.filter(service='flickr.com', foreign_id__in=[record['id'] for record in records])
+        .values_list('foreign_id', flat=True))
+    for record in records:
+        if record['id'] in seen:
+            continue
+        try:
+            resp = call_flickr('flickr.photos.getInfo', photo_id=record['id'], extras='date_upload,o_dims',
+                sign=True, auth_token=account.authinfo)
+        except leapfrog.poll.embedlam.RequestError:
+            log.debug("Expected problem making requesting photo data, ignoring", exc_info=True)
+            continue
+        record['photodata'] = resp['photo']
+
+
+def persist_flickr(account, records):
+    """Saves the photos to the Flickr account's user's stream, returning the
+    records of the photos that couldn't be saved."""
     user = account.person.user
-    if user is None:
-        return
 
-    try:
-        recent = call_flickr('flickr.photos.getContactsPhotos', sign=True, auth_token=account.authinfo)
-    except leapfrog.poll.embedlam.RequestError:
-        log.debug("Expected problem polling Flickr photos for account %s", account.ident, exc_info=True)
-        return
-    for slim_photodata in recent['photos']['photo']:
-        photo_id = slim_photodata['id']
+    failed = list()
+    for record in records:
+        photo_id = record['id']
         try:
             obj = Object.objects.get(service='flickr.com', foreign_id=photo_id)
             log.debug("Reusing existing object %r for Flickr photo #%s", obj, photo_id)
         except Object.DoesNotExist:
-            try:
-                resp = call_flickr('flickr.photos.getInfo', photo_id=photo_id, extras='date_upload,o_dims',
-                    sign=True, auth_token=account.authinfo)
-            except leapfrog.poll.embedlam.RequestError:
-                log.debug("Expected problem making requesting photo data, ignoring", exc_data=True)
+            photodata = record.get('photodata')
+            if photodata is None:
+                # Flickr couldn't tell us about it.
+                failed.append(record)
                 continue
-            photodata = resp['photo']
 
             # Omit instagram and picplz shares.
             for tagdata in photodata['tags']['tag']:
@@ -221,12 +255,36 @@ def poll_flickr(account):
             try:
                 obj = make_object_from_photo_data(photodata)
             except leapfrog.poll.embedlam.RequestError:
-                log.debug("Expected problem making object from photo data, ignoring", exc_data=True)
+                log.debug("Expected problem making object from photo data, ignoring", exc_info=True)
+                failed.append(record)
             except Exception, exc:
                 log.exception(exc)
+                failed.append(record)
                 continue
             if obj is None:
                 continue
 
         UserStream.objects.get_or_create(user=user, obj=obj,
             defaults={'time': obj.time, 'why_account': obj.author, 'why_verb': 'post'})
+
+    # Only the latest photos are read anyway.
+    return False, failed
+
+
+def mark_flickr(account, records, failed):
+    """Returns the ID of the newest photo saved before any that failed, to
+    skip the photos up to it next time."""
+    record = newest_saved(records, failed, lambda record: int(record['id']))
+    if record is None:
+        return None
+    return record['id']
+
+
+stages = Stages(fetch_flickr, normalize_flickr, persist_flickr, mark=mark_flickr,
+    fetch_details=fetch_flickr_details)
+
+
+def poll_flickr(account, pages=None):
+    # flickr.photos.getContactsPhotos only gives the latest photos, so there
+    # are no more pages to read.
+    run_stages(stages, account, pages)
@@ -0,0 +1,593 @@
+from __future__ import with_statement
+
+from email.utils import mktime_tz, parsedate_tz
+import errno
+from hashlib import sha1
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+from urlparse import parse_qs, urlparse
+
+from django.conf import settings
+import httplib2
+
+
+log = logging.getLogger(__name__)
+
+# How many idle connections to keep open to each host.
+default_pool_size = 4
+# How long (in seconds) to keep an idle connection open before closing it.
+default_idle_seconds = 30
+# How big the response cache may get, in megabytes.
+default_cache_mb = 100
+# How many requests may be made to each host in how many seconds, in bursts
+# of up to that many requests. The POLL_RATE_LIMITS setting can override
+# these, and POLL_RATE_LIMIT_DEFAULT the limit for all other hosts.
+default_rate_limits = {
+    'api.twitter.com': (20, 1),
+    'api.tumblr.com': (10, 1),
+    'api.flickr.com': (3600, 3600),
+    'graph.facebook.com': (600, 600),
+    'vimeo.com': (10, 1),
+    'mlkshk.com': (10, 1),
+    'api.typepad.com': (10, 1),
+}
+default_rate_limit = (10, 1)
+# The longest to wait (in seconds) for a host's rate limit before giving up
+# on the request.
+default_max_rate_wait = 10
+# How long to leave a host alone after it says we've made too many
+# requests, if it doesn't say how long.
+default_retry_after = 60
+
+
+class ConnectionPool(object):
+
+    """Idle persistent HTTP connections, shared by all the `httplib2`
+    clients in the process.
+
+    httplib2 keeps an `Http` object's connections open between requests,
+    but nearly every request is made with a new `Http` (or `oauth.Client`,
+    or `EmbedlamUserAgent`), so without sharing them every request would
+    open a new connection. Instead, each request borrows an idle
+    connection to its host from the pool, if there is one, and gives back
+    all its client's connections when it's done.
+
+    Connections are pooled separately for clients that check certificates
+    differently, so a connection opened without checking the certificate
+    isn't lent to a client that would have.
+
+    Up to `size` idle connections are kept for each host, each for up to
+    `idle_seconds` seconds.
+
+    """
+
+    def __init__(self, size=None, idle_seconds=None):
+        if size is None:
+            size = getattr(settings, 'POLL_HTTP_POOL_SIZE', default_pool_size)
+        if idle_seconds is None:
+            idle_seconds = getattr(settings, 'POLL_HTTP_IDLE_SECONDS', default_idle_seconds)
+        self.size = size
+        self.idle_seconds = idle_seconds
+        self.idle = dict()
+        self.opened = 0
+        self.reused = 0
+        self.lock = threading.Lock()
+
+    def checkout(self, key):
+        """Returns an idle connection for the key, or `None` if there are
+        none that are still fresh."""
+        stale = list()
+        conn = None
+        now = time.time()
+        with self.lock:
+            conns = self.idle.get(key, [])
+            if conns:
+                candidate, last_used = conns.pop()
+                if now - last_used <= self.idle_seconds:
+                    conn = candidate
+                    self.reused += 1
+                else:
+                    # The rest were idle even longer, so close them all.
+                    stale.append(candidate)
+                    stale.extend(candidate for candidate, last_used in conns)
+                    del conns[:]
+        for candidate in stale:
+            candidate.close()
+        return conn
+
+    def checkin(self, key, conn, reused=True):
+        """Gives the connection back to the pool to lend out again, or
+        closes it if there are already enough idle connections for the
+        key."""
+        with self.lock:
+            if not reused:
+                self.opened += 1
+            conns = self.idle.setdefault(key, [])
+            if conn.sock is not None and len(conns) < self.size:
+                conns.append((conn, time.time()))
+                return
+        conn.close()
+
+    def clear(self):
+        """Closes all the idle connections."""
+        with self.lock:
+            idle, self.idle = self.idle, dict()
+        for conns in idle.itervalues():
+            for conn, last_used in conns:
+                conn.close()
+
+    def summary(self):
+        with self.lock:
+            return 'HTTP connections: %d opened, %d reused' % (self.opened, self.reused)
+
+
+pool = None
+pool_lock = threading.Lock()
+
+
+def get_pool():
+    global pool
+    with pool_lock:
+        if pool is None:
+            pool = ConnectionPool()
+        return pool
+
+
+def pool_key(http, conn_key):
+    """Returns the key to pool the connections `http` makes to the
+    ``scheme:host`` `conn_key` under, or `None` if they shouldn't be
+    pooled."""
+    proxy_info = getattr(http, 'proxy_info', None)
+    if proxy_info is not None and not callable(proxy_info):
+        # Connections through a particular proxy are that client's own.
+        return None
+    return (conn_key, getattr(http, 'disable_ssl_certificate_validation', False),
+        getattr(http, 'ca_certs', None))
+
+
+def pooled_request(request, http, uri, *args, **kwargs):
+    """Makes the HTTP request with `request` (`httplib2.Http.request` or
+    the like) on a pooled connection to the host, if one is idle.
+
+    httplib2 follows redirects by calling `request` again, so the client's
+    connections are only given back to the pool when the outermost request
+    is done.
+
+    """
+    connections = getattr(http, 'connections', None)
+    if connections is None:
+        return request(http, uri, *args, **kwargs)
+    conn_pool = get_pool()
+
+    scheme, authority, request_uri, defrag_uri = httplib2.urlnorm(httplib2.iri2uri(uri))
+    conn_key = scheme + ':' + authority
+    key = pool_key(http, conn_key)
+    borrowed = getattr(http, '_pooled_connections', None)
+    outermost = borrowed is None
+    if outermost:
+        borrowed = http._pooled_connections = set()
+    if key is not None and conn_key not in connections:
+        conn = conn_pool.checkout(key)
+        if conn is not None:
+            # Reused connections keep the timeout they were opened with,
+            # so give them this client's (which may be capped to a
+            # poll's deadline).
+            conn.timeout = http.timeout
+            if conn.sock is not None:
+                conn.sock.settimeout(http.timeout)
+            connections[conn_key] = conn
+            borrowed.add(conn)
+
+    failed = True
+    try:
+        resp, content = request(http, uri, *args, **kwargs)
+        failed = False
+    finally:
+        if outermost:
+            del http._pooled_connections
+            for conn_key, conn in connections.items():
+                del connections[conn_key]
+                key = pool_key(http, conn_key)
+                if failed or key is None:
+                    # Who knows what state it's in, so don't lend it out.
+                    conn.close()
+                else:
+                    conn_pool.checkin(key, conn, reused=conn in borrowed)
+    return resp, content
+
+
+class ResponseCache(object):
+
+    """A cache of HTTP responses in a directory, for `httplib2` to keep
+    responses in.
+
+    httplib2 decides what to cache and for how long from the responses'
+    ``Cache-Control`` and ``Expires`` headers, and revalidates stale
+    responses with their ``ETag`` or ``Last-Modified`` date, so the cache
+    itself only stores them. Once the directory holds more than
+    `max_bytes`, the least recently used responses are deleted.
+
+    What the cache saves us is counted by `count_response()`, as only the
+    client knows whether the responses it found here were used as they
+    were, revalidated, or downloaded again.
+
+    Several processes can share the directory: responses are written to
+    temporary files and renamed into place, and responses another process
+    deleted are treated as missing. As responses to requests with
+    credentials in their URLs may be cached, keep the directory as private
+    as the database.
+
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.revalidations = 0
+        self.misses = 0
+        self.evictions = 0
+        self.written = 0
+        self.lock = threading.Lock()
+        try:
+            os.makedirs(directory, 0700)
+        except OSError, exc:
+            if exc.errno != errno.EEXIST:
+                raise
+
+    def path(self, key):
+        if isinstance(key, unicode):
+            key = key.encode('utf8')
+        return os.path.join(self.directory, sha1(key).hexdigest())
+
+    def get(self, key):
+        path = self.path(key)
+        try:
+            with open(path, 'rb') as f:
+                value = f.read()
+        except IOError, exc:
+            if exc.errno != errno.ENOENT:
+                raise
+            value = None
+        else:
+            # Mark it as recently used, so it's evicted last.
+            try:
+                os.utime(path, None)
+            except OSError:
+                pass
+        return value
+
+    def count_response(self, resp, fetched):
+        """Counts the response to a request made with the cache as a hit if
+        httplib2 answered it from the cache without making a request over
+        the network (`fetched`), as a revalidation if the cached response
+        was used after the host said it hadn't changed, or as a miss."""
+        with self.lock:
+            if not resp.fromcache:
+                self.misses += 1
+            elif fetched:
+                self.revalidations += 1
+            else:
+                self.hits += 1
+
+    def set(self, key, value):
+        if len(value) > self.max_bytes / 10:
+            # Don't let one huge response push out everything else.
+            self.delete(key)
+            return
+
+        fd, temp_path = tempfile.mkstemp(prefix='.', dir=self.directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(value)
+            os.rename(temp_path, self.path(key))
+        except:
+            os.unlink(temp_path)
+            raise
+
+        with self.lock:
+            self.written += len(value)
+            trim = self.written > self.max_bytes / 10
+            if trim:
+                self.written = 0
+        if trim:
+            self.trim()
+
+    def delete(self, key):
+        try:
+            os.unlink(self.path(key))
+        except OSError, exc:
+            if exc.errno != errno.ENOENT:
+                raise
+
+    def trim(self):
+        """Deletes the least recently used responses until the cache is
+        comfortably under its size limit."""
+        entries = list()
+        total = 0
+        now = time.time()
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            if name.startswith('.'):
+                # Someone's still writing it, unless they crashed doing so.
+                if now - stat.st_mtime > 3600:
+                    try:
+                        os.unlink(path)
+                    except OSError:
+                        pass
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+            total += stat.st_size
+        if total <= self.max_bytes:
+            return
+
+        entries.sort()
+        target = self.max_bytes * 0.9
+        evicted = 0
+        for mtime, size, path in entries:
+            if total <= target:
+                break
+            try:
+                os.unlink(path)
+            except OSError, exc:
+                if exc.errno != errno.ENOENT:
+                    raise
+            else:
+                evicted += 1
+            total -= size
+        log.debug("Evicted %d responses from the HTTP cache", evicted)
+        with self.lock:
+            self.evictions += evicted
+
+    def summary(self):
+        with self.lock:
+            return ('HTTP cache: %d hits, %d revalidated, %d misses, %d evicted'
+                % (self.hits, self.revalidations, self.misses, self.evictions))
+
+
+cache = None
+cache_lock = threading.Lock()
+
+
+def get_cache():
+    """Returns the response cache in the ``POLL_HTTP_CACHE_DIR`` directory,
+    or `None` if there's no cache directory set."""
+    global cache
+    with cache_lock:
+        if cache is None:
+            directory = getattr(settings, 'POLL_HTTP_CACHE_DIR', None)
+            if directory is None:
+                return None
+            max_mb = getattr(settings, 'POLL_HTTP_CACHE_MB', default_cache_mb)
+            cache = ResponseCache(directory, max_mb * 1024 * 1024)
+        return cache
+
+
+class Throttled(BaseException):
+
+    """Raised instead of making a request to a host when waiting for its
+    rate limit would take too long.
+
+    `retry_after` is how many seconds to wait before trying the host again.
+
+    Like `leapfrog.poll.metrics.PollTimeout`, this is a `BaseException`
+    rather than an `Exception`, so the pollers' handlers for problems with
+    individual items (or with requests in general) don't catch it, and the
+    whole poll is put off until the rate limit allows.
+
+    """
+
+    def __init__(self, host, retry_after):
+        super(Throttled, self).__init__("Requests to %s are rate limited for another %d seconds" % (host, retry_after))
+        self.host = host
+        self.retry_after = retry_after
+
+
+class TokenBucket(object):
+
+    """Spaces out requests to be made at `rate` per second on average, in
+    bursts of up to `burst` requests."""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.time()
+
+    def reserve(self, now):
+        """Takes a token, returning how many seconds to wait until it's
+        good. Tokens are taken in turn, so waiting requests go in order."""
+        # `now` can be from before the bucket was made or last refilled.
+        if now > self.updated:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+        self.tokens -= 1
+        if self.tokens >= 0:
+            return 0
+        return -self.tokens / self.rate
+
+    def refund(self):
+        """Gives back a token that wasn't used after all."""
+        self.tokens += 1
+
+
+def retry_after(resp, now):
+    """Returns how many seconds the response asks us to wait before making
+    more requests, or `None` if it doesn't."""
+    value = resp.get('retry-after')
+    if value is not None:
+        try:
+            return max(0, int(value))
+        except ValueError:
+            # It can also be a date.
+            when = parsedate_tz(value)
+            if when is not None:
+                return max(0, mktime_tz(when) - now)
+    if resp.status == 429:
+        return default_retry_after
+
+    if resp.get('x-ratelimit-remaining', '').strip() == '0':
+        try:
+            reset = int(resp.get('x-ratelimit-reset', ''))
+        except ValueError:
+            return default_retry_after
+        # Some hosts give the time the limit resets, others how long until then.
+        if reset > 1000000000:
+            reset -= now
+        return max(0, reset)
+    return None
+
+
+def credentials_for_request(uri, headers):
+    """Returns the OAuth or access token the request is made with, if any,
+    as hosts usually limit each token separately."""
+    query = parse_qs(urlparse(uri).query)
+    for param in ('oauth_token', 'access_token'):
+        if param in query:
+            return query[param][0]
+    for name, value in (headers or {}).iteritems():
+        if name.lower() == 'authorization':
+            mo = re.search(r'oauth_token="([^"]*)"', value)
+            if mo is not None:
+                return mo.group(1)
+    return None
+
+
+class RateLimiter(object):
+
+    """Keeps our requests to each host within its rate limit.
+
+    Requests to each host are spaced out with a `TokenBucket`, at the rate
+    configured for the host. When a host tells us we're making too many
+    requests (with a ``429`` status, a ``Retry-After`` header, or an
+    ``X-RateLimit-Remaining`` of zero), requests to it with the same
+    credentials are held until it says we can go again.
+
+    Requests that would have to wait longer than `max_wait` seconds (or
+    the client's timeout, if that's shorter) raise `Throttled` instead of
+    waiting.
+
+    """
+
+    def __init__(self, limits=None, default_limit=None, max_wait=None):
+        if limits is None:
+            limits = dict(default_rate_limits)
+            limits.update(getattr(settings, 'POLL_RATE_LIMITS', {}))
+        if default_limit is None:
+            default_limit = getattr(settings, 'POLL_RATE_LIMIT_DEFAULT', default_rate_limit)
+        if max_wait is None:
+            max_wait = getattr(settings, 'POLL_RATE_MAX_WAIT', default_max_rate_wait)
+        self.limits = limits
+        self.default_limit = default_limit
+        self.max_wait = max_wait
+        self.buckets = dict()
+        self.holds = dict()
+        self.waited = 0
+        self.wait_time = 0.0
+        self.throttled = 0
+        self.rate_limited = 0
+        self.lock = threading.Lock()
+
+    def bucket_for(self, host):
+        try:
+            return self.buckets[host]
+        except KeyError:
+            requests, seconds = self.limits.get(host, self.default_limit)
+            bucket = self.buckets[host] = TokenBucket(float(requests) / seconds, requests)
+            return bucket
+
+    def wait(self, host, credentials, timeout=None):
+        """Waits until a request to the host can be made, raising
+        `Throttled` if that would take too long."""
+        max_wait = self.max_wait
+        if timeout is not None:
+            max_wait = min(max_wait, timeout)
+        now = time.time()
+        with self.lock:
+            held = max(self.holds.get((host, None), 0), self.holds.get((host, credentials), 0)) - now
+            if held > max_wait:
+                self.throttled += 1
+                raise Throttled(host, held)
+            bucket = self.bucket_for(host)
+            delay = max(held, bucket.reserve(now))
+            if delay > max_wait:
+                bucket.refund()
+                self.throttled += 1
+                raise Throttled(host, delay)
+            if delay > 0:
+                self.waited += 1
+                self.wait_time += delay
+        if delay > 0:
+            log.debug("Waiting %.1f seconds for %s's rate limit", delay, host)
+            time.sleep(delay)
+
+    def observe(self, host, credentials, resp):
+        """Notes what the response says about the host's rate limit,
+        returning how many seconds it asks us to wait (or `None`)."""
+        now = time.time()
+        delay = retry_after(resp, now)
+        if delay is None:
+            return None
+        if resp.status == 429:
+            log.info("%s says we're making too many requests, holding off for %d seconds", host, delay)
+        until = now + delay
+        with self.lock:
+            if resp.status == 429:
+                self.rate_limited += 1
+            # Forget holds that are over.
+            for key, held in self.holds.items():
+                if held <= now:
+                    del self.holds[key]
+            key = (host, credentials)
+            self.holds[key] = max(self.holds.get(key, 0), until)
+        return delay
+
+    def summary(self):
+        with self.lock:
+            return ('HTTP rate limits: %d requests waited %.1f seconds, %d throttled, %d rejected by hosts'
+                % (self.waited, self.wait_time, self.throttled, self.rate_limited))
+
+
+limiter = None
+limiter_lock = threading.Lock()
+
+
+def get_limiter():
+    global limiter
+    with limiter_lock:
+        if limiter is None:
+            limiter = RateLimiter()
+        return limiter
+
+
+def throttled_request(request, http, conn, request_uri, method, body, headers):
+    """Makes the HTTP request on the connection `conn` with `request`
+    (`httplib2.Http._conn_request` or the like) once the host's rate limit
+    allows, raising `Throttled` if it won't allow it soon enough.
+
+    This is the request httplib2 makes over the network once it has looked
+    in its cache, so responses served from the cache don't count against
+    the limit.
+
+    If the host answers ``429 Too Many Requests`` but asks us to wait only
+    a short while, the request is made once more after waiting.
+
+    """
+    rate_limiter = get_limiter()
+    host = conn.host
+    credentials = credentials_for_request(request_uri, headers)
+    rate_limiter.wait(host, credentials, http.timeout)
+    resp, content = request(http, conn, request_uri, method, body, headers)
+    delay = rate_limiter.observe(host, credentials, resp)
+    if resp.status == 429 and delay is not None:
+        rate_limiter.wait(host, credentials, http.timeout)
+        resp, content = request(http, conn, request_uri, method, body, headers)
+        rate_limiter.observe(host, credentials, resp)
+    return resp, content
@@ -0,0 +1,260 @@
+from __future__ import with_statement
+
+from contextlib import contextmanager
+from datetime import datetime
+import threading
+import time
+
+from django.db.models.signals import post_save
+import httplib2
+
+from leapfrog.models import Object, PollMetric, UserStream, UserReplyStream
+from leapfrog.poll.archive import archived_request
+from leapfrog.poll.httpclient import pooled_request, throttled_request
+
+
+class PollTimeout(BaseException):
+
+    """Raised when polling an account has run past its deadline.
+
+    This is a `BaseException` rather than an `Exception` so that the
+    pollers' handlers for problems with individual items don't catch it,
+    and the whole poll is abandoned.
+
+    """
+
+    pass
+
+
+class RequestRate(object):
+
+    """Keeps track of the most HTTP requests made in any one second."""
+
+    def __init__(self):
+        self.second = None
+        self.count = 0
+        self.peak = 0
+        self.lock = threading.Lock()
+
+    def record(self, when=None):
+        if when is None:
+            when = time.time()
+        second = int(when)
+        with self.lock:
+            if second != self.second:
+                self.second = second
+                self.count = 0
+            self.count += 1
+            self.peak = max(self.peak, self.count)
+
+
+class PollContext(object):
+
+    """Tallies what happens while polling one account.
+
+    While a context is entered, HTTP requests made through `httplib2` (and
+    the clients built on it, once `install_http_hooks()` has been called)
+    and the time spent waiting for them, rows
+    saved, and new `Object`, `UserStream` and `UserReplyStream` rows in the
+    same thread are counted toward it.
+    The requests are also recorded in the `RequestRate` given as `rate`,
+    if any.
+
+    If the context has a `timeout` (in seconds), HTTP requests made after
+    that long raise `PollTimeout`, and requests made before then time out
+    at the deadline.
+
+    """
+
+    local = threading.local()
+
+    def __init__(self, rate=None, timeout=None):
+        self.rate = rate
+        self.timeout = timeout
+        self.deadline = None
+        self.started = None
+        self.wall_time = 0.0
+        self.http_requests = 0
+        self.http_bytes = 0
+        self.http_time = 0.0
+        self.db_writes = 0
+        self.objects = 0
+        self.stream_items = 0
+        self.request_depth = 0
+
+    @classmethod
+    def current(cls):
+        return getattr(cls.local, 'context', None)
+
+    def __enter__(self):
+        self.started = datetime.utcnow()
+        self.start_time = time.time()
+        if self.timeout is not None and self.deadline is None:
+            self.deadline = self.start_time + self.timeout
+        self.outer = self.current()
+        self.local.context = self
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.wall_time += time.time() - self.start_time
+        self.local.context = self.outer
+
+    def fork(self):
+        """Returns a context for tallying what another thread does as part
+        of the same poll, with the same deadline. Add its tallies back into
+        this context with `join()` when the thread is done."""
+        context = PollContext(self.rate, self.timeout)
+        context.deadline = self.deadline
+        return context
+
+    def join(self, context):
+        """Adds the tallies of a context from `fork()` to this one's.
+
+        Forked threads wait for their HTTP responses at the same time, so
+        their waits would add up to more than the poll's wall time. Their
+        time waiting isn't added; instead, the time this context's thread
+        spends blocked on them is counted with `waiting_for_http()`.
+
+        """
+        self.http_requests += context.http_requests
+        self.http_bytes += context.http_bytes
+        self.db_writes += context.db_writes
+        self.objects += context.objects
+        self.stream_items += context.stream_items
+
+    def remaining(self):
+        """Returns how many seconds are left until the deadline, raising
+        `PollTimeout` if there are none."""
+        if self.deadline is None:
+            return None
+        remaining = self.deadline - time.time()
+        if remaining <= 0:
+            raise PollTimeout("Poll ran longer than %s seconds" % self.timeout)
+        return remaining
+
+    def record(self, account, outcome):
+        """Saves what the context tallied as a `PollMetric` for a poll of the
+        given account with the given outcome."""
+        return PollMetric.objects.create(service=account.service, account=account,
+            started=self.started or datetime.utcnow(), wall_time=self.wall_time,
+            processing_time=max(self.wall_time - self.http_time, 0.0),
+            http_requests=self.http_requests, http_bytes=self.http_bytes,
+            db_writes=self.db_writes, object_count=self.objects, stream_items=self.stream_items,
+            outcome=outcome)
+
+
+@contextmanager
+def waiting_for_http():
+    """Counts the time spent in the block toward the current thread's poll
+    context's time waiting for HTTP responses, as when it's waiting for
+    other threads to make its requests."""
+    context = PollContext.current()
+    start_time = time.time()
+    try:
+        yield
+    finally:
+        if context is not None:
+            context.http_time += time.time() - start_time
+
+
+def count_write(sender, instance, created, **kwargs):
+    context = PollContext.current()
+    if context is not None:
+        context.db_writes += 1
+
+def count_object(sender, instance, created, **kwargs):
+    context = PollContext.current()
+    if created and context is not None:
+        context.objects += 1
+
+def count_stream_item(sender, instance, created, **kwargs):
+    context = PollContext.current()
+    if created and context is not None:
+        context.stream_items += 1
+
+post_save.connect(count_write, dispatch_uid='leapfrog.poll.metrics.write')
+post_save.connect(count_object, sender=Object, dispatch_uid='leapfrog.poll.metrics.object')
+post_save.connect(count_stream_item, sender=UserStream, dispatch_uid='leapfrog.poll.metrics.userstream')
+post_save.connect(count_stream_item, sender=UserReplyStream, dispatch_uid='leapfrog.poll.metrics.userreplystream')
+
+
+uncounted_request = httplib2.Http.request
+unthrottled_conn_request = httplib2.Http._conn_request
+
+def network_request(self, *args, **kwargs):
+    return pooled_request(uncounted_request, self, *args, **kwargs)
+
+def throttled_conn_request(self, *args, **kwargs):
+    return throttled_request(unthrottled_conn_request, self, *args, **kwargs)
+
+def counted_request(self, *args, **kwargs):
+    """Makes an HTTP request as `httplib2.Http.request` does, counting it
+    toward the current thread's poll context, if any.
+
+    If an archive is being recorded or replayed (see
+    `leapfrog.poll.archive`), the request is recorded or replayed too.
+    Otherwise it's made on a pooled connection if there's one open to the
+    host and, if httplib2 doesn't answer it from its cache, once the host's
+    rate limit allows (see `leapfrog.poll.httpclient`).
+
+    This only happens once `install_http_hooks()` has been called.
+
+    """
+    context = PollContext.current()
+    if context is None:
+        return archived_request(network_request, self, *args, **kwargs)
+
+    # httplib2 follows redirects by calling request() again, so count each
+    # hop as a request but only the final response's bytes.
+    remaining = context.remaining()
+    if remaining is not None and (self.timeout is None or self.timeout > remaining):
+        # Don't let the request itself run past the deadline either.
+        self.timeout = remaining
+
+    context.http_requests += 1
+    if context.rate is not None:
+        context.rate.record()
+    context.request_depth += 1
+    start_time = time.time()
+    try:
+        resp, content = archived_request(network_request, self, *args, **kwargs)
+    finally:
+        context.request_depth -= 1
+        if context.request_depth == 0:
+            context.http_time += time.time() - start_time
+    if context.request_depth == 0:
+        context.http_bytes += len(content or '')
+    return resp, content
+
+
+def install_http_hooks():
+    """Makes all HTTP requests made through `httplib2` (and the clients built
+    on it, such as `oauth.Client`, `EmbedlamUserAgent` and typd) in this
+    process go through `counted_request`, and the requests httplib2 makes
+    over the network (rather than answering from its cache) through
+    `throttled_conn_request`.
+
+    `PollRunner` calls this when it's created, so the poller commands'
+    requests are counted, archived, rate limited and pooled. The web views
+    get only the pool (see `install_pool_hook()`), so none of the rest can
+    get in the way of a reader connecting an account.
+
+    """
+    if httplib2.Http.__dict__['request'] is not counted_request:
+        httplib2.Http.request = counted_request
+        httplib2.Http._conn_request = throttled_conn_request
+
+
+def install_pool_hook():
+    """Makes all HTTP requests made through `httplib2` in this process use
+    the pooled connections of `leapfrog.poll.httpclient`, without counting,
+    archiving or rate limiting them.
+
+    The URLconf calls this, so the web views reuse their connections to
+    the services when readers connect accounts. If `install_http_hooks()`
+    has already been called, the requests keep going through all its
+    hooks.
+
+    """
+    if httplib2.Http.__dict__['request'] is not counted_request:
+        httplib2.Http.request = network_request
@@ -17,7 +17,9 @@ import httplib2
 
 from leapfrog.models import Account, Person, Media, Object, UserStream, UserReplyStream
 import leapfrog.poll.embedlam
+import leapfrog.poll.resolve
 import leapfrog.poll.twitter
+from leapfrog.poll.stages import Stages, newest_saved, run_stages
 
 
 log = logging.getLogger(__name__)
@@ -56,6 +58,8 @@ def call_mlkshk(uri, method='GET', body=None, headers=None, authtoken=None, auth
     resp, cont = h.request(uri, method, body, headers)
     if resp.status == 401:
         raise leapfrog.poll.embedlam.RequestError("401 Unauthorized requesting %s (probably an expired token?)" % uri)
+    if resp.status >= 500:
+        raise leapfrog.poll.embedlam.ServerError("Server error %d %s requesting %s" % (resp.status, resp.reason, uri))
     if resp.status != 200:
         raise ValueError("Unexpected HTTP response %d %s requesting %s" % (resp.status, resp.reason, uri))
 
@@ -112,10 +116,8 @@ def object_from_url(url):
     return object_from_post(postdata, authtoken=authtoken, authsecret=authsecret)
 
 
-def replacement_text_for_url(url):
-    try:
-        url_page = leapfrog.poll.embedlam.Page(url)
-    except ValueError:
+def replacement_text_for_url(url, url_page):
+    if isinstance(url_page, ValueError):
         text = url
     else:
         url = url_page.permalink_url
@@ -124,20 +126,42 @@ def replacement_text_for_url(url):
     return r'<a class="aboutlink" href="%s">%s</a>' % (escape(url), escape(text))
 
 
-def urlized_words(text):
+def split_words(text):
+    """Returns the words of the text, each paired with whether it's a URL."""
     from django.utils.html import word_split_re, punctuation_re
     from django.utils.http import urlquote
+    words = list()
     for word in word_split_re.split(text):
         if '.' in word or ':' in word:
             match = punctuation_re.match(word)
             lead, middle, trail = match.groups()
             if any(middle.startswith(scheme) for scheme in ('http://', 'https://')):
-                yield replacement_text_for_url(urlquote(middle, safe='/&=:;#?+*'))
+                words.append((True, urlquote(middle, safe='/&=:;#?+*')))
                 continue
-        yield word
+        words.append((False, word))
+    return words
+
+
+def urlized_words(text, link_pages=None):
+    """Yields the words of the text, with the URLs made into links titled
+    for the pages they link to. The pages are taken from the `link_pages`
+    dict (as returned by `leapfrog.poll.resolve.fetch_pages()`) if they're
+    in it, and fetched otherwise."""
+    words = split_words(text)
+
+    # Fetch all the linked pages we don't have yet at once.
+    pages = dict(link_pages or {})
+    missing = [word for is_url, word in words if is_url and word not in pages]
+    if missing:
+        pages.update(leapfrog.poll.resolve.fetch_pages(missing))
+    for is_url, word in words:
+        if is_url:
+            yield replacement_text_for_url(word, pages[word])
+        else:
+            yield word
 
 
-def object_from_post(post, authtoken=None, authsecret=None):
+def object_from_post(post, authtoken=None, authsecret=None, link_pages=None):
     sharekey = post['permalink_page'].split('/')[-1]
 
     author = account_for_mlkshk_userinfo(post['user'])
@@ -158,7 +182,7 @@ def object_from_post(post, authtoken=None, authsecret=None):
     posted_at = datetime.strptime(post['posted_at'], '%Y-%m-%dT%H:%M:%SZ')
 
     body = post.get('description') or ''
-    body = u''.join(urlized_words(body))
+    body = u''.join(urlized_words(body, link_pages))
     body = re.sub(r'\r?\n', '<br>', body)
 
     if 'url' in post:
@@ -212,53 +236,127 @@ def object_from_post(post, authtoken=None, authsecret=None):
     return False, obj
 
 
-def poll_mlkshk(account):
-    user = account.person.user
-    if user is None:
-        return
+def fetch_mlkshk(account, cursor):
+    """Returns the mlkshk account's friend shake before the post with the
+    sharekey `cursor` (or the latest posts since the last poll, if `cursor`
+    is `None`)."""
+    token, secret = account.authinfo.encode('utf8').split(':', 1)
+    if cursor is None and account.poll_cursor:
+        mlkshk_url = 'https://mlkshk.com/api/friends/after/%s' % account.poll_cursor
+        try:
+            return call_mlkshk(mlkshk_url, authtoken=token, authsecret=secret)
+        except ValueError, exc:
+            # The post may have been deleted, so start from the latest.
+            log.info("Couldn't read friend shake for %s after %s, reading the latest posts instead: %s",
+                account.ident, account.poll_cursor, str(exc))
+
+    if cursor is None:
+        mlkshk_url = 'https://mlkshk.com/api/friends'
+    else:
+        mlkshk_url = 'https://mlkshk.com/api/friends/before/%s' % cursor
 
+    try:
+        return call_mlkshk(mlkshk_url, authtoken=token, authsecret=secret)
+    except leapfrog.poll.embedlam.ServerError:
+        raise
+    except leapfrog.poll.embedlam.RequestError, exc:
+        if cursor is None:
+            # We couldn't get any of the friend shake, so the poll failed.
+            raise
+        log.info("Expected failure polling friend shake for %s: %s", account.ident, str(exc))
+        return None
+
+
+def normalize_mlkshk(account, friendshake, cursor):
+    """Returns the posts in a page of a friend shake, and the sharekey to
+    read the page before it from."""
+    posts = friendshake.get('friend_shake')
+    if not posts:
+        log.debug("Premature end of friend shake for %s before %s, stopping", account.ident, cursor)
+        return [], None
+
+    return posts, sharekey_for_post(posts[-1])
+
+
+def sharekey_for_post(post):
+    return post['permalink_page'].rsplit('/', 1)[1]
+
+
+def fetch_mlkshk_details(account, posts):
+    """Fetches the pages linked from the descriptions of the new posts, all
+    at once, for `persist_mlkshk` to use."""
+    sharekeys = [sharekey_for_post(post) for post in posts]
+    seen = set(Object.objects.filter(service='mlkshk.com', foreign_id__in=sharekeys)
+        .values_list('foreign_id', flat=True))
+    urls = set()
+    for post in posts:
+        if sharekey_for_post(post) not in seen:
+            urls.update(word for is_url, word in split_words(post.get('description') or '') if is_url)
+
+    link_pages = leapfrog.poll.resolve.fetch_pages(urls)
+    for post in posts:
+        post['link_pages'] = link_pages
+
+
+def persist_mlkshk(account, posts):
+    """Saves the posts to the mlkshk account's user's stream, returning
+    whether any were already there and the posts that couldn't be saved."""
+    user = account.person.user
     token, secret = account.authinfo.encode('utf8').split(':', 1)
-    overlap = False
-    post = None
-    while not overlap:
-        if post is None:
-            mlkshk_url = 'https://mlkshk.com/api/friends'
-        else:
-            permalink_page = post['permalink_page']
-            sharekey = permalink_page.rsplit('/', 1)[1]
-            mlkshk_url = 'https://mlkshk.com/api/friends/before/%s' % sharekey
 
+    overlap = False
+    failed = list()
+    for post in posts:
         try:
-            friendshake = call_mlkshk(mlkshk_url, authtoken=token, authsecret=secret)
-        except leapfrog.poll.embedlam.RequestError, exc:
-            log.info("Expected failure polling friend shake for %s: %s", account.ident, str(exc))
-            break
-        if not friendshake.get('friend_shake'):
-            log.debug("Premature end of friend shake for %s at %s, stopping", account.ident, mlkshk_url)
-            break
-
-        for post in friendshake['friend_shake']:
-            try:
-                really_a_share, obj = object_from_post(post, authtoken=token, authsecret=secret)
-            except leapfrog.poll.embedlam.RequestError:
-                continue
-            why_account = account_for_mlkshk_userinfo(post['user']) if really_a_share else obj.author
-
-            # Save the root object as a UserStream (with the leaf object's time).
-            root = obj
-            why_verb = 'share' if really_a_share else 'post'
-            while root.in_reply_to is not None:
-                root = root.in_reply_to
-                why_verb = 'share' if really_a_share else 'reply'
-
-            streamitem, created = UserStream.objects.get_or_create(user=user, obj=root,
-                defaults={'time': obj.time, 'why_account': why_account, 'why_verb': why_verb})
-            if not created:
-                log.debug("~~ found existing post %s in stream, about to stop ~~", post['permalink_page'])
-                overlap = True
-
-            superobj = obj
-            while superobj.in_reply_to is not None:
-                UserReplyStream.objects.get_or_create(user=user, root=root, reply=superobj,
-                    defaults={'root_time': streamitem.time, 'reply_time': superobj.time})
-                superobj = superobj.in_reply_to
+            really_a_share, obj = object_from_post(post, authtoken=token, authsecret=secret,
+                link_pages=post.get('link_pages'))
+        except leapfrog.poll.embedlam.RequestError:
+            failed.append(post)
+            continue
+        why_account = account_for_mlkshk_userinfo(post['user']) if really_a_share else obj.author
+
+        # Save the root object as a UserStream (with the leaf object's time).
+        root = obj
+        why_verb = 'share' if really_a_share else 'post'
+        while root.in_reply_to is not None:
+            root = root.in_reply_to
+            why_verb = 'share' if really_a_share else 'reply'
+
+        streamitem, created = UserStream.objects.get_or_create(user=user, obj=root,
+            defaults={'time': obj.time, 'why_account': why_account, 'why_verb': why_verb})
+        if not created:
+            log.debug("~~ found existing post %s in stream, about to stop ~~", post['permalink_page'])
+            overlap = True
+
+        superobj = obj
+        while superobj.in_reply_to is not None:
+            UserReplyStream.objects.get_or_create(user=user, root=root, reply=superobj,
+                defaults={'root_time': streamitem.time, 'reply_time': superobj.time})
+            superobj = superobj.in_reply_to
+
+    return overlap, failed
+
+
+def mark_mlkshk(account, posts, failed):
+    """Returns the sharekey of the newest post saved before any that failed,
+    to ask only for the posts after it next time."""
+    # Sharekeys aren't in order, but the (UTC, ISO 8601) posting times are.
+    post = newest_saved(posts, failed, lambda post: post['posted_at'])
+    if post is None:
+        return None
+    return sharekey_for_post(post)
+
+
+stages = Stages(fetch_mlkshk, normalize_mlkshk, persist_mlkshk, default_pages=None, mark=mark_mlkshk,
+    fetch_details=fetch_mlkshk_details)
+
+
+def poll_mlkshk(account, pages=None):
+    """Adds the new posts in the mlkshk account's friend shake to its user's
+    stream.
+
+    The friend shake is read back until reaching posts already in the
+    stream, or (if `pages` is set) until that many pages have been read.
+
+    """
+    run_stages(stages, account, pages)
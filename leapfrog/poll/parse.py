@@ -0,0 +1,66 @@
+from __future__ import with_statement
+
+import logging
+import multiprocessing
+import threading
+
+from BeautifulSoup import BeautifulSoup
+
+
+log = logging.getLogger(__name__)
+
+# How long to wait for a worker process to parse something, in seconds.
+parse_timeout = 60
+
+pool = None
+pool_lock = threading.Lock()
+
+
+def start_pool(processes):
+    """Starts a pool of `processes` worker processes for `parse()` to parse
+    HTML in, so pollers on hosts with several cores can parse on all of
+    them. With no `processes`, HTML is parsed in the thread asking.
+
+    Start the pool before starting any threads, as the worker processes are
+    forked from this one.
+
+    """
+    global pool
+    with pool_lock:
+        if pool is not None or not processes:
+            return
+        log.debug("Starting %d parser processes", processes)
+        pool = multiprocessing.Pool(processes)
+
+
+def stop_pool():
+    """Stops the pool of parser processes, if there is one."""
+    global pool
+    with pool_lock:
+        if pool is None:
+            return
+        pool.terminate()
+        pool.join()
+        pool = None
+
+
+def parse(func, *args):
+    """Returns the result of calling `func` with `args`, in one of the
+    worker processes if the pool is started.
+
+    As the arguments and result are pickled to pass them between processes,
+    `func` should be a module-level function taking and returning plain
+    strings, dicts and lists, not parse trees.
+
+    """
+    if pool is None:
+        return func(*args)
+    return pool.apply_async(func, args).get(parse_timeout)
+
+
+def strip_scripts(body):
+    """Returns the HTML fragment `body` without any script elements."""
+    soup = BeautifulSoup(body)
+    for script_node in soup.findAll('script'):
+        script_node.extract()
+    return str(soup).decode('utf8').strip()
@@ -0,0 +1,170 @@
+from __future__ import with_statement
+
+import logging
+import sys
+import threading
+import time
+from urlparse import urlparse
+
+from django.conf import settings
+from django.db import connection
+
+import leapfrog.poll.embedlam
+from leapfrog.poll.httpclient import Throttled
+from leapfrog.poll.metrics import PollContext, waiting_for_http
+
+
+log = logging.getLogger(__name__)
+
+# How many pages to fetch at once, and how many of them from any one host.
+default_resolve_threads = 8
+default_resolve_per_host = 4
+# How long (in seconds) to wait for all the pages before giving up on the
+# ones still being fetched.
+default_resolve_timeout = 30
+
+
+class Resolver(object):
+
+    """Fetches a set of URLs' pages in several threads at once.
+
+    Each thread takes the next URL whose host isn't already being asked
+    for `per_host` pages, so a slow or rate limited host doesn't hold up
+    the others.
+
+    """
+
+    def __init__(self, urls, threads, per_host):
+        self.pending = list(urls)
+        self.total = len(self.pending)
+        self.threads = threads
+        self.per_host = per_host
+        self.active = dict()
+        self.results = dict()
+        self.stopping = False
+        self.cond = threading.Condition()
+
+    def next_url(self):
+        """Returns the next URL to fetch, waiting for one whose host has
+        room for another request, or `None` if there are none left."""
+        with self.cond:
+            while not self.stopping and self.pending:
+                for i, url in enumerate(self.pending):
+                    host = urlparse(url).hostname
+                    if self.active.get(host, 0) < self.per_host:
+                        del self.pending[i]
+                        self.active[host] = self.active.get(host, 0) + 1
+                        return url
+                self.cond.wait(0.5)
+            return None
+
+    def work(self, context):
+        try:
+            with context:
+                while True:
+                    url = self.next_url()
+                    if url is None:
+                        return
+                    try:
+                        result = leapfrog.poll.embedlam.Page(url)
+                    except BaseException:
+                        result = sys.exc_info()
+                    with self.cond:
+                        host = urlparse(url).hostname
+                        self.active[host] -= 1
+                        self.results[url] = result
+                        self.cond.notify_all()
+        finally:
+            # Each thread has its own database connection, so close it.
+            connection.close()
+
+    def run(self, timeout):
+        """Fetches the pages, giving up on any not fetched within `timeout`
+        seconds."""
+        outer = PollContext.current()
+        contexts = [outer.fork() if outer is not None else PollContext() for i in range(self.threads)]
+        workers = [threading.Thread(target=self.work, args=(context,), name='resolve')
+            for context in contexts]
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+
+        deadline = time.time() + timeout
+        with waiting_for_http():
+            with self.cond:
+                while len(self.results) < self.total and time.time() < deadline:
+                    self.cond.wait(deadline - time.time())
+                self.stopping = True
+                self.cond.notify_all()
+                results = dict(self.results)
+
+        if outer is not None:
+            for worker, context in zip(workers, contexts):
+                # Requests still going keep their connections, but don't wait
+                # long for them.
+                worker.join(0.1)
+                if not worker.isAlive():
+                    outer.join(context)
+        return results
+
+
+def fetch_pages(urls, timeout=None):
+    """Returns a dict of the `leapfrog.poll.embedlam.Page` for each of the
+    URLs, fetched concurrently, blocking until they're all fetched.
+
+    A URL whose page couldn't be fetched is mapped to the `ValueError` (such
+    as a `RequestError`) that fetching it raised instead. So is a URL whose
+    host is rate limited, or whose page was still being fetched after
+    `timeout` seconds (the ``POLL_RESOLVE_TIMEOUT`` setting, by default, or
+    the rest of the current poll, if that's shorter). Any other exception
+    is raised once the others are fetched, as if the pages had been fetched
+    one at a time.
+
+    Turning the pages into objects with `Page.to_object()` saves them, so
+    do that in the calling thread. The time spent waiting for the pages
+    counts toward the current poll's time waiting for HTTP responses.
+
+    """
+    urls = list(set(urls))
+    if timeout is None:
+        timeout = getattr(settings, 'POLL_RESOLVE_TIMEOUT', default_resolve_timeout)
+    context = PollContext.current()
+    if context is not None:
+        remaining = context.remaining()
+        if remaining is not None:
+            timeout = min(timeout, remaining)
+
+    if len(urls) <= 1:
+        # There's nothing to fetch alongside it, so don't bother with threads.
+        results = dict()
+        for url in urls:
+            try:
+                results[url] = leapfrog.poll.embedlam.Page(url)
+            except ValueError, exc:
+                results[url] = exc
+            except Throttled, exc:
+                results[url] = leapfrog.poll.embedlam.RequestError("Couldn't fetch %s: %s" % (url, str(exc)))
+        return results
+
+    threads = min(len(urls), getattr(settings, 'POLL_RESOLVE_THREADS', default_resolve_threads))
+    per_host = getattr(settings, 'POLL_RESOLVE_PER_HOST', default_resolve_per_host)
+    results = Resolver(urls, threads, per_host).run(timeout)
+
+    pages = dict()
+    for url in urls:
+        try:
+            result = results[url]
+        except KeyError:
+            log.debug("Gave up resolving %s after %.1f seconds", url, timeout)
+            pages[url] = leapfrog.poll.embedlam.RequestError("Timed out resolving %s" % url)
+            continue
+        if isinstance(result, tuple):
+            exc_type, exc_value, exc_tb = result
+            if isinstance(exc_value, Throttled):
+                # Only this link is rate limited, not the whole poll.
+                exc_value = leapfrog.poll.embedlam.RequestError("Couldn't fetch %s: %s" % (url, str(exc_value)))
+            elif not isinstance(exc_value, ValueError):
+                raise exc_type, exc_value, exc_tb
+            result = exc_value
+        pages[url] = result
+    return pages
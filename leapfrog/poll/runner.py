@@ -0,0 +1,1039 @@
+from __future__ import with_statement
+
+from collections import deque
+from datetime import datetime, timedelta
+import gc
+import httplib
+import errno
+import logging
+import math
+import os
+import resource
+import socket
+import sys
+import threading
+import zlib
+
+from django.conf import settings
+from django.db import connection, reset_queries
+from django.db.models import Q
+from sentry.client.base import SentryClient
+
+from leapfrog.models import Account, PollRequest, PollRun
+from leapfrog.poll.embedlam import RequestError, ServerError
+from leapfrog.poll.httpclient import Throttled, get_cache, get_limiter, get_pool
+from leapfrog.poll.metrics import PollContext, PollTimeout, RequestRate, install_http_hooks
+from leapfrog.poll.parse import start_pool, stop_pool
+from leapfrog.poll import facebook
+from leapfrog.poll import flickr
+from leapfrog.poll import mlkshk
+from leapfrog.poll import tumblr
+from leapfrog.poll import twitter
+from leapfrog.poll import typepad
+from leapfrog.poll import vimeo
+
+
+log = logging.getLogger(__name__)
+
+
+pollers = {
+    'facebook.com': facebook.poll_facebook,
+    'flickr.com': flickr.poll_flickr,
+    'mlkshk.com': mlkshk.poll_mlkshk,
+    'tumblr.com': tumblr.poll_tumblr,
+    'twitter.com': twitter.poll_twitter,
+    'typepad.com': typepad.poll_typepad,
+    'vimeo.com': vimeo.poll_vimeo,
+}
+
+# The shortest and longest times to wait between polls of an account, by
+# service. The POLL_INTERVALS setting can override these (in minutes).
+default_poll_intervals = {
+    'twitter.com': (timedelta(minutes=2), timedelta(hours=1)),
+    'tumblr.com': (timedelta(minutes=5), timedelta(hours=2)),
+    'facebook.com': (timedelta(minutes=5), timedelta(hours=2)),
+}
+default_poll_interval = (timedelta(minutes=10), timedelta(hours=6))
+# How many new stream items we'd like to find each time we poll an account.
+default_target_yield = 10
+# How much weight each poll's yield gets in an account's average yield.
+yield_weight = 0.3
+# How long to wait before trying an account again after a poll fails. This
+# doubles with each failure in a row, up to the longest back-off.
+failure_interval = timedelta(minutes=15)
+default_max_backoff = timedelta(days=1)
+# How many seconds a poll of one account may take before it's abandoned.
+default_poll_timeout = 120
+# How far before or after the chosen interval an account may be polled, as a
+# fraction of the interval, so accounts' polls are spread out over time.
+default_poll_jitter = 0.5
+# How long a poller may hold its claim on an account before other pollers
+# may assume it crashed and take the account over.
+default_lease_time = timedelta(minutes=10)
+# How often a poll run records that it's still alive, so runs on other hosts
+# can tell it hasn't died. This must be well under the lease time.
+heartbeat_interval = timedelta(minutes=1)
+# Don't poll the accounts of readers who haven't viewed their home page in this long.
+viewed_horizon = timedelta(days=5)
+# Errors that mean a service itself is down or failing, rather than that
+# something is wrong with the one account.
+service_errors = (ServerError, socket.error, httplib.HTTPException)
+# How many service errors in a row trip a service's circuit breaker, and how
+# long to leave it tripped before trying the service again.
+default_breaker_threshold = 5
+default_breaker_cooldown = timedelta(minutes=5)
+# When a reader views their home page, ask for their accounts that haven't
+# been polled in this long to be polled right away.
+default_stale_time = timedelta(minutes=10)
+# How many pages back to read when catching up a reader returning after
+# they were gone long enough that we stopped polling their accounts.
+default_catchup_pages = 5
+# How many pages of history to read for a newly connected account.
+default_backfill_pages = 5
+
+
+def pollable_accounts(now=None):
+    """Returns a queryset of the accounts we can poll: those on services
+    we have pollers for that belong to readers who have viewed their home
+    page recently."""
+    if now is None:
+        now = datetime.utcnow()
+    return Account.objects.filter(service__in=pollers.keys(),
+        person__user__isnull=False, person__last_viewed_home__gte=now - viewed_horizon)
+
+
+def due_accounts(now, service=None, shard=None, force=False):
+    """Returns a queryset of the pollable accounts that are due to be polled
+    as of `now`, stalest first.
+
+    All the selection happens in the one query (using the indexes on the
+    accounts' poll times and the readers' last home page views), and the
+    accounts' people and users come along with them, so pollers don't need
+    to look those up again.
+
+    """
+    accounts = pollable_accounts(now).exclude(authinfo='')
+    if not force:
+        accounts = accounts.filter(next_poll__lte=now)
+    if service:
+        accounts = accounts.filter(service=service)
+    accounts = in_shard(accounts, shard)
+    return accounts.select_related('person', 'person__user').order_by('last_updated')
+
+
+def by_priority(accounts):
+    """Orders the queryset of accounts so the accounts of the readers who
+    viewed their home pages most recently come first, and of each reader's
+    accounts, the stalest come first."""
+    return accounts.order_by('-person__last_viewed_home', 'last_updated')
+
+
+def parse_shard(value):
+    """Parses a shard specification like ``2/5`` (the third of five shards,
+    counting from 0) into an ``(index, count)`` tuple."""
+    try:
+        index, count = [int(x) for x in value.split('/', 1)]
+    except ValueError:
+        raise ValueError("Shard %r is not of the form INDEX/COUNT" % value)
+    if count < 1 or not 0 <= index < count:
+        raise ValueError("Shard %r is not one of its COUNT shards" % value)
+    return index, count
+
+
+def in_shard(accounts, shard, column='leapfrog_account.id'):
+    """Limits the queryset of accounts to those in the given ``(index,
+    count)`` shard, if any.
+
+    Querysets of other models can be sharded by their accounts too, by
+    naming the `column` holding their account IDs.
+
+    """
+    if shard is None:
+        return accounts
+    index, count = shard
+    return accounts.extra(where=['%s %%%% %%s = %%s' % column], params=[count, index])
+
+
+def request_polls(person, now=None):
+    """Asks for the person's accounts that haven't been polled lately to be
+    polled as soon as possible, returning how many were asked for.
+
+    This only records the requests in the poll request queue, so it's quick
+    enough to do while showing the reader their home page. A ``runpoller``
+    (or the next ``fetchnewcontent``) polls the accounts ahead of the ones
+    that are just due.
+
+    Accounts whose polls have been failing are left to wait out their
+    back-off (see `back_off()`), as urgent polls are made even if the
+    account isn't due.
+
+    """
+    if now is None:
+        now = datetime.utcnow()
+    try:
+        stale_time = timedelta(minutes=settings.POLL_STALE_MINUTES)
+    except AttributeError:
+        stale_time = default_stale_time
+
+    accounts = person.accounts.filter(service__in=pollers.keys(), last_updated__lt=now - stale_time)
+    accounts = accounts.exclude(authinfo='').filter(poll_requests__isnull=True)
+    accounts = accounts.exclude(failure_count__gt=0, next_poll__gt=now)
+    count = 0
+    for account in accounts:
+        PollRequest.objects.create(account=account, requested=now)
+        count += 1
+    return count
+
+
+def request_catchup(person, now=None):
+    """Asks for all the person's accounts to be polled as soon as possible,
+    paging back through as many as the ``POLL_CATCHUP_PAGES`` setting
+    pages (until reaching items already in their stream), returning how
+    many were asked for.
+
+    This is for readers returning after we stopped polling their accounts
+    (see `viewed_horizon`), for whom the latest page of each account isn't
+    enough to fill in what they missed.
+
+    """
+    if now is None:
+        now = datetime.utcnow()
+    pages = getattr(settings, 'POLL_CATCHUP_PAGES', default_catchup_pages)
+
+    accounts = person.accounts.filter(service__in=pollers.keys()).exclude(authinfo='')
+    count = 0
+    for account in accounts:
+        requests = PollRequest.objects.filter(account=account, started__isnull=True)
+        if not requests.update(pages=pages, kind='catchup'):
+            PollRequest.objects.create(account=account, requested=now, pages=pages, kind='catchup')
+        count += 1
+    return count
+
+
+def request_backfill(account, now=None):
+    """Asks for the newly connected account to be polled as soon as
+    possible, paging back through as many as the ``POLL_BACKFILL_PAGES``
+    setting pages of its history.
+
+    Like `request_polls`, this only records the request, so the views that
+    finish connecting accounts can ask for it without waiting on the
+    service. Until a poller finishes the backfill, `backfill_progress`
+    reports it to the reader's home page.
+
+    """
+    if account.service not in pollers:
+        return None
+    if now is None:
+        now = datetime.utcnow()
+    pages = getattr(settings, 'POLL_BACKFILL_PAGES', default_backfill_pages)
+    return PollRequest.objects.create(account=account, requested=now, pages=pages, kind='backfill')
+
+
+def backfill_progress(person):
+    """Returns the person's accounts that are still being backfilled or
+    caught up, as a list of dicts with their `service`, `display_name` and
+    `state` ('queued' or 'polling'), for showing the reader how their
+    stream is coming along."""
+    requests = PollRequest.objects.filter(account__person=person, kind__in=('backfill', 'catchup'))
+    requests = requests.select_related('account').order_by('requested')
+    progress = list()
+    seen = set()
+    for request in requests:
+        if request.account_id in seen:
+            continue
+        seen.add(request.account_id)
+        progress.append({
+            'service': request.account.service,
+            'display_name': request.account.display_name,
+            'state': 'queued' if request.started is None else 'polling',
+        })
+    return progress
+
+
+def take_poll_requests(service=None, shard=None, limit=None, now=None):
+    """Takes the oldest outstanding poll requests from the queue, returning
+    them (with their accounts).
+
+    Taken requests stay in the queue, marked as started, until
+    `finish_poll_requests` removes them when their polls are done. Requests
+    taken longer than the lease time ago are outstanding again, in case the
+    poller that took them died.
+
+    """
+    if now is None:
+        now = datetime.utcnow()
+    requests = PollRequest.objects.filter(Q(started__isnull=True) | Q(started__lt=now - lease_time()))
+    if service:
+        requests = requests.filter(account__service=service)
+    requests = in_shard(requests, shard, column='leapfrog_pollrequest.account_id')
+    requests = requests.select_related('account', 'account__person', 'account__person__user').order_by('requested')
+    if limit is not None:
+        requests = requests[:limit]
+    requests = list(requests)
+    if not requests:
+        return []
+
+    PollRequest.objects.filter(pk__in=[request.pk for request in requests]).update(started=now)
+    return requests
+
+
+def finish_poll_requests(account):
+    """Removes the account's taken poll requests from the queue, once it
+    has been polled for them."""
+    PollRequest.objects.filter(account=account, started__isnull=False).delete()
+
+
+def release_poll_requests(account_ids):
+    """Puts the taken poll requests for the given accounts back in the
+    queue, for when they were dropped without being polled."""
+    if account_ids:
+        PollRequest.objects.filter(account__in=account_ids, started__isnull=False).update(started=None)
+
+
+def lease_owner():
+    """Returns the name this process claims accounts with."""
+    return '%s:%d' % (socket.gethostname(), os.getpid())
+
+
+def lease_time():
+    try:
+        return timedelta(seconds=settings.POLL_LEASE_SECONDS)
+    except AttributeError:
+        return default_lease_time
+
+
+def poll_timeout(pages=None):
+    """Returns how many seconds a poll reading `pages` pages (or the usual
+    amount) may take before it's abandoned."""
+    return getattr(settings, 'POLL_TIMEOUT', default_poll_timeout) * (pages or 1)
+
+
+def run_is_alive(run, now):
+    """Returns whether the process doing the given `PollRun` seems to still
+    be running.
+
+    Runs on this host are alive if their processes are. We can't see the
+    processes of runs on other hosts, so those are alive as long as they
+    keep checking in.
+
+    """
+    host, pid = run.owner.rsplit(':', 1)
+    if host != socket.gethostname():
+        return run.last_seen > now - lease_time()
+    try:
+        os.kill(int(pid), 0)
+    except OSError, exc:
+        return exc.errno != errno.ESRCH
+    return True
+
+
+def resume_dead_runs(now=None):
+    """Marks the unfinished runs whose processes died as such, and makes
+    the accounts they were partway through polling due right away,
+    returning how many there were.
+
+    Accounts are marked as updated when they're claimed, so otherwise the
+    accounts a dead run never finished would wait out a failed poll's
+    interval before being polled again.
+
+    """
+    if now is None:
+        now = datetime.utcnow()
+    dead = [run.pk for run in PollRun.objects.filter(finished__isnull=True) if not run_is_alive(run, now)]
+    if dead:
+        log.warning("Resuming the unfinished accounts of %d poll runs that died", len(dead))
+        PollRun.objects.filter(pk__in=dead).update(finished=now, status='died')
+
+    # Accounts whose leases expired are as good as dead too.
+    unfinished = Account.objects.filter(poll_state__in=('claimed', 'polling'))
+    unfinished = unfinished.filter(Q(poll_run__in=dead) | Q(lease_expires__lte=now))
+    return unfinished.update(next_poll=now, lease_owner='', lease_expires=None, poll_state='')
+
+
+def claim_account(account, owner, now, force=False, run=None, pages=None):
+    """Claims the account for polling by the named owner (as part of the
+    given `PollRun`, if any), returning whether the claim succeeded.
+
+    The claim is a single conditional update, so of several pollers racing
+    to claim the same account (on the same host or not), only one wins. An
+    account can't be claimed while another owner's lease is unexpired, nor
+    (unless `force` is set) if it's not due to be polled yet.
+
+    The lease isn't renewed while polling, so it lasts the lease time on
+    top of how long a poll of `pages` pages may take, so a long catch-up
+    poll isn't taken over while it's still going.
+
+    """
+    claimable = Account.objects.filter(pk=account.pk)
+    claimable = claimable.filter(Q(lease_expires__isnull=True) | Q(lease_expires__lte=now))
+    if not force:
+        claimable = claimable.filter(next_poll__lte=now)
+
+    # Mark the account as updated even if the update fails later.
+    claim = {
+        'last_updated': now,
+        'next_poll': spread_poll_time(account, now, failure_interval),
+        'lease_owner': owner,
+        'lease_expires': now + lease_time() + timedelta(seconds=poll_timeout(pages)),
+        'poll_state': 'claimed',
+        'poll_run': run,
+    }
+    if claimable.update(**claim) != 1:
+        return False
+    for field, value in claim.iteritems():
+        setattr(account, field, value)
+    return True
+
+
+def total_seconds(delta):
+    return delta.days * 86400 + delta.seconds + delta.microseconds / 1e6
+
+
+def poll_interval_bounds(service):
+    """Returns the shortest and longest times to wait between polls of
+    accounts on the given service, as `timedelta` instances."""
+    try:
+        min_minutes, max_minutes = settings.POLL_INTERVALS[service]
+    except (AttributeError, KeyError):
+        return default_poll_intervals.get(service, default_poll_interval)
+    return timedelta(minutes=min_minutes), timedelta(minutes=max_minutes)
+
+
+def poll_phase(account):
+    """Returns the account's place in any interval between its polls, as a
+    fraction from 0 to 1 that stays the same from poll to poll."""
+    return (zlib.crc32('%s:%s' % (account.service, account.ident)) & 0xffffffff) / 4294967296.0
+
+
+def spread_poll_time(account, now, interval):
+    """Returns the time to poll the account next, about `interval` from now.
+
+    Rather than exactly `interval` from now, the account's next poll is at
+    its phase of the interval (counting intervals from the epoch), so even
+    accounts that are all polled at once, such as after an outage, go on to
+    be polled at times evenly spread across their interval instead of in
+    bursts. The ``POLL_JITTER`` setting is the soonest (as a fraction of the
+    interval before it) the next poll may be.
+
+    """
+    jitter = getattr(settings, 'POLL_JITTER', default_poll_jitter)
+    seconds = total_seconds(interval)
+    if jitter <= 0 or seconds <= 0:
+        return now + interval
+
+    epoch = datetime(1970, 1, 1)
+    earliest = total_seconds(now - epoch) + seconds * (1 - min(jitter, 1))
+    offset = poll_phase(account) * seconds
+    periods = math.ceil((earliest - offset) / seconds)
+    return epoch + timedelta(seconds=periods * seconds + offset)
+
+
+def schedule_next_poll(account, new_items, previous_poll, now, update_yield=True):
+    """Updates the account's average yield with the number of new stream
+    items its latest poll found, and sets its `next_poll` time accordingly.
+    (If `update_yield` is false, such as when the poll read further back
+    than usual, the next poll is scheduled by the yield as it was.)
+
+    Busy accounts are polled as often as their service's shortest interval
+    allows, and quiet ones back off toward the longest interval. The poll
+    itself is spread around that time with `spread_poll_time()`.
+
+    """
+    min_interval, max_interval = poll_interval_bounds(account.service)
+
+    # Don't count time since before the longest interval (such as for an
+    # account we've never polled) as a quiet time.
+    elapsed = min(now - previous_poll, max_interval)
+    hours = max(total_seconds(elapsed) / 3600, 1 / 60.0)
+    items_per_hour = new_items / hours
+
+    if update_yield and account.poll_yield is None:
+        account.poll_yield = items_per_hour
+    elif update_yield:
+        account.poll_yield = yield_weight * items_per_hour + (1 - yield_weight) * account.poll_yield
+
+    if account.poll_yield:
+        target_yield = getattr(settings, 'POLL_TARGET_YIELD', default_target_yield)
+        interval = timedelta(hours=target_yield / account.poll_yield)
+        interval = max(min_interval, min(max_interval, interval))
+    else:
+        interval = max_interval
+
+    account.next_poll = spread_poll_time(account, now, interval)
+
+
+def back_off(account, exc, now):
+    """Records that polling the account failed with the given exception,
+    and puts off its next poll accordingly.
+
+    Each failure in a row doubles the time until the account's next poll
+    (up to the ``POLL_MAX_BACKOFF_HOURS`` setting), so accounts that fail
+    every time, such as those whose tokens have been revoked, don't use up
+    our time and API quota on every run.
+
+    """
+    try:
+        max_backoff = timedelta(hours=settings.POLL_MAX_BACKOFF_HOURS)
+    except AttributeError:
+        max_backoff = default_max_backoff
+
+    try:
+        message = unicode(exc)
+    except UnicodeError:
+        message = repr(exc)
+    account.failure_count += 1
+    account.failure_reason = (u'%s: %s' % (exc.__class__.__name__, message))[:255]
+
+    backoff = min(failure_interval * 2 ** min(account.failure_count - 1, 16), max_backoff)
+    account.next_poll = spread_poll_time(account, now, backoff)
+    Account.objects.filter(pk=account.pk).update(failure_count=account.failure_count,
+        failure_reason=account.failure_reason, next_poll=account.next_poll)
+
+
+def poll_account(account, owner=None, force=False, rate=None, run=None, pages=None):
+    """Claims and polls the given account with its service's poller.
+
+    Returns the outcome of the poll: ``'ok'`` if it succeeded,
+    ``'server-error'`` if it failed because the service is down or
+    failing, ``'failed'`` if it failed with an expected `RequestError`
+    (such as for a revoked token), ``'error'`` if it failed some other way,
+    ``'throttled'`` if the service's rate limit won't let us make its
+    requests for a while, or ``'skipped'`` if some other poller has the
+    account claimed (or, unless `force` is set, it isn't due). Accounts
+    that fail for reasons other than their service failing are backed off
+    with `back_off()`, and throttled accounts are put off until the rate
+    limit allows.
+
+    A poll that runs longer than the ``POLL_TIMEOUT`` setting (in seconds)
+    is abandoned at its next HTTP request, keeping the stream items it
+    already saved, with the outcome ``'timeout'``.
+
+    If `pages` is given, the poller pages back through up to that many
+    pages of the account's feed, rather than reading its usual amount
+    (with a timeout that many times as long).
+
+    Each poll that happens is recorded as a `PollMetric`, and its HTTP
+    requests in the `RequestRate` given as `rate`, if any.
+
+    The account's bookkeeping fields are written with targeted updates
+    rather than whole-row saves, so polls running in other threads (or a
+    poller that changes the account's `authinfo`) don't have their changes
+    clobbered.
+
+    """
+    log = logging.getLogger('%s.%s' % (__name__, account.service))
+    poller = pollers[account.service]
+    if owner is None:
+        owner = lease_owner()
+
+    previous_poll = account.last_updated
+    if not claim_account(account, owner, datetime.utcnow(), force, run, pages):
+        log.debug("Account %s %s is claimed by another poller or not due, skipping", account.service, account.display_name)
+        return 'skipped'
+    account.poll_state = 'polling'
+    Account.objects.filter(pk=account.pk).update(poll_state=account.poll_state)
+
+    log.debug("Polling account %s %s", account.service, account.display_name)
+    context = PollContext(rate, poll_timeout(pages))
+    outcome = 'ok'
+    try:
+        with context:
+            poller(account, pages)
+    except PollTimeout, exc:
+        log.warning("Abandoned polling %s %s: %s", account.service, account.display_name, str(exc))
+        outcome = 'timeout'
+    except Throttled, exc:
+        log.info("Throttled polling %s %s: %s", account.service, account.display_name, str(exc))
+        account.next_poll = datetime.utcnow() + timedelta(seconds=exc.retry_after)
+        Account.objects.filter(pk=account.pk).update(next_poll=account.next_poll)
+        context.record(account, 'throttled')
+        release_account(account, owner)
+        return 'throttled'
+    except service_errors, exc:
+        # There's nothing to fix on our end, so don't bother Sentry about it.
+        log.info("Service error polling %s %s: %s", account.service, account.display_name, str(exc))
+        context.record(account, 'server-error')
+        release_account(account, owner)
+        return 'server-error'
+    except RequestError, exc:
+        log.info("Expected error polling %s %s: %s", account.service, account.display_name, str(exc))
+        back_off(account, exc, datetime.utcnow())
+        context.record(account, 'failed')
+        release_account(account, owner)
+        return 'failed'
+    except Exception, exc:
+        log.exception(exc)
+        SentryClient().create_from_exception(view='%s.%s' % (__name__, account.service))
+        back_off(account, exc, datetime.utcnow())
+        context.record(account, 'error')
+        release_account(account, owner)
+        return 'error'
+
+    now = datetime.utcnow()
+    schedule_next_poll(account, context.stream_items, previous_poll, now, update_yield=pages is None)
+    log.debug("Found %d new stream items for %s %s; next polling at %s", context.stream_items,
+        account.service, account.display_name, account.next_poll)
+
+    if outcome == 'timeout':
+        # Keep what we found, but don't count it as a success.
+        Account.objects.filter(pk=account.pk).update(next_poll=account.next_poll, poll_yield=account.poll_yield)
+        context.record(account, outcome)
+        release_account(account, owner)
+        return outcome
+
+    account.last_success = now
+    account.failure_count = 0
+    account.failure_reason = ''
+    Account.objects.filter(pk=account.pk).update(last_success=account.last_success,
+        next_poll=account.next_poll, poll_yield=account.poll_yield,
+        failure_count=0, failure_reason='')
+    context.record(account, 'ok')
+    release_account(account, owner)
+    return 'ok'
+
+
+def release_account(account, owner):
+    """Gives up the owner's claim on the account, if it still has one,
+    marking its poll done."""
+    account.lease_owner = ''
+    account.lease_expires = None
+    account.poll_state = 'done'
+    Account.objects.filter(pk=account.pk, lease_owner=owner).update(lease_owner='', lease_expires=None,
+        poll_state='done')
+
+
+def memory_used():
+    """Returns how many megabytes of memory this process is using."""
+    try:
+        statm = open('/proc/self/statm')
+        try:
+            pages = int(statm.read().split()[1])
+        finally:
+            statm.close()
+    except (IOError, IndexError, ValueError):
+        # Without /proc, the most we've ever used will have to do.
+        return peak_memory_used()
+    return pages * resource.getpagesize() / 1048576.0
+
+
+def peak_memory_used():
+    """Returns the most megabytes of memory this process has used."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def restart_process(argv=None):
+    """Replaces this process with a fresh one running the same command (or
+    the one given as `argv`), to leave all the memory it used behind."""
+    if argv is None:
+        argv = sys.argv
+    log.info("Restarting as %s", ' '.join(argv))
+    connection.close()
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os.execv(sys.executable, [sys.executable] + list(argv))
+
+
+class CircuitBreaker(object):
+
+    """Keeps track of whether a service is failing, so we can stop polling
+    its accounts for a while when it is.
+
+    The breaker starts out closed, letting all polls through. After
+    `threshold` service errors in a row it trips open, and turns polls away
+    until `cooldown` has passed. Then it's half open: it lets one poll
+    through to probe the service, closing again if that poll gets through
+    to the service or opening for another cooldown if it doesn't.
+
+    """
+
+    def __init__(self, service, threshold, cooldown):
+        self.service = service
+        self.threshold = threshold
+        self.cooldown = cooldown
+
+        self.state = 'closed'
+        self.failures = 0
+        self.trips = 0
+        self.retry_at = None
+        self.lock = threading.Lock()
+
+    def __str__(self):
+        if self.state == 'open':
+            return '%s: open until %s (tripped %d times)' % (self.service, self.retry_at, self.trips)
+        return '%s: %s (tripped %d times)' % (self.service, self.state, self.trips)
+
+    def is_open(self, now=None):
+        """Returns whether the breaker would turn away a poll right now."""
+        if now is None:
+            now = datetime.utcnow()
+        with self.lock:
+            return self.state == 'half-open' or (self.state == 'open' and now < self.retry_at)
+
+    def allow(self, now=None):
+        """Returns whether to go ahead with a poll of one of the service's
+        accounts. If this is the probe of a half open breaker, the caller
+        must report how the poll went."""
+        if now is None:
+            now = datetime.utcnow()
+        with self.lock:
+            if self.state == 'closed':
+                return True
+            if self.state == 'open' and now >= self.retry_at:
+                self.state = 'half-open'
+                log.warning("Probing %s to see if it has recovered", self.service)
+                return True
+            return False
+
+    def succeeded(self):
+        """Records that a poll got through to the service."""
+        with self.lock:
+            if self.state != 'closed':
+                log.warning("Closing circuit breaker for %s; it seems to have recovered", self.service)
+            self.state = 'closed'
+            self.failures = 0
+
+    def failed(self, now=None):
+        """Records that a poll failed because the service is failing."""
+        if now is None:
+            now = datetime.utcnow()
+        with self.lock:
+            self.failures += 1
+            if self.state == 'half-open' or (self.state == 'closed' and self.failures >= self.threshold):
+                self.state = 'open'
+                self.trips += 1
+                self.retry_at = now + self.cooldown
+                log.warning("Tripped circuit breaker for %s after %d service errors in a row; not polling it until %s",
+                    self.service, self.failures, self.retry_at)
+
+    def abandoned(self):
+        """Records that a poll the breaker allowed didn't happen after all,
+        so if it was the probe, another poll can probe instead."""
+        with self.lock:
+            if self.state == 'half-open':
+                self.state = 'open'
+
+
+class PollRunner(object):
+
+    """Polls accounts, several at once if asked.
+
+    Accounts are claimed before polling so other runners (in this process
+    or others) don't poll them at the same time. With one worker, accounts
+    are polled in the calling thread as they're submitted. With more,
+    they're polled by a pool of worker threads, with no more than
+    ``service_limits[service]`` polls of any one service in flight at a
+    time (by default, the ``POLL_SERVICE_CONCURRENCY`` setting).
+
+    Each service has a `CircuitBreaker`, so when a service is down, the
+    runner stops trying its accounts after the first few fail (per the
+    ``POLL_BREAKER_THRESHOLD`` and ``POLL_BREAKER_COOLDOWN`` settings).
+    If a `deadline` is given, the runner stops starting polls once it has
+    passed; accounts still waiting are dropped (and tallied as
+    ``'out-of-time'``), but polls already in progress are left to finish.
+    Accounts submitted as `urgent` (such as those readers asked for by
+    viewing their home pages) are polled ahead of the others, even if
+    they're not due, reading back through `pages` pages if given. The
+    outcomes of the runner's polls are tallied in `outcomes`.
+
+    With `parse_processes` (by default, the ``POLL_PARSE_PROCESSES``
+    setting), HTML is parsed in a pool of that many worker processes, so
+    polls can use more than one core. The pool is stopped by `finish()`.
+
+    Creating a runner installs the HTTP hooks (see
+    `leapfrog.poll.metrics.install_http_hooks()`) that count, time out,
+    archive, rate limit and pool the polls' requests.
+
+    To keep its process from growing without bound, the runner clears out
+    what it can between polls. Once it has polled `max_accounts` accounts
+    or the process is using more than `max_rss` megabytes, it sets
+    `recycling` and stops starting polls as if at its deadline, so the
+    caller can hand the rest of the work to a fresh process with
+    `restart_process()`.
+
+    The runner records itself as a `PollRun` named for its `command`, so
+    if its process dies, later runs can resume the accounts it was polling
+    with `resume_dead_runs()`. Until it's finished, a thread calls
+    `heartbeat()` every minute, even while a long poll is going, so runners
+    on other hosts can tell it's alive.
+
+    """
+
+    def __init__(self, workers=1, service_limits=None, force=False, deadline=None,
+                 max_accounts=None, max_rss=None, command='poll', parse_processes=None):
+        # Fork the parser processes before starting any threads.
+        if parse_processes is None:
+            parse_processes = getattr(settings, 'POLL_PARSE_PROCESSES', 0)
+        start_pool(parse_processes)
+        install_http_hooks()
+
+        self.workers = workers
+        self.force = force
+        self.deadline = deadline
+        self.max_accounts = max_accounts
+        self.max_rss = max_rss
+        self.polled = 0
+        self.recycling = False
+        self.owner = lease_owner()
+        now = datetime.utcnow()
+        self.run = PollRun.objects.create(owner=self.owner, command=command, started=now, last_seen=now)
+        if service_limits is None:
+            service_limits = getattr(settings, 'POLL_SERVICE_CONCURRENCY', {})
+        self.service_limits = dict(service_limits)
+
+        self.breaker_threshold = getattr(settings, 'POLL_BREAKER_THRESHOLD', default_breaker_threshold)
+        try:
+            self.breaker_cooldown = timedelta(seconds=settings.POLL_BREAKER_COOLDOWN)
+        except AttributeError:
+            self.breaker_cooldown = default_breaker_cooldown
+        self.breakers = dict()
+        self.outcomes = dict()
+        self.request_rate = RequestRate()
+
+        self.pending = dict()
+        self.in_flight = dict()
+        self.active = set()
+        self.urgent = dict()
+        self.closed = False
+        self.cond = threading.Condition()
+
+        # Check in from a thread of its own, as one poll can outlast the lease time.
+        self.stopping = threading.Event()
+        self.heart = threading.Thread(target=self.beat, name='heartbeat')
+        self.heart.daemon = True
+        self.heart.start()
+
+        self.threads = list()
+        if self.workers > 1:
+            for i in range(self.workers):
+                thread = threading.Thread(target=self.work, name='poller-%d' % i)
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+
+    def limit_for(self, service):
+        return self.service_limits.get(service, self.workers)
+
+    def breaker_for(self, service):
+        with self.cond:
+            try:
+                return self.breakers[service]
+            except KeyError:
+                breaker = CircuitBreaker(service, self.breaker_threshold, self.breaker_cooldown)
+                self.breakers[service] = breaker
+                return breaker
+
+    def poll(self, account):
+        """Polls the account, unless its service's circuit breaker is open."""
+        with self.cond:
+            urgent = account.pk in self.urgent
+            pages = self.urgent.pop(account.pk, None)
+        breaker = self.breaker_for(account.service)
+        if breaker.allow():
+            outcome = poll_account(account, self.owner, self.force or urgent, self.request_rate, self.run, pages)
+            if outcome == 'server-error':
+                breaker.failed()
+            elif outcome in ('skipped', 'throttled'):
+                breaker.abandoned()
+            else:
+                # Even if the poll failed, the service answered.
+                breaker.succeeded()
+        else:
+            log.debug("Circuit breaker for %s is open, skipping account %s", account.service, account.display_name)
+            outcome = 'tripped'
+
+        # If the service's breaker is open, its rate limit is used up or
+        # another poller has the account, leave the requests taken, so
+        # they're taken again after the lease time rather than right away.
+        if urgent and outcome not in ('tripped', 'skipped', 'throttled'):
+            finish_poll_requests(account)
+        self.tally(outcome)
+        if outcome not in ('tripped', 'skipped'):
+            self.clean_up()
+        return outcome
+
+    def heartbeat(self, now=None):
+        """Records that the runner is still alive, if it hasn't lately."""
+        if now is None:
+            now = datetime.utcnow()
+        with self.cond:
+            if now - self.run.last_seen < heartbeat_interval:
+                return
+            self.run.last_seen = now
+        PollRun.objects.filter(pk=self.run.pk).update(last_seen=now)
+
+    def beat(self):
+        try:
+            while not self.stopping.wait(total_seconds(heartbeat_interval)):
+                self.heartbeat()
+        finally:
+            # Each thread has its own database connection, so close it.
+            connection.close()
+
+    def clean_up(self):
+        """Frees what we can of what the last poll left behind, and decides
+        whether it's time to recycle the process."""
+        # The query log grows forever when DEBUG is on.
+        reset_queries()
+        # BeautifulSoup trees are full of reference cycles.
+        gc.collect()
+
+        with self.cond:
+            self.polled += 1
+            if self.recycling:
+                return
+            if self.max_accounts is not None and self.polled >= self.max_accounts:
+                log.info("Polled %d accounts; recycling poller process", self.polled)
+                self.recycling = True
+            elif self.max_rss is not None:
+                rss = memory_used()
+                if rss > self.max_rss:
+                    log.info("Using %.1f MB of memory; recycling poller process", rss)
+                    self.recycling = True
+
+    def summary(self):
+        """Returns a list of lines describing how the runner's polls went and
+        the state of its circuit breakers."""
+        with self.cond:
+            outcomes = sorted(self.outcomes.iteritems())
+            breakers = sorted(self.breakers.iteritems())
+        lines = ['Polls: %s' % (', '.join('%d %s' % (count, outcome) for outcome, count in outcomes) or 'none')]
+        lines.append('Peak HTTP requests per second: %d' % self.request_rate.peak)
+        lines.append(get_pool().summary())
+        lines.append(get_limiter().summary())
+        if get_cache() is not None:
+            lines.append(get_cache().summary())
+        lines.append('Peak memory used: %.1f MB' % peak_memory_used())
+        lines.extend('Circuit breaker %s' % breaker for service, breaker in breakers)
+        return lines
+
+    def stop_reason(self):
+        """Returns why the runner should stop starting polls (as the
+        outcome to tally the accounts it won't poll under), or ``None`` if
+        it should keep going."""
+        if self.recycling:
+            return 'recycling'
+        if self.deadline is not None and datetime.utcnow() >= self.deadline:
+            return 'out-of-time'
+        return None
+
+    def tally(self, outcome, count=1):
+        with self.cond:
+            self.outcomes[outcome] = self.outcomes.get(outcome, 0) + count
+
+    def submit(self, account, urgent=False, pages=None):
+        """Polls the account, or queues it for the worker threads to poll.
+        Returns False if the runner's deadline has passed or it's
+        recycling, so there's no point submitting any more accounts."""
+        reason = self.stop_reason()
+        if reason is not None:
+            self.tally(reason)
+            if urgent:
+                release_poll_requests([account.pk])
+            return False
+
+        if urgent:
+            with self.cond:
+                self.urgent[account.pk] = pages
+        if not self.threads:
+            self.poll(account)
+            return True
+
+        with self.cond:
+            accounts = self.pending.setdefault(account.service, deque())
+            if urgent:
+                accounts.appendleft(account)
+            else:
+                accounts.append(account)
+            self.active.add(account.pk)
+            self.cond.notify_all()
+        return True
+
+    def active_ids(self):
+        """Returns the IDs of the submitted accounts that are waiting for or
+        being polled by the worker threads."""
+        with self.cond:
+            return set(self.active)
+
+    def next_account(self):
+        with self.cond:
+            while True:
+                reason = self.stop_reason()
+                if reason is not None:
+                    self.drop_pending(reason)
+                for service, accounts in self.pending.iteritems():
+                    if accounts and self.in_flight.get(service, 0) < self.limit_for(service):
+                        self.in_flight[service] = self.in_flight.get(service, 0) + 1
+                        return accounts.popleft()
+                if self.closed and not any(self.pending.itervalues()):
+                    return None
+                if self.deadline is None:
+                    self.cond.wait()
+                else:
+                    # Wake up in time to drop the pending accounts at the deadline.
+                    self.cond.wait(max(total_seconds(self.deadline - datetime.utcnow()), 0.1))
+
+    def drop_pending(self, reason):
+        requested = list()
+        with self.cond:
+            dropped = 0
+            for accounts in self.pending.itervalues():
+                for account in accounts:
+                    self.active.discard(account.pk)
+                    if account.pk in self.urgent:
+                        del self.urgent[account.pk]
+                        requested.append(account.pk)
+                dropped += len(accounts)
+                accounts.clear()
+            if dropped:
+                log.info("Dropping %d accounts waiting to be polled (%s)", dropped, reason)
+                self.tally(reason, dropped)
+        # Let another poller take the requests for them.
+        release_poll_requests(requested)
+
+    def done(self, account):
+        with self.cond:
+            self.in_flight[account.service] -= 1
+            self.active.discard(account.pk)
+            self.cond.notify_all()
+
+    def work(self):
+        try:
+            while True:
+                account = self.next_account()
+                if account is None:
+                    break
+                try:
+                    self.poll(account)
+                except Exception, exc:
+                    # Keep the thread going, or the accounts still to be
+                    # submitted would wait for it forever.
+                    log.exception(exc)
+                    SentryClient().create_from_exception(view=__name__)
+                    self.tally('error')
+                    # In case it was the database connection that failed.
+                    connection.close()
+                finally:
+                    self.done(account)
+        finally:
+            # Each thread has its own database connection, so close it.
+            connection.close()
+
+    def finish(self, status=None):
+        """Waits for all the submitted accounts to be polled, then records
+        the run as finished with the given status (by default,
+        ``'recycled'`` if the runner is recycling or ``'finished'`` if
+        not)."""
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        for thread in self.threads:
+            thread.join()
+        self.stopping.set()
+        self.heart.join()
+        stop_pool()
+        get_pool().clear()
+
+        if status is None:
+            status = 'recycled' if self.recycling else 'finished'
+        PollRun.objects.filter(pk=self.run.pk).update(finished=datetime.utcnow(), status=status,
+            accounts=self.polled)
@@ -0,0 +1,197 @@
+from __future__ import with_statement
+
+import logging
+import Queue
+import sys
+import threading
+
+from django.db import connection
+
+from leapfrog.models import Account
+from leapfrog.poll.metrics import PollContext, waiting_for_http
+
+
+log = logging.getLogger(__name__)
+
+
+class Stages(object):
+
+    """A service's poller, split into the stages of polling an account.
+
+    `fetch(account, cursor)` requests one page of the account's feed from
+    the service, returning the raw response (or `None` if there's nothing to
+    read). The `cursor` is `None` for the latest page, or the cursor
+    `normalize` returned for the page before.
+
+    `normalize(account, raw, cursor)` turns a raw page into a list of plain
+    records, returning them and the cursor for the next page back (or
+    `None` if there are no more pages). It doesn't make any requests or
+    touch the database, so it can be done wherever there's time for it.
+
+    If saving the records takes more requests (for the pages they link to,
+    say, or more about each item), `fetch_details(account, records)` makes
+    them and adds what they return to the records, so `persist` can build
+    its objects without waiting on the network for each record in turn.
+    It's run on each page's records right after `normalize`, so while one
+    page is persisted, the next page's details can be fetched ahead.
+
+    `persist(account, records)` saves the records as objects and stream
+    items for the account's user, returning whether any of them were
+    already in the stream (meaning there's no need to read further back),
+    and a list of the records it couldn't save.
+
+    Unless a poll asks for some number of pages, `default_pages` pages are
+    read, or (if it's `None`) pages are read until reaching records already
+    in the stream.
+
+    If the service can be asked for only the items newer than some point in
+    the feed, `mark(account, records, failed)` returns that point for the
+    newest of the records older than all the `failed` ones (the ones
+    `persist` couldn't save), as a string, or `None` if there are none.
+    `newest_saved()` finds that record by whatever key orders the service's
+    feed. Once the poll succeeds it's saved as the account's `poll_cursor`,
+    and `fetch` should ask for only the items newer than the account's
+    `poll_cursor` from then on.
+
+    """
+
+    def __init__(self, fetch, normalize, persist, default_pages=1, mark=None, fetch_details=None):
+        self.fetch = fetch
+        self.normalize = normalize
+        self.persist = persist
+        self.default_pages = default_pages
+        self.mark = mark
+        self.fetch_details = fetch_details
+
+
+def newest_saved(records, failed, key):
+    """Returns the newest of the records (by the `key` function) that's
+    older than all of the `failed` ones, or `None` if there isn't one.
+
+    The items after it in the feed haven't all been saved, so a poll cursor
+    can't be moved past it without losing them.
+
+    """
+    if failed:
+        oldest_failed = min(key(record) for record in failed)
+        records = [record for record in records if key(record) < oldest_failed]
+    if not records:
+        return None
+    return max(records, key=key)
+
+
+def read_pages(stages, account, pages=None):
+    """Yields the lists of records in up to `pages` pages of the account's
+    feed (the service's default number, if `pages` isn't given), newest
+    first."""
+    if not pages:
+        pages = stages.default_pages
+    cursor = None
+    page = 0
+    while pages is None or page < pages:
+        page += 1
+        raw = stages.fetch(account, cursor)
+        if raw is None:
+            return
+        records, cursor = stages.normalize(account, raw, cursor)
+        if records and stages.fetch_details is not None:
+            stages.fetch_details(account, records)
+        yield records
+        if cursor is None:
+            return
+
+
+def fetch_ahead(pages):
+    """Yields the items of the `pages` iterator, producing each one in
+    another thread while the caller handles the one before.
+
+    HTTP requests and rows saved in that thread count toward the caller's
+    `PollContext`, and have the same deadline. The time the caller spends
+    waiting for the next item counts as time waiting for HTTP responses.
+
+    """
+    context = PollContext.current()
+    ahead = context.fork() if context is not None else PollContext()
+    results = Queue.Queue(maxsize=1)
+    stopping = threading.Event()
+
+    def run():
+        try:
+            with ahead:
+                for page in pages:
+                    results.put((page, None))
+                    if stopping.isSet():
+                        return
+            results.put((None, None))
+        except BaseException:
+            results.put((None, sys.exc_info()))
+        finally:
+            # Each thread has its own database connection, so close it.
+            connection.close()
+
+    thread = threading.Thread(target=run, name='fetch-ahead')
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            with waiting_for_http():
+                page, exc_info = results.get()
+            if exc_info is not None:
+                raise exc_info[0], exc_info[1], exc_info[2]
+            if page is None:
+                return
+            yield page
+    finally:
+        stopping.set()
+        # Take any page it's waiting to hand over, so it can see it should stop.
+        while thread.isAlive():
+            try:
+                results.get(timeout=0.1)
+            except Queue.Empty:
+                pass
+        thread.join()
+        if context is not None:
+            context.join(ahead)
+
+
+def run_stages(stages, account, pages=None):
+    """Polls the account through its service's stages, reading up to
+    `pages` pages back (the service's default number, if not given) until
+    reaching records already in the stream.
+
+    When a number of pages is asked for, each page is fetched and
+    normalized while the one before it is persisted. (Usually the first
+    page reaches records already in the stream, so the service's default
+    pages are read one at a time, rather than fetching a page that won't
+    be used.)
+
+    Once all the pages are persisted, the account's `poll_cursor` is moved
+    up to the newest record, or if some records couldn't be saved, only up
+    to the newest record older than all of them, so they're asked for again
+    next time.
+
+    """
+    if account.person.user is None:
+        return
+
+    persisted, failed = list(), list()
+    records_by_page = read_pages(stages, account, pages)
+    if pages is not None and pages > 1:
+        records_by_page = fetch_ahead(records_by_page)
+    try:
+        for records in records_by_page:
+            overlap, page_failed = stages.persist(account, records)
+            persisted.extend(records)
+            failed.extend(page_failed)
+            if overlap:
+                log.debug("Found records already in the stream for %s %s, stopping", account.service, account.display_name)
+                break
+    finally:
+        records_by_page.close()
+
+    if stages.mark is None:
+        return
+    mark = stages.mark(account, persisted, failed)
+    if mark is not None and mark != account.poll_cursor:
+        account.poll_cursor = mark
+        Account.objects.filter(pk=account.pk).update(poll_cursor=account.poll_cursor)
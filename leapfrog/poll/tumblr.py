@@ -17,6 +17,8 @@ import oauth2 as oauth
 
 from leapfrog.models import Object, Account, Media, Person, UserStream, UserReplyStream
 import leapfrog.poll.embedlam
+from leapfrog.poll.parse import parse
+from leapfrog.poll.stages import Stages, newest_saved, run_stages
 
 
 log = logging.getLogger(__name__)
@@ -196,28 +198,37 @@ def account_for_tumblelog_element(tumblelog_elem, person=None):
     return account
 
 
-def remove_reblog_boilerplate_from_obj(obj, in_reply_to):
-    soup = BeautifulSoup(obj.body)
+def body_without_reblog_boilerplate(body, in_reply_to_url):
+    """Returns the reblog's HTML `body` without its leading link to and
+    quote of the post at `in_reply_to_url`, or `None` if it doesn't start
+    with them."""
+    soup = BeautifulSoup(body)
     top_two = soup.findAll(recursive=False, limit=2)
     if len(top_two) < 2:
-        return
+        return None
     maybe_p, maybe_quote = top_two
 
     if maybe_quote.name != 'blockquote':
         log.debug('Second element is a %s, not a blockquote', maybe_quote.name)
-        return
+        return None
     if maybe_p.name != 'p':
         log.debug('First element is a %s, not a p', maybe_p.name)
-        return
-    maybe_blog_link = maybe_p.find(name='a', attrs={'href': in_reply_to.permalink_url})
+        return None
+    maybe_blog_link = maybe_p.find(name='a', attrs={'href': in_reply_to_url})
     if not maybe_blog_link:
         log.debug("First element doesn't link to reply target %s in its HTML: %s",
-            in_reply_to.permalink_url, unicode(maybe_p).encode('utf8', 'ignore'))
-        return
+            in_reply_to_url, unicode(maybe_p).encode('utf8', 'ignore'))
+        return None
 
     maybe_p.extract()
     maybe_quote.extract()
-    obj.body = str(soup).decode('utf8').strip()
+    return str(soup).decode('utf8').strip()
+
+
+def remove_reblog_boilerplate_from_obj(obj, in_reply_to):
+    body = parse(body_without_reblog_boilerplate, obj.body, in_reply_to.permalink_url)
+    if body is not None:
+        obj.body = body
 
 
 def object_from_postdata(postdata):
@@ -568,32 +579,36 @@ def object_from_url(url):
     return object_from_post_element(post_el, tumblelog_el)
 
 
-def poll_tumblr(account):
-    user = account.person.user
-    if user is None:
-        return
-
+def fetch_tumblr(account, cursor):
+    """Returns the raw page of the Tumblr account's dashboard starting
+    `cursor` posts back (or the latest page, if `cursor` is `None`), with
+    only the posts since the last poll."""
     csr = oauth.Consumer(*settings.TUMBLR_CONSUMER)
     token = oauth.Token(*account.authinfo.split(':', 1))
     client = oauth.Client(csr, token)
 
+    query = dict()
+    if cursor:
+        query['offset'] = cursor
+    if account.poll_cursor:
+        query['since_id'] = account.poll_cursor
+    dashboard_url = 'http://api.tumblr.com/v2/user/dashboard'
+    if query:
+        dashboard_url += '?' + urlencode(query)
     try:
-        resp, cont = client.request('http://api.tumblr.com/v2/user/dashboard')
-    except socket.error:
-        log.info("Socket error polling Tumblr user %s's dashboard (is Tumblr down?)", account.ident)
-        return
+        resp, cont = client.request(dashboard_url)
+    except socket.error, exc:
+        raise leapfrog.poll.embedlam.ServerError("Socket error polling Tumblr user %s's dashboard (is Tumblr down?): %s"
+            % (account.ident, str(exc)))
 
     if resp.status == 500:
-        log.info("Server error polling Tumblr user %s's dashboard (is Tumblr down?)", account.ident)
-        return
+        raise leapfrog.poll.embedlam.ServerError("Server error polling Tumblr user %s's dashboard (is Tumblr down?)" % account.ident)
     if resp.status == 408:
-        log.info("Timeout polling Tumblr user %s's dashboard (is Tumblr down/slow?)", account.ident)
-        return
+        raise leapfrog.poll.embedlam.ServerError("Timeout polling Tumblr user %s's dashboard (is Tumblr down/slow?)" % account.ident)
     if resp.status == 401:
-        log.info("401 Unauthorized fetching Tumblr user %s's dashboard (maybe suspended?)", account.ident)
-        return
+        raise leapfrog.poll.embedlam.RequestError("401 Unauthorized fetching Tumblr user %s's dashboard (maybe suspended?)" % account.ident)
     if resp.status == 403:
-        raise ValueError("403 Forbidden fetching Tumblr user %s's dashboard\n\n%s" % (account.ident, cont))
+        raise leapfrog.poll.embedlam.RequestError("403 Forbidden fetching Tumblr user %s's dashboard\n\n%s" % (account.ident, cont))
 
     if resp.status != 200:
         raise ValueError("Unexpected HTTP response %d %s looking for dashboard for Tumblr user %s" % (resp.status, resp.reason, account.ident))
@@ -601,13 +616,32 @@ def poll_tumblr(account):
     content_type = resp.get('content-type')
     if content_type is None:
         log.info("Response polling Tumblr user %s's dashboard had no content type (is Tumblr down?)", account.ident)
-        return
+        return None
     if not content_type.startswith('application/json'):
         log.info("Unexpected response of type %r looking for dashboard for Tumblr user %s (expected application/json)", content_type, account.ident)
-        return
+        return None
+
+    return cont
 
+
+def normalize_tumblr(account, cont, cursor):
+    """Returns the post data in a raw page of a dashboard, and the offset
+    to read the page before it from."""
     data = json.loads(cont)
-    for postdata in data['response']['posts']:
+    posts = data['response']['posts']
+    if not posts:
+        return [], None
+    return posts, (cursor or 0) + len(posts)
+
+
+def persist_tumblr(account, posts):
+    """Saves the posts to the Tumblr account's user's stream, returning
+    whether any were already there, and the posts that couldn't be saved
+    (none, as a post that can't be saved fails the whole poll)."""
+    user = account.person.user
+
+    overlap = False
+    for postdata in posts:
         really_a_share, obj = object_from_postdata(postdata)
         if obj is None:
             continue
@@ -623,6 +657,8 @@ def poll_tumblr(account):
         stream_time = obj.time if obj.time <= now else now
         streamitem, created = UserStream.objects.get_or_create(user=user, obj=root,
             defaults={'time': stream_time, 'why_account': why_account, 'why_verb': why_verb})
+        if not created:
+            overlap = True
 
         superobj = obj
         while superobj.in_reply_to is not None:
@@ -630,3 +666,29 @@ def poll_tumblr(account):
             UserReplyStream.objects.get_or_create(user=user, root=root, reply=superobj,
                 defaults={'root_time': streamitem.time, 'reply_time': stream_time})
             superobj = superobj.in_reply_to
+
+    return overlap, []
+
+
+def mark_tumblr(account, posts, failed):
+    """Returns the ID of the newest post saved before any that failed, to
+    ask only for the posts after it next time."""
+    postdata = newest_saved(posts, failed, lambda postdata: postdata['id'])
+    if postdata is None:
+        return None
+    return str(postdata['id'])
+
+
+stages = Stages(fetch_tumblr, normalize_tumblr, persist_tumblr, mark=mark_tumblr)
+
+
+def poll_tumblr(account, pages=None):
+    """Adds the new posts on the Tumblr account's dashboard to its user's
+    stream.
+
+    Only the latest page of the dashboard is read, unless `pages` asks to
+    page back through up to that many pages, stopping at the first page
+    with posts already in the stream.
+
+    """
+    run_stages(stages, account, pages)
@@ -11,6 +11,8 @@ import oauth2 as oauth
 
 from leapfrog.models import Object, Account, Person, UserStream, Media, UserReplyStream
 import leapfrog.poll.embedlam
+import leapfrog.poll.resolve
+from leapfrog.poll.stages import Stages, newest_saved, run_stages
 
 
 log = logging.getLogger(__name__)
@@ -270,7 +272,25 @@ def object_from_url(url):
     return tweet_obj
 
 
-def raw_object_for_tweet(tweetdata, client):
+def link_urls(tweetdata):
+    """Returns the URLs of the links in the tweet."""
+    urls = tweetdata['entities'].get('urls', ())
+    return [urldata.get('expanded_url') or urldata.get('url') for urldata in urls]
+
+
+def page_for_url(url, link_pages):
+    """Returns the `leapfrog.poll.embedlam.Page` for the URL, using the one
+    in the dict of `link_pages` fetched ahead if there is one."""
+    try:
+        page = link_pages[url]
+    except (KeyError, TypeError):
+        return leapfrog.poll.embedlam.Page(url)
+    if isinstance(page, ValueError):
+        raise page
+    return page
+
+
+def raw_object_for_tweet(tweetdata, client, link_pages=None):
     """Returns the normalized Object for the given tweetdata, and whether
     that Object represents that tweet or the thing the tweet is sharing.
 
@@ -278,6 +298,10 @@ def raw_object_for_tweet(tweetdata, client):
     share, and (b) the ``leapfrog.models.Object`` reference for that tweet
     data, in that order.
 
+    Pages the tweet links to are taken from the `link_pages` dict (as
+    returned by `leapfrog.poll.resolve.fetch_pages()`) if they're in it,
+    and fetched otherwise.
+
     """
     try:
         return False, Object.objects.get(service='twitter.com', foreign_id=str(tweetdata['id']))
@@ -309,7 +333,7 @@ def raw_object_for_tweet(tweetdata, client):
 
         about_page = None
         try:
-            about_page = leapfrog.poll.embedlam.Page(about_url)
+            about_page = page_for_url(about_url, link_pages)
         except leapfrog.poll.embedlam.RequestError, exc:
             log.debug("Expected problem making page data from reference %s of %s's tweet %s", about_url, tweetdata['user']['screen_name'], tweetdata['id'], exc_info=True)
         except ValueError, exc:
@@ -362,17 +386,17 @@ def raw_object_for_tweet(tweetdata, client):
 
     # Update the status's links anyway.
     else:
-        try:
-            urls = tweetdata['entities']['urls']
-        except KeyError:
-            urls = ()
-        for urldata in urls:
-            url = urldata.get('expanded_url') or urldata.get('url')
+        urls = tweetdata['entities'].get('urls', ())
+        pages = dict(link_pages or {})
+        # Fetch all the linked pages we don't have yet at once.
+        missing = [url for url in link_urls(tweetdata) if url and url not in pages]
+        if missing:
+            pages.update(leapfrog.poll.resolve.fetch_pages(missing))
+        for urldata, url in zip(urls, link_urls(tweetdata)):
             if not url:
                 continue
-            try:
-                url_page = leapfrog.poll.embedlam.Page(url)
-            except ValueError:
+            url_page = pages[url]
+            if isinstance(url_page, ValueError):
                 # meh
                 continue
 
@@ -406,56 +430,112 @@ def raw_object_for_tweet(tweetdata, client):
     return False, tweet
 
 
-def poll_twitter(account):
-    user = account.person.user
-    if user is None:
-        return
-
+def fetch_twitter(account, cursor):
+    """Returns the raw page of the Twitter account's home timeline before
+    the tweet ID `cursor` (or the latest page, if `cursor` is `None`), with
+    only the tweets since the last poll."""
     authtoken = account.authinfo
     if not authtoken:
-        return
+        return None
 
     # Get that twitter user's home timeline.
     csr = oauth.Consumer(*settings.TWITTER_CONSUMER)
     token = oauth.Token(*authtoken.split(':', 1))
     client = oauth.Client(csr, token)
+    timeline_url = 'http://api.twitter.com/1/statuses/home_timeline.json?include_entities=true&count=50'
+    if cursor is not None:
+        timeline_url += '&max_id=%d' % cursor
+    if account.poll_cursor:
+        timeline_url += '&since_id=%s' % account.poll_cursor
     try:
-        resp, content = client.request('http://api.twitter.com/1/statuses/home_timeline.json?include_entities=true&count=50', 'GET')
+        resp, content = client.request(timeline_url, 'GET')
     except httplib.IncompleteRead:
-        log.info("Twitter returned an incomplete response asking for %s's feed", account.ident)
-        return
+        raise leapfrog.poll.embedlam.ServerError("Twitter returned an incomplete response asking for %s's feed" % account.ident)
     if resp.status in (500, 502, 503):
         # Can't get Twitter results right now. Let's try again later.
-        log.info("Twitter returned a server error status %d asking for %s's feed (Twitter's down?)", resp.status, account.ident)
-        return
+        raise leapfrog.poll.embedlam.ServerError("Twitter returned a server error status %d asking for %s's feed (Twitter's down?)"
+            % (resp.status, account.ident))
     if resp.status == 401:
         # The token may be invalid. Have we successfully scanned this account recently?
         if account.last_success > datetime.utcnow() - timedelta(days=2):
-            raise ValueError("Token for Twitter user %s came back as invalid (possibly temporary)" % account.ident)
+            raise leapfrog.poll.embedlam.RequestError("Token for Twitter user %s came back as invalid (possibly temporary)" % account.ident)
         # The token is now invalid (maybe they revoked the app). Stop updating this account.
         account.authinfo = ''
         account.save()
-        raise ValueError("Token for Twitter user %s came back as invalid (probably permanent, so deleted authinfo)" % account.ident)
+        raise leapfrog.poll.embedlam.RequestError("Token for Twitter user %s came back as invalid (probably permanent, so deleted authinfo)" % account.ident)
     if resp.status != 200:
         raise ValueError("Unexpected %d %s response fetching %s's twitter timeline"
             % (resp.status, resp.reason, account.ident))
 
+    return content
+
+
+def normalize_twitter(account, content, cursor):
+    """Returns records for the tweets in a raw page of a home timeline,
+    oldest first, and the ID to read the page before it from."""
     tl = json.loads(content)
+    if not tl:
+        return [], None
 
+    records = list()
     for orig_tweetdata in reversed(tl):
+        # TODO: filter based on source?
+        tweetdata = orig_tweetdata
+        why_verb = 'post'
         try:
-            # TODO: filter based on source?
+            tweetdata = orig_tweetdata['retweeted_status']
+        except KeyError:
+            pass
+        else:
+            why_verb = 'share'
+
+        if 'entities' not in tweetdata:
+            synthesize_entities(tweetdata)
+        records.append({
+            'id': orig_tweetdata['id'],
+            'tweetdata': tweetdata,
+            'why_verb': why_verb,
+            'sharer': orig_tweetdata['user'],
+        })
 
-            tweetdata = orig_tweetdata
-            why_verb = 'post'
-            try:
-                tweetdata = orig_tweetdata['retweeted_status']
-            except KeyError:
-                pass
-            else:
-                why_verb = 'share'
+    # Next time, ask for the page of tweets before these.
+    return records, min(tweetdata['id'] for tweetdata in tl) - 1
+
+
+def fetch_twitter_details(account, records):
+    """Fetches the pages linked from the new tweets in the records, all at
+    once, for `persist_twitter` to use."""
+    tweet_ids = [str(record['tweetdata']['id']) for record in records]
+    seen = set(Object.objects.filter(service='twitter.com', foreign_id__in=tweet_ids)
+        .values_list('foreign_id', flat=True))
+    urls = set()
+    for record in records:
+        tweetdata = record['tweetdata']
+        # Replies aren't about their links, so those aren't fetched.
+        if str(tweetdata['id']) in seen or tweetdata.get('in_reply_to_status_id'):
+            continue
+        urls.update(url for url in link_urls(tweetdata) if url)
+
+    link_pages = leapfrog.poll.resolve.fetch_pages(urls)
+    for record in records:
+        record['link_pages'] = link_pages
+
+
+def persist_twitter(account, records):
+    """Saves the tweets in the records to the Twitter account's user's
+    stream, returning whether any were already there and the records that
+    couldn't be saved."""
+    user = account.person.user
+    csr = oauth.Consumer(*settings.TWITTER_CONSUMER)
+    token = oauth.Token(*account.authinfo.split(':', 1))
+    client = oauth.Client(csr, token)
 
-            really_a_share, tweet = raw_object_for_tweet(tweetdata, client)
+    overlap = False
+    failed = list()
+    for record in records:
+        try:
+            why_verb = record['why_verb']
+            really_a_share, tweet = raw_object_for_tweet(record['tweetdata'], client, record.get('link_pages'))
             if tweet is None:
                 continue
 
@@ -463,7 +543,7 @@ def poll_twitter(account):
                 why_verb = 'share'
 
             if why_verb == 'share':
-                why_account = account_for_twitter_user(orig_tweetdata['user'])
+                why_account = account_for_twitter_user(record['sharer'])
             else:
                 why_account = tweet.author
 
@@ -485,6 +565,8 @@ def poll_twitter(account):
             streamitem, created = UserStream.objects.get_or_create(user=user, obj=root,
                 # TODO: is tweet.time the right time here or do we need the "why time" from orig_tweetdata?
                 defaults={'why_account': why_account, 'why_verb': why_verb, 'time': tweet.time})
+            if not created:
+                overlap = True
 
             # Now add a reply for each tweet in the thread along the way.
             supertweet = tweet
@@ -496,3 +578,31 @@ def poll_twitter(account):
         except Exception, exc:
             from sentry.client.base import SentryClient
             SentryClient().create_from_exception(view=__name__)
+            failed.append(record)
+
+    return overlap, failed
+
+
+def mark_twitter(account, records, failed):
+    """Returns the ID of the newest tweet saved before any that failed, to
+    ask only for the tweets after it next time."""
+    record = newest_saved(records, failed, lambda record: record['id'])
+    if record is None:
+        return None
+    return str(record['id'])
+
+
+stages = Stages(fetch_twitter, normalize_twitter, persist_twitter, mark=mark_twitter,
+    fetch_details=fetch_twitter_details)
+
+
+def poll_twitter(account, pages=None):
+    """Adds the new tweets in the Twitter account's home timeline to its
+    user's stream.
+
+    Only the latest page of the timeline is read, unless `pages` asks to
+    page back through up to that many pages, stopping at the first page
+    with tweets already in the stream.
+
+    """
+    run_stages(stages, account, pages)
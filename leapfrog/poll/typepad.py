@@ -10,6 +10,8 @@ from tidylib import tidy_fragment
 
 from leapfrog.models import Object, Account, Person, UserStream, Media, UserReplyStream
 import leapfrog.poll.embedlam
+from leapfrog.poll.parse import parse
+from leapfrog.poll.stages import Stages, run_stages
 
 
 log = logging.getLogger(__name__)
@@ -78,11 +80,13 @@ def account_for_typepad_user(tp_user, person=None):
     return account
 
 
-def remove_reblog_boilerplate_from_obj(obj):
-    soup = BeautifulSoup(obj.body)
+def body_without_reblog_boilerplate(body):
+    """Returns the reblog's HTML `body` without its leading quote of the
+    reblogged post (and its attribution), or `None` if it has none."""
+    soup = BeautifulSoup(body)
     top_two = soup.findAll(recursive=False, limit=2)
     if len(top_two) < 2:
-        return
+        return None
     maybe_quote, maybe_p = top_two
 
     # Regardless of what the first thing is, if the second is a <p><small>, toss 'em.
@@ -93,9 +97,15 @@ def remove_reblog_boilerplate_from_obj(obj):
     elif maybe_quote.name == 'blockquote':
         maybe_quote.extract()
     else:
-        return
+        return None
+
+    return str(soup).decode('utf8').strip()
 
-    obj.body = str(soup).decode('utf8').strip()
+
+def remove_reblog_boilerplate_from_obj(obj):
+    body = parse(body_without_reblog_boilerplate, obj.body)
+    if body is not None:
+        obj.body = body
 
 
 def object_for_typepad_object(tp_obj):
@@ -274,21 +284,40 @@ def object_from_url(url):
     raise ValueError("Could not identify TypePad asset for url %s" % url)
 
 
-def poll_typepad(account):
-    user = account.person.user
-    if user is None:
-        return
-
+def fetch_typepad(account, cursor):
+    """Returns the TypePad account's latest notifications that are worth
+    showing, oldest first."""
     # Get that TypePad user's notifications.
     t = typd.TypePad(endpoint='http://api.typepad.com/')
     notes = t.users.get_notifications(account.ident)
     try:
         notes.entries
-    except typd.ServerError:
+    except typd.ServerError, exc:
         # Guess we can't get those notes right now.
-        return
+        raise leapfrog.poll.embedlam.ServerError("TypePad returned a server error asking for %s's notifications: %s"
+            % (account.ident, str(exc)))
+
+    # Filling in the threads of comments takes more requests, so that's
+    # part of fetching too.
+    return list(good_notes_for_notes(reversed(notes.entries), t))
+
+
+def normalize_typepad(account, notes, cursor):
+    """Returns the notes, which typd has already made into objects.
+
+    Only the latest notifications are read, so there are no more pages.
 
-    for note in good_notes_for_notes(reversed(notes.entries), t):
+    """
+    return notes, None
+
+
+def persist_typepad(account, notes):
+    """Saves the notes' objects to the TypePad account's user's stream,
+    returning the notes that couldn't be saved."""
+    user = account.person.user
+
+    failed = list()
+    for note in notes:
         try:
             really_a_share, obj = object_for_typepad_object(note.object)
 
@@ -317,3 +346,15 @@ def poll_typepad(account):
 
         except Exception, exc:
             log.exception(exc)
+            failed.append(note)
+
+    # Only the latest notifications are read anyway.
+    return False, failed
+
+
+stages = Stages(fetch_typepad, normalize_typepad, persist_typepad)
+
+
+def poll_typepad(account, pages=None):
+    # Only the latest notifications are read, however many `pages` are asked for.
+    run_stages(stages, account, pages)
@@ -12,6 +12,7 @@ import oauth2 as oauth
 
 from leapfrog.models import Account, Media, Person, Object, UserStream
 import leapfrog.poll.embedlam
+from leapfrog.poll.stages import Stages, run_stages
 
 
 log = logging.getLogger(__name__)
@@ -37,8 +38,8 @@ def call_vimeo(method, token=None, **kwargs):
     resp, content = h.request(normal_url, method=oauth_request.method,
         headers=oauth_header)
 
-    if resp.status == 500:
-        raise leapfrog.poll.embedlam.RequestError("500 Server Error making Vimeo request %s" % normal_url)
+    if resp.status >= 500:
+        raise leapfrog.poll.embedlam.ServerError("%d Server Error making Vimeo request %s" % (resp.status, normal_url))
     if resp.status != 200:
         raise ValueError("Unexpected response making Vimeo request %s: %d %s" % (normal_url, resp.status, resp.reason))
 
@@ -137,22 +138,54 @@ def object_from_url(url):
     return object_from_video_data(videodata)
 
 
-def poll_vimeo(account):
+def fetch_vimeo(account, cursor):
+    """Returns the page numbered `cursor` (or the first page, if `cursor`
+    is `None`) of the videos in the Vimeo account's subscriptions."""
+    token = oauth.Token(*account.authinfo.split(':'))
+    return call_vimeo('vimeo.videos.getSubscriptions', token=token, full_response='true', page=cursor or 1)
+
+
+def normalize_vimeo(account, subdata, cursor):
+    """Returns the video data in a page of subscriptions, and the number of
+    the page after it."""
+    videos = subdata['videos'].get('video', [])
+    if not videos:
+        return [], None
+    return videos, (cursor or 1) + 1
+
+
+def persist_vimeo(account, videos):
+    """Saves the videos to the Vimeo account's user's stream, returning
+    whether any were already there and the videos that couldn't be saved."""
     user = account.person.user
-    if user is None:
-        return
 
-    token = oauth.Token(*account.authinfo.split(':'))
-    try:
-        subdata = call_vimeo('vimeo.videos.getSubscriptions', token=token, full_response='true')
-    except leapfrog.poll.embedlam.RequestError:
-        log.debug("An expected error occurred getting Vimeo subscriptions, tsk", exc_data=True)
-        return
-    for videodata in subdata['videos']['video']:
+    overlap = False
+    failed = list()
+    for videodata in videos:
         try:
             obj = object_from_video_data(videodata)
             # TODO: save videos from "like" subscriptions as shares
-            UserStream.objects.get_or_create(user=user, obj=obj,
+            streamitem, created = UserStream.objects.get_or_create(user=user, obj=obj,
                 defaults={'time': obj.time, 'why_account': obj.author, 'why_verb': 'post'})
+            if not created:
+                overlap = True
         except Exception, exc:
             log.exception(exc)
+            failed.append(videodata)
+
+    return overlap, failed
+
+
+stages = Stages(fetch_vimeo, normalize_vimeo, persist_vimeo)
+
+
+def poll_vimeo(account, pages=None):
+    """Adds the new videos in the Vimeo account's subscriptions to its
+    user's stream.
+
+    Only the latest page of videos is read, unless `pages` asks to page
+    back through up to that many pages, stopping at the first page with
+    videos already in the stream.
+
+    """
+    run_stages(stages, account, pages)
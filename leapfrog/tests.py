@@ -5,8 +5,25 @@ unittest). These will both pass when you run "manage.py test".
 Replace these with more appropriate tests for your application.
 """
 
+from datetime import datetime, timedelta
+import os
+import socket
+import subprocess
+
+from django.conf import settings
+from django.contrib.auth.models import User
 from django.test import TestCase
 
+from leapfrog.models import Account, Person
+
+
+def make_account(service='twitter.com', ident='1', **kwargs):
+    """Saves and returns an account of a reader's, for polling."""
+    user = User.objects.create(username='%s-%s' % (service, ident))
+    person = Person.objects.create(user=user, display_name=ident)
+    return Account.objects.create(service=service, ident=ident, display_name=ident, person=person, **kwargs)
+
+
 class SimpleTest(TestCase):
     def test_basic_addition(self):
         """
@@ -21,3 +38,990 @@ Another way to test that 1 + 1 is equal to 2.
 True
 """}
 
+
+
+class FakeSocket(object):
+
+    def settimeout(self, timeout):
+        self.timeout = timeout
+
+
+class FakeConnection(object):
+
+    def __init__(self):
+        self.sock = FakeSocket()
+        self.timeout = None
+
+    def close(self):
+        self.sock = None
+
+
+class FakeHttp(object):
+
+    """Stands in for an `httplib2.Http`, opening a `FakeConnection` to each
+    host it doesn't already have one to."""
+
+    def __init__(self, timeout=None):
+        self.connections = dict()
+        self.timeout = timeout
+        self.used = list()
+
+    def request(self, uri, fail=False):
+        import httplib2
+        scheme, authority = httplib2.urlnorm(uri)[:2]
+        conn = self.connections.setdefault('%s:%s' % (scheme, authority), FakeConnection())
+        self.used.append(conn)
+        if fail:
+            raise IOError("Connection reset")
+        return {'status': '200'}, ''
+
+
+class ConnectionPoolTest(TestCase):
+
+    def setUp(self):
+        from leapfrog.poll import httpclient
+        self.old_pool = httpclient.pool
+        self.pool = httpclient.pool = httpclient.ConnectionPool(size=2, idle_seconds=30)
+
+    def tearDown(self):
+        from leapfrog.poll import httpclient
+        httpclient.pool = self.old_pool
+
+    def request(self, http, uri='http://example.com/', **kwargs):
+        from leapfrog.poll.httpclient import pooled_request
+        return pooled_request(FakeHttp.request, http, uri, **kwargs)
+
+    def test_reuse(self):
+        first, second = FakeHttp(), FakeHttp(timeout=5)
+        self.request(first)
+        self.assertEqual(first.connections, {})
+        self.request(second)
+        self.assertEqual(second.used, first.used)
+        self.assertEqual(second.used[0].timeout, 5)
+        self.assertEqual(second.used[0].sock.timeout, 5)
+        self.assertEqual((self.pool.opened, self.pool.reused), (1, 1))
+
+        other = FakeHttp()
+        self.request(other, 'https://example.com/')
+        self.assertNotEqual(other.used, first.used)
+
+    def test_failed(self):
+        http = FakeHttp()
+        self.assertRaises(IOError, self.request, http, fail=True)
+        self.assertEqual(http.used[0].sock, None)
+        self.assertEqual(self.pool.idle, {})
+
+    def test_size(self):
+        conns = [FakeConnection() for i in range(3)]
+        for conn in conns:
+            self.pool.checkin('key', conn, reused=False)
+        self.assertEqual(self.pool.opened, 3)
+        self.assertEqual(conns[2].sock, None)
+        self.assert_(self.pool.checkout('key') is conns[1])
+        self.assert_(self.pool.checkout('key') is conns[0])
+        self.assertEqual(self.pool.checkout('key'), None)
+
+    def test_idle(self):
+        conns = [FakeConnection() for i in range(2)]
+        for conn in conns:
+            self.pool.checkin('key', conn)
+        self.pool.idle['key'] = [(conn, last_used - 31) for conn, last_used in self.pool.idle['key']]
+        self.assertEqual(self.pool.checkout('key'), None)
+        self.assertEqual([conn.sock for conn in conns], [None, None])
+
+    def test_clear(self):
+        conn = FakeConnection()
+        self.pool.checkin('key', conn)
+        self.pool.clear()
+        self.assertEqual(conn.sock, None)
+        self.assertEqual(self.pool.checkout('key'), None)
+
+    def test_pool_hook(self):
+        import httplib2
+        from leapfrog.poll import metrics
+        request, conn_request = httplib2.Http.__dict__['request'], httplib2.Http._conn_request
+        try:
+            httplib2.Http.request = metrics.uncounted_request
+            httplib2.Http._conn_request = metrics.unthrottled_conn_request
+            metrics.install_pool_hook()
+            self.assert_(httplib2.Http.__dict__['request'] is metrics.network_request)
+            self.assert_(httplib2.Http.__dict__['_conn_request'] is metrics.unthrottled_conn_request)
+            metrics.install_http_hooks()
+            metrics.install_pool_hook()
+            self.assert_(httplib2.Http.__dict__['request'] is metrics.counted_request)
+        finally:
+            httplib2.Http.request, httplib2.Http._conn_request = request, conn_request
+
+
+class ResponseCacheTest(TestCase):
+
+    def setUp(self):
+        import tempfile
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.directory)
+
+    def cache(self, max_bytes=1000):
+        from leapfrog.poll.httpclient import ResponseCache
+        return ResponseCache(self.directory, max_bytes)
+
+    def test_get_set(self):
+        cache = self.cache()
+        self.assertEqual(cache.get(u'http://example.com/\u2603'), None)
+        cache.set(u'http://example.com/\u2603', 'response')
+        self.assertEqual(cache.get(u'http://example.com/\u2603'), 'response')
+        # Another process sees it too.
+        self.assertEqual(self.cache().get(u'http://example.com/\u2603'), 'response')
+        cache.delete(u'http://example.com/\u2603')
+        cache.delete(u'http://example.com/\u2603')
+        self.assertEqual(cache.get(u'http://example.com/\u2603'), None)
+
+    def test_too_big(self):
+        cache = self.cache()
+        cache.set('key', 'x' * 10)
+        cache.set('key', 'x' * 101)
+        self.assertEqual(cache.get('key'), None)
+
+    def test_trim(self):
+        import time
+        cache = self.cache()
+        for i in range(11):
+            cache.set(str(i), 'x' * 90)
+            os.utime(cache.path(str(i)), (time.time() - 1000 + i,) * 2)
+        self.assertEqual(cache.evictions, 0)
+        # Reading a response keeps it.
+        cache.get('0')
+        cache.set('11', 'x' * 90)
+        self.assertEqual(cache.evictions, 2)
+        self.assertEqual([key for key in map(str, range(12)) if cache.get(key) is None], ['1', '2'])
+
+    def test_count_response(self):
+        from email.utils import formatdate
+        import httplib2
+        from leapfrog.poll.embedlam import EmbedlamUserAgent
+        served = list()
+
+        def conn_request(http, conn, request_uri, method, body, headers):
+            served.append(request_uri)
+            if headers.get('if-none-match') == '"1"':
+                return httplib2.Response({'status': '304', 'etag': '"1"'}), ''
+            max_age = 60 if request_uri == '/fresh' else 0
+            return httplib2.Response({'status': '200', 'etag': '"1"', 'date': formatdate(usegmt=True),
+                'cache-control': 'max-age=%d' % max_age}), 'page'
+
+        cache = self.cache(100000)
+        real_conn_request = httplib2.Http.__dict__['_conn_request']
+        httplib2.Http._conn_request = conn_request
+        try:
+            for url in ('http://example.com/fresh', 'http://example.com/stale'):
+                for i in range(2):
+                    resp, content = EmbedlamUserAgent(cache=cache).request(url)
+                    self.assertEqual(content, 'page')
+        finally:
+            httplib2.Http._conn_request = real_conn_request
+
+        self.assertEqual(served, ['/fresh', '/stale', '/stale'])
+        self.assertEqual((cache.hits, cache.revalidations, cache.misses), (1, 1, 2))
+
+
+class TokenBucketTest(TestCase):
+
+    def test_burst(self):
+        from leapfrog.poll.httpclient import TokenBucket
+        bucket = TokenBucket(2.0, 3)
+        now = bucket.updated
+        self.assertEqual([bucket.reserve(now) for i in range(3)], [0, 0, 0])
+        self.assertEqual(bucket.reserve(now), 0.5)
+        self.assertEqual(bucket.reserve(now), 1.0)
+
+    def test_refill(self):
+        from leapfrog.poll.httpclient import TokenBucket
+        bucket = TokenBucket(2.0, 3)
+        now = bucket.updated
+        for i in range(5):
+            bucket.reserve(now)
+        # Two tokens came back in the second, but two requests were waiting for them.
+        self.assertEqual(bucket.reserve(now + 1), 0.5)
+        # Tokens don't build up past the burst size.
+        self.assertEqual([bucket.reserve(now + 60) for i in range(4)], [0, 0, 0, 0.5])
+
+    def test_refund(self):
+        from leapfrog.poll.httpclient import TokenBucket
+        bucket = TokenBucket(1.0, 1)
+        now = bucket.updated
+        self.assertEqual(bucket.reserve(now), 0)
+        bucket.refund()
+        self.assertEqual(bucket.reserve(now), 0)
+
+
+class RetryAfterTest(TestCase):
+
+    now = 1300000000
+
+    def retry_after(self, status, **headers):
+        import httplib2
+        from leapfrog.poll.httpclient import retry_after
+        headers = dict((name.replace('_', '-'), value) for name, value in headers.iteritems())
+        headers['status'] = str(status)
+        return retry_after(httplib2.Response(headers), self.now)
+
+    def test_seconds(self):
+        self.assertEqual(self.retry_after(503, retry_after='120'), 120)
+        self.assertEqual(self.retry_after(429, retry_after='-5'), 0)
+
+    def test_date(self):
+        from email.utils import formatdate
+        self.assertEqual(self.retry_after(503, retry_after=formatdate(self.now + 90, usegmt=True)), 90)
+        self.assertEqual(self.retry_after(503, retry_after=formatdate(self.now - 90, usegmt=True)), 0)
+
+    def test_too_many_requests(self):
+        from leapfrog.poll.httpclient import default_retry_after
+        self.assertEqual(self.retry_after(429), default_retry_after)
+        self.assertEqual(self.retry_after(429, retry_after='soon'), default_retry_after)
+
+    def test_rate_limit_reset(self):
+        from leapfrog.poll.httpclient import default_retry_after
+        # The reset time can be when the limit resets or how long until then.
+        self.assertEqual(self.retry_after(200, x_ratelimit_remaining='0',
+            x_ratelimit_reset=str(self.now + 300)), 300)
+        self.assertEqual(self.retry_after(200, x_ratelimit_remaining='0',
+            x_ratelimit_reset='45'), 45)
+        self.assertEqual(self.retry_after(200, x_ratelimit_remaining='0'), default_retry_after)
+
+    def test_no_limit(self):
+        self.assertEqual(self.retry_after(200), None)
+        self.assertEqual(self.retry_after(200, x_ratelimit_remaining='5',
+            x_ratelimit_reset=str(self.now + 300)), None)
+
+
+class RateLimiterTest(TestCase):
+
+    host = 'api.example.com'
+
+    def limiter(self, requests, seconds, max_wait=1):
+        from leapfrog.poll.httpclient import RateLimiter
+        return RateLimiter(limits={self.host: (requests, seconds)}, default_limit=(1000, 1), max_wait=max_wait)
+
+    def response(self, status, **headers):
+        import httplib2
+        headers = dict((name.replace('_', '-'), value) for name, value in headers.iteritems())
+        headers['status'] = str(status)
+        return httplib2.Response(headers)
+
+    def test_spacing(self):
+        limiter = self.limiter(1, 0.1)
+        limiter.wait(self.host, None)
+        self.assertEqual(limiter.waited, 0)
+        limiter.wait(self.host, None)
+        self.assertEqual(limiter.waited, 1)
+        self.assert_(0 < limiter.wait_time <= 0.1)
+
+    def test_throttled(self):
+        from leapfrog.poll.httpclient import Throttled
+        limiter = self.limiter(2, 1, max_wait=0.2)
+        limiter.wait(self.host, None)
+        limiter.wait(self.host, None)
+        self.assertRaises(Throttled, limiter.wait, self.host, None)
+        self.assertEqual(limiter.throttled, 1)
+        # The client's timeout is the longest wait too.
+        limiter = self.limiter(2, 1)
+        limiter.wait(self.host, None)
+        limiter.wait(self.host, None)
+        self.assertRaises(Throttled, limiter.wait, self.host, None, 0.2)
+        # Throttled requests don't use up tokens.
+        self.assertAlmostEqual(limiter.buckets[self.host].tokens, 0, 2)
+
+    def test_hold(self):
+        from leapfrog.poll.httpclient import Throttled
+        limiter = self.limiter(100, 1)
+        self.assertEqual(limiter.observe(self.host, 'token', self.response(429, retry_after='60')), 60)
+        self.assertEqual(limiter.rate_limited, 1)
+        try:
+            limiter.wait(self.host, 'token')
+        except Throttled, exc:
+            self.assertEqual(exc.host, self.host)
+            self.assert_(59 < exc.retry_after <= 60)
+        else:
+            self.fail("Request made while the host said to hold off")
+        # Other tokens' requests and other hosts' aren't held.
+        limiter.wait(self.host, 'other')
+        limiter.wait('example.org', 'token')
+
+    def test_host_hold(self):
+        from leapfrog.poll.httpclient import Throttled
+        limiter = self.limiter(100, 1)
+        limiter.observe(self.host, None, self.response(503, retry_after='60'))
+        self.assertEqual(limiter.rate_limited, 0)
+        self.assertRaises(Throttled, limiter.wait, self.host, 'token')
+
+    def test_no_hold(self):
+        limiter = self.limiter(100, 1)
+        self.assertEqual(limiter.observe(self.host, 'token', self.response(200)), None)
+        limiter.observe(self.host, 'token', self.response(429, retry_after='0'))
+        limiter.wait(self.host, 'token')
+        self.assertEqual(limiter.throttled, 0)
+
+
+class CredentialsForRequestTest(TestCase):
+
+    def test_query(self):
+        from leapfrog.poll.httpclient import credentials_for_request
+        self.assertEqual(credentials_for_request('https://graph.facebook.com/me/home?access_token=abc&limit=25', {}), 'abc')
+        self.assertEqual(credentials_for_request('http://api.flickr.com/services/rest/?oauth_token=def', None), 'def')
+
+    def test_authorization_header(self):
+        from leapfrog.poll.httpclient import credentials_for_request
+        headers = {'authorization': 'OAuth realm="", oauth_consumer_key="key", oauth_token="ghi", oauth_nonce="123"'}
+        self.assertEqual(credentials_for_request('https://api.twitter.com/1/statuses/home_timeline.json', headers), 'ghi')
+
+    def test_none(self):
+        from leapfrog.poll.httpclient import credentials_for_request
+        self.assertEqual(credentials_for_request('http://example.com/', None), None)
+        self.assertEqual(credentials_for_request('http://example.com/?q=oauth_token',
+            {'Authorization': 'Basic Zm9vOmJhcg=='}), None)
+
+
+class ArchiveKeyTest(TestCase):
+
+    def test_volatile_params(self):
+        from leapfrog.poll.archive import archive_key
+        self.assertEqual(archive_key('GET', 'http://example.com/feed?oauth_token=abc&oauth_nonce=1&oauth_timestamp=2&oauth_signature=3'),
+            archive_key('GET', 'http://example.com/feed?oauth_token=abc&oauth_nonce=4&oauth_timestamp=5&oauth_signature=6'))
+        self.assertNotEqual(archive_key('GET', 'http://example.com/feed?oauth_token=abc'),
+            archive_key('GET', 'http://example.com/feed?oauth_token=def'))
+
+    def test_order(self):
+        from leapfrog.poll.archive import archive_key
+        self.assertEqual(archive_key('GET', 'http://example.com/feed?a=1&b=2'),
+            archive_key('get', 'http://example.com/feed?b=2&a=1#top'))
+        self.assertEqual(archive_key('GET', u'http://example.com/feed?a=1'),
+            archive_key('GET', 'http://example.com/feed?a=1'))
+        self.assertNotEqual(archive_key('GET', 'http://example.com/feed?a=1'),
+            archive_key('POST', 'http://example.com/feed?a=1'))
+
+    def test_body(self):
+        from leapfrog.poll.archive import archive_key
+        # Form bodies are normalized like query strings, and others used as is.
+        self.assertEqual(archive_key('POST', 'http://example.com/feed', 'b=2&a=1&oauth_nonce=7'),
+            archive_key('POST', 'http://example.com/feed', 'a=1&b=2&oauth_nonce=8'))
+        self.assertNotEqual(archive_key('POST', 'http://example.com/feed', '{"a": 1}'),
+            archive_key('POST', 'http://example.com/feed', '{"a": 2}'))
+        self.assertEqual(archive_key('POST', 'http://example.com/feed', ''),
+            archive_key('POST', 'http://example.com/feed'))
+
+
+class HTTPArchiveTest(TestCase):
+
+    uri = 'http://api.example.com/feed?oauth_nonce=%s&page=2'
+
+    def setUp(self):
+        import tempfile
+        from leapfrog.poll import archive
+        self.directory = tempfile.mkdtemp()
+        self.old_archive = archive.archive
+
+    def tearDown(self):
+        import shutil
+        from leapfrog.poll import archive
+        archive.archive = self.old_archive
+        shutil.rmtree(self.directory)
+
+    def response(self, status, content):
+        import httplib2
+        return httplib2.Response({'status': str(status), 'content-type': 'text/plain'}), content
+
+    def test_replay_in_order(self):
+        from leapfrog.poll.archive import HTTPArchive, NotRecorded
+        recorder = HTTPArchive(self.directory)
+        recorder.record('GET', self.uri % 'a', None, *self.response(200, 'first'))
+        recorder.record('GET', self.uri % 'b', None, *self.response(503, 'second'))
+
+        player = HTTPArchive(self.directory, replaying=True)
+        resp, content = player.replay('GET', self.uri % 'c', None)
+        self.assertEqual((resp.status, resp['content-type'], content), (200, 'text/plain', 'first'))
+        for i in range(2):
+            resp, content = player.replay('GET', self.uri % 'd', None)
+            self.assertEqual((resp.status, content), (503, 'second'))
+        self.assertRaises(NotRecorded, player.replay, 'POST', self.uri % 'e', None)
+
+    def test_archived_request(self):
+        from leapfrog.poll import archive
+        made = list()
+
+        def request(http, uri, method='GET', body=None, headers=None):
+            made.append(uri)
+            return self.response(200, 'page')
+
+        archive.start_recording(os.path.join(self.directory, 'archive'))
+        self.assertEqual(archive.archived_request(request, None, self.uri % 'a')[1], 'page')
+        archive.start_replaying(os.path.join(self.directory, 'archive'))
+        self.assertEqual(archive.archived_request(request, None, self.uri % 'b')[1], 'page')
+        self.assertEqual(made, [self.uri % 'a'])
+        self.assertRaises(ValueError, archive.start_replaying, os.path.join(self.directory, 'missing'))
+
+
+class SpreadPollTimeTest(TestCase):
+
+    interval = timedelta(hours=1)
+
+    def setUp(self):
+        self.old_jitter = getattr(settings, 'POLL_JITTER', None)
+        settings.POLL_JITTER = 0.5
+
+    def tearDown(self):
+        if self.old_jitter is None:
+            del settings.POLL_JITTER
+        else:
+            settings.POLL_JITTER = self.old_jitter
+
+    def spread(self, account, now):
+        from leapfrog.poll.runner import spread_poll_time, total_seconds
+        return total_seconds(spread_poll_time(account, now, self.interval) - datetime(1970, 1, 1))
+
+    def test_phase(self):
+        from leapfrog.poll.runner import poll_phase
+        account = Account(service='twitter.com', ident='12345')
+        offset = poll_phase(account) * 3600
+        for minutes in range(0, 240, 7):
+            now = datetime(2011, 3, 1, 12, 0, 0) + timedelta(minutes=minutes)
+            phase = (self.spread(account, now) - offset) % 3600
+            self.assert_(phase < 0.001 or phase > 3600 - 0.001, "Next poll at %r is out of phase" % phase)
+
+    def test_jitter_bounds(self):
+        from leapfrog.poll.runner import total_seconds
+        for ident in ('1', '22', '333', '4444', '55555'):
+            account = Account(service='twitter.com', ident=ident)
+            for minutes in range(0, 240, 7):
+                now = datetime(2011, 3, 1, 12, 0, 0) + timedelta(minutes=minutes)
+                when = self.spread(account, now)
+                earliest = total_seconds(now - datetime(1970, 1, 1)) + 1800
+                self.assert_(earliest - 0.001 <= when < earliest + 3600)
+
+    def test_spread(self):
+        now = datetime(2011, 3, 1, 12, 0, 0)
+        times = set(self.spread(Account(service='twitter.com', ident=str(ident)), now) for ident in range(20))
+        self.assertEqual(len(times), 20)
+
+    def test_no_jitter(self):
+        from leapfrog.poll.runner import spread_poll_time
+        settings.POLL_JITTER = 0
+        now = datetime(2011, 3, 1, 12, 0, 0)
+        account = Account(service='twitter.com', ident='12345')
+        self.assertEqual(spread_poll_time(account, now, self.interval), now + self.interval)
+
+
+class ScheduleNextPollTest(TestCase):
+
+    now = datetime(2011, 3, 1, 12, 0, 0)
+
+    def setUp(self):
+        self.old_jitter = getattr(settings, 'POLL_JITTER', None)
+        settings.POLL_JITTER = 0
+
+    def tearDown(self):
+        if self.old_jitter is None:
+            del settings.POLL_JITTER
+        else:
+            settings.POLL_JITTER = self.old_jitter
+
+    def schedule(self, new_items, elapsed, poll_yield=None, update_yield=True):
+        from leapfrog.poll.runner import schedule_next_poll
+        account = Account(service='twitter.com', ident='1', poll_yield=poll_yield)
+        schedule_next_poll(account, new_items, self.now - elapsed, self.now, update_yield=update_yield)
+        return account
+
+    def test_first_poll(self):
+        # Time since before the longest interval doesn't count as quiet.
+        account = self.schedule(20, timedelta(days=30))
+        self.assertEqual(account.poll_yield, 20)
+        self.assertEqual(account.next_poll, self.now + timedelta(minutes=30))
+
+    def test_average_yield(self):
+        account = self.schedule(40, timedelta(hours=1), poll_yield=10)
+        self.assertAlmostEqual(account.poll_yield, 19)
+
+    def test_bounds(self):
+        account = self.schedule(1000, timedelta(minutes=10))
+        self.assertEqual(account.next_poll, self.now + timedelta(minutes=2))
+        account = self.schedule(0, timedelta(hours=1))
+        self.assertEqual(account.poll_yield, 0)
+        self.assertEqual(account.next_poll, self.now + timedelta(hours=1))
+
+    def test_without_updating_yield(self):
+        account = self.schedule(1000, timedelta(minutes=10), poll_yield=5, update_yield=False)
+        self.assertEqual(account.poll_yield, 5)
+        self.assertEqual(account.next_poll, self.now + timedelta(hours=1))
+
+
+class BackOffTest(TestCase):
+
+    now = datetime(2011, 3, 1, 12, 0, 0)
+
+    def setUp(self):
+        self.old_jitter = getattr(settings, 'POLL_JITTER', None)
+        settings.POLL_JITTER = 0
+
+    def tearDown(self):
+        if self.old_jitter is None:
+            del settings.POLL_JITTER
+        else:
+            settings.POLL_JITTER = self.old_jitter
+
+    def test_doubles(self):
+        from leapfrog.poll.runner import back_off
+        account = make_account()
+        for minutes in (15, 30, 60, 120):
+            back_off(account, ValueError('bad token'), self.now)
+            self.assertEqual(account.next_poll, self.now + timedelta(minutes=minutes))
+
+        account = Account.objects.get(pk=account.pk)
+        self.assertEqual(account.failure_count, 4)
+        self.assertEqual(account.failure_reason, 'ValueError: bad token')
+        self.assertEqual(account.next_poll, self.now + timedelta(hours=2))
+
+    def test_longest(self):
+        from leapfrog.poll.runner import back_off
+        account = make_account(failure_count=30)
+        back_off(account, ValueError('x' * 300), self.now)
+        account = Account.objects.get(pk=account.pk)
+        self.assertEqual(account.next_poll, self.now + timedelta(days=1))
+        self.assertEqual(len(account.failure_reason), 255)
+
+    def test_not_requested(self):
+        from leapfrog.poll.runner import back_off, request_polls
+        account = make_account(authinfo='token:secret')
+        back_off(account, ValueError('bad token'), self.now)
+        self.assertEqual(request_polls(account.person, self.now), 0)
+        self.assertEqual(request_polls(account.person, self.now + timedelta(minutes=15)), 1)
+
+
+class ParseShardTest(TestCase):
+
+    def test_parse(self):
+        from leapfrog.poll.runner import parse_shard
+        self.assertEqual(parse_shard('0/1'), (0, 1))
+        self.assertEqual(parse_shard('2/5'), (2, 5))
+
+    def test_errors(self):
+        from leapfrog.poll.runner import parse_shard
+        for value in ('', '2', 'a/5', '2/b', '1/2/3', '5/5', '-1/5', '0/0', '1/-2'):
+            self.assertRaises(ValueError, parse_shard, value)
+
+
+class ClaimAccountTest(TestCase):
+
+    now = datetime(2011, 3, 1, 12, 0, 0)
+
+    def test_one_claim_wins(self):
+        from leapfrog.poll.runner import claim_account
+        account = make_account(next_poll=self.now)
+        # Both pollers loaded the account before either claimed it.
+        theirs = Account.objects.get(pk=account.pk)
+        self.assert_(claim_account(account, 'one:1', self.now))
+        self.failIf(claim_account(theirs, 'two:2', self.now, force=True))
+
+        account = Account.objects.get(pk=account.pk)
+        self.assertEqual(account.lease_owner, 'one:1')
+        self.assertEqual(account.poll_state, 'claimed')
+        self.assertEqual(account.last_updated, self.now)
+        self.assert_(account.next_poll > self.now)
+        self.assertEqual(theirs.lease_owner, '')
+
+    def test_not_due(self):
+        from leapfrog.poll.runner import claim_account
+        account = make_account(next_poll=self.now + timedelta(minutes=1))
+        self.failIf(claim_account(account, 'one:1', self.now))
+        self.assert_(claim_account(account, 'one:1', self.now, force=True))
+
+    def test_expired_lease(self):
+        from leapfrog.poll.runner import claim_account, lease_time, poll_timeout
+        account = make_account(next_poll=self.now)
+        self.assert_(claim_account(account, 'one:1', self.now))
+        expires = self.now + lease_time() + timedelta(seconds=poll_timeout())
+        self.assertEqual(account.lease_expires, expires)
+        self.failIf(claim_account(account, 'two:2', expires - timedelta(seconds=1), force=True))
+        self.assert_(claim_account(account, 'two:2', expires, force=True))
+        self.assertEqual(Account.objects.get(pk=account.pk).lease_owner, 'two:2')
+
+    def test_lease_covers_pages(self):
+        from leapfrog.poll.runner import claim_account, lease_time, poll_timeout
+        account = make_account(next_poll=self.now)
+        self.assert_(claim_account(account, 'one:1', self.now, pages=5))
+        self.assertEqual(account.lease_expires, self.now + lease_time() + timedelta(seconds=poll_timeout(5)))
+
+
+class CircuitBreakerTest(TestCase):
+
+    now = datetime(2011, 3, 1, 12, 0, 0)
+    cooldown = timedelta(minutes=5)
+
+    def tripped_breaker(self):
+        from leapfrog.poll.runner import CircuitBreaker
+        breaker = CircuitBreaker('twitter.com', 3, self.cooldown)
+        for i in range(3):
+            breaker.failed(self.now)
+        return breaker
+
+    def test_trip(self):
+        from leapfrog.poll.runner import CircuitBreaker
+        breaker = CircuitBreaker('twitter.com', 3, self.cooldown)
+        self.assert_(breaker.allow(self.now))
+        breaker.failed(self.now)
+        breaker.failed(self.now)
+        self.assertEqual(breaker.state, 'closed')
+        # Only errors in a row trip it.
+        breaker.succeeded()
+        breaker.failed(self.now)
+        breaker.failed(self.now)
+        self.assertEqual(breaker.state, 'closed')
+        self.assert_(breaker.allow(self.now))
+        self.failIf(breaker.is_open(self.now))
+
+        breaker.failed(self.now)
+        self.assertEqual(breaker.state, 'open')
+        self.assertEqual(breaker.trips, 1)
+        self.assert_(breaker.is_open(self.now))
+        self.failIf(breaker.allow(self.now + self.cooldown - timedelta(seconds=1)))
+
+    def test_probe_succeeds(self):
+        breaker = self.tripped_breaker()
+        later = self.now + self.cooldown
+        self.failIf(breaker.is_open(later))
+        self.assert_(breaker.allow(later))
+        self.assertEqual(breaker.state, 'half-open')
+        # Only one poll probes the service.
+        self.assert_(breaker.is_open(later))
+        self.failIf(breaker.allow(later))
+
+        breaker.succeeded()
+        self.assertEqual(breaker.state, 'closed')
+        self.assert_(breaker.allow(later))
+        breaker.failed(later)
+        self.assertEqual(breaker.state, 'closed')
+
+    def test_probe_fails(self):
+        breaker = self.tripped_breaker()
+        later = self.now + self.cooldown
+        self.assert_(breaker.allow(later))
+        breaker.failed(later)
+        self.assertEqual(breaker.state, 'open')
+        self.assertEqual(breaker.trips, 2)
+        self.assertEqual(breaker.retry_at, later + self.cooldown)
+        self.failIf(breaker.allow(later))
+        self.assert_(breaker.allow(later + self.cooldown))
+
+    def test_abandoned(self):
+        breaker = self.tripped_breaker()
+        later = self.now + self.cooldown
+        self.assert_(breaker.allow(later))
+        breaker.abandoned()
+        # Another poll can probe instead.
+        self.assertEqual(breaker.state, 'open')
+        self.assertEqual(breaker.trips, 1)
+        self.assert_(breaker.allow(later))
+        self.assertEqual(breaker.state, 'half-open')
+
+        # Polls abandoned while the breaker is closed don't change it.
+        breaker.succeeded()
+        breaker.abandoned()
+        self.assertEqual(breaker.state, 'closed')
+        self.assert_(breaker.allow(later))
+
+
+class ResumeDeadRunsTest(TestCase):
+
+    now = datetime(2011, 3, 1, 12, 0, 0)
+
+    def dead_pid(self):
+        process = subprocess.Popen(['true'])
+        process.wait()
+        return process.pid
+
+    def make_run(self, owner, last_seen=None):
+        from leapfrog.models import PollRun
+        return PollRun.objects.create(owner=owner, command='runpoller', started=self.now,
+            last_seen=last_seen or self.now)
+
+    def test_run_is_alive(self):
+        from leapfrog.poll.runner import lease_time, run_is_alive
+        host = socket.gethostname()
+        self.assert_(run_is_alive(self.make_run('%s:%d' % (host, os.getpid())), self.now + timedelta(days=1)))
+        self.failIf(run_is_alive(self.make_run('%s:%d' % (host, self.dead_pid())), self.now))
+
+        elsewhere = self.make_run('%s.elsewhere:1' % host)
+        self.assert_(run_is_alive(elsewhere, self.now + lease_time() - timedelta(seconds=1)))
+        self.failIf(run_is_alive(elsewhere, self.now + lease_time()))
+
+    def test_resume(self):
+        from leapfrog.models import PollRun
+        from leapfrog.poll.runner import lease_time, resume_dead_runs
+        dead = self.make_run('%s:%d' % (socket.gethostname(), self.dead_pid()))
+        alive = self.make_run('%s.elsewhere:1' % socket.gethostname())
+        expires = self.now + lease_time()
+        orphaned = make_account(ident='1', poll_run=dead, poll_state='polling', lease_owner=dead.owner,
+            lease_expires=expires)
+        polling = make_account(ident='2', poll_run=alive, poll_state='polling', lease_owner=alive.owner,
+            lease_expires=expires)
+        expired = make_account(ident='3', poll_run=alive, poll_state='claimed', lease_owner=alive.owner,
+            lease_expires=self.now)
+        done = make_account(ident='4', poll_run=dead, poll_state='done')
+
+        self.assertEqual(resume_dead_runs(self.now), 2)
+        dead = PollRun.objects.get(pk=dead.pk)
+        self.assertEqual(dead.status, 'died')
+        self.assertEqual(dead.finished, self.now)
+        self.assertEqual(PollRun.objects.get(pk=alive.pk).finished, None)
+
+        for account in (orphaned, expired):
+            account = Account.objects.get(pk=account.pk)
+            self.assertEqual(account.next_poll, self.now)
+            self.assertEqual(account.lease_owner, '')
+            self.assertEqual(account.poll_state, '')
+        for account in (polling, done):
+            self.assertNotEqual(Account.objects.get(pk=account.pk).next_poll, self.now)
+
+
+class RunStagesTest(TestCase):
+
+    def run_stages(self, pages, failed_ids, cursor='99'):
+        """Polls a new account with the given pages of tweet IDs, failing to
+        save the tweets with the given IDs, and returns its new cursor."""
+        from leapfrog.poll.stages import Stages, run_stages
+        from leapfrog.poll.twitter import mark_twitter
+
+        def fetch(account, cursor):
+            if cursor is None:
+                cursor = 0
+            if cursor < len(pages):
+                return cursor
+        def normalize(account, raw, cursor):
+            records = [{'id': id} for id in pages[raw]]
+            return records, raw + 1
+        def persist(account, records):
+            return False, [record for record in records if record['id'] in failed_ids]
+
+        account = make_account(ident=str(Account.objects.count() + 1), poll_cursor=cursor)
+        run_stages(Stages(fetch, normalize, persist, default_pages=None, mark=mark_twitter), account)
+        saved = Account.objects.get(pk=account.pk).poll_cursor
+        self.assertEqual(saved, account.poll_cursor)
+        return saved
+
+    def test_all_saved(self):
+        self.assertEqual(self.run_stages([[100, 101, 102]], ()), '102')
+        self.assertEqual(self.run_stages([[102, 101, 100]], ()), '102')
+
+    def test_failed_oldest_first(self):
+        self.assertEqual(self.run_stages([[100, 101, 102]], (101,)), '100')
+        # Nothing older than the failed tweet was saved, so keep the old cursor.
+        self.assertEqual(self.run_stages([[100, 101, 102]], (100, 102)), '99')
+
+    def test_failed_newest_first(self):
+        self.assertEqual(self.run_stages([[102, 101, 100]], (101,)), '100')
+        self.assertEqual(self.run_stages([[102, 101, 100]], (100,)), '99')
+
+    def test_failed_on_older_page(self):
+        self.assertEqual(self.run_stages([[104, 103], [102, 101, 100]], (101,)), '100')
+        self.assertEqual(self.run_stages([[103, 104], [100, 101, 102]], (102,)), '101')
+
+
+class PollContextTest(TestCase):
+
+    def test_join(self):
+        from leapfrog.poll.metrics import PollContext
+        context = PollContext(timeout=60)
+        with context:
+            forked = [context.fork() for i in range(3)]
+        for other in forked:
+            self.assertEqual(other.deadline, context.deadline)
+            other.http_requests, other.http_bytes, other.http_time = 2, 100, 10.0
+            context.join(other)
+        self.assertEqual(context.http_requests, 6)
+        self.assertEqual(context.http_bytes, 300)
+        # The forked contexts waited at the same time, so their waits don't add up.
+        self.assertEqual(context.http_time, 0.0)
+
+    def test_waiting_for_http(self):
+        import time
+        from leapfrog.poll.metrics import PollContext, waiting_for_http
+        context = PollContext()
+        with context:
+            with waiting_for_http():
+                time.sleep(0.05)
+        self.assert_(0.05 <= context.http_time <= context.wall_time)
+
+
+class RunpollerTest(TestCase):
+
+    def test_requests_between_due_accounts(self):
+        from leapfrog.management.commands.runpoller import Command
+        from leapfrog.models import PollRequest
+        from leapfrog.poll.runner import CircuitBreaker
+
+        now = datetime.utcnow()
+        due = [make_account(ident=ident, next_poll=now - timedelta(minutes=1)) for ident in ('1', '2')]
+        requested = make_account(ident='3')
+        command = Command()
+        command.options = {'service': None, 'shard': None, 'batch': 50, 'request_seconds': 2}
+        command.queue = [(account.next_poll, account.pk) for account in due]
+        command.queued = set(account.pk for account in due)
+        command.poll_requested(None)
+
+        class Runner(object):
+            polled = []
+            def breaker_for(self, service):
+                return CircuitBreaker(service, 5, timedelta(minutes=5))
+            def submit(self, account, urgent=False, pages=None):
+                self.polled.append(account.ident)
+                if len(self.polled) == 1:
+                    # A reader asks for an account while the first poll takes a while.
+                    PollRequest.objects.create(account=requested)
+                    command.next_request_check = datetime.utcnow()
+                return True
+
+        runner = Runner()
+        command.poll_due(runner, now)
+        self.assertEqual(runner.polled, ['1', '3', '2'])
+
+
+class PollRequestQueueTest(TestCase):
+
+    now = datetime(2011, 3, 1, 12, 0, 0)
+
+    def test_take_oldest(self):
+        from leapfrog.models import PollRequest
+        from leapfrog.poll.runner import take_poll_requests
+        newer = PollRequest.objects.create(account=make_account(ident='1'), requested=self.now)
+        older = PollRequest.objects.create(account=make_account(ident='2'), requested=self.now - timedelta(minutes=1))
+        PollRequest.objects.create(account=make_account(service='flickr.com', ident='3'), requested=self.now)
+
+        taken = take_poll_requests(service='twitter.com', limit=1, now=self.now)
+        self.assertEqual([request.pk for request in taken], [older.pk])
+        self.assertEqual(PollRequest.objects.get(pk=older.pk).started, self.now)
+        # Taken requests aren't taken again.
+        taken = take_poll_requests(service='twitter.com', now=self.now)
+        self.assertEqual([request.pk for request in taken], [newer.pk])
+        self.assertEqual(take_poll_requests(service='twitter.com', now=self.now), [])
+
+    def test_take_abandoned(self):
+        from leapfrog.models import PollRequest
+        from leapfrog.poll.runner import lease_time, take_poll_requests
+        request = PollRequest.objects.create(account=make_account(), requested=self.now)
+        self.assertEqual(len(take_poll_requests(now=self.now)), 1)
+        self.assertEqual(take_poll_requests(now=self.now + lease_time()), [])
+        later = self.now + lease_time() + timedelta(seconds=1)
+        self.assertEqual([taken.pk for taken in take_poll_requests(now=later)], [request.pk])
+
+    def test_finish(self):
+        from leapfrog.models import PollRequest
+        from leapfrog.poll.runner import finish_poll_requests, take_poll_requests
+        account = make_account()
+        PollRequest.objects.create(account=account, requested=self.now)
+        take_poll_requests(now=self.now)
+        # A request made while the account was being polled stays queued.
+        waiting = PollRequest.objects.create(account=account, requested=self.now)
+        finish_poll_requests(account)
+        self.assertEqual([request.pk for request in account.poll_requests.all()], [waiting.pk])
+
+    def test_release(self):
+        from leapfrog.models import PollRequest
+        from leapfrog.poll.runner import release_poll_requests, take_poll_requests
+        account = make_account()
+        PollRequest.objects.create(account=account, requested=self.now)
+        take_poll_requests(now=self.now)
+        release_poll_requests([account.pk])
+        self.assertEqual(len(take_poll_requests(now=self.now)), 1)
+
+
+class FetchDetailsTest(TestCase):
+
+    def test_details_fetched_before_persist(self):
+        from leapfrog.poll.stages import Stages, run_stages
+        calls = []
+
+        def fetch(account, cursor):
+            return cursor or 0
+        def normalize(account, raw, cursor):
+            calls.append(('normalize', raw))
+            return [{'page': raw}], (raw + 1 if raw < 2 else None)
+        def fetch_details(account, records):
+            calls.append(('fetch_details', records[0]['page']))
+            for record in records:
+                record['details'] = True
+        def persist(account, records):
+            calls.append(('persist', records[0]['page']))
+            self.assert_(all(record.get('details') for record in records))
+            return False, []
+
+        stages = Stages(fetch, normalize, persist, default_pages=None, fetch_details=fetch_details)
+        run_stages(stages, make_account())
+        self.assertEqual(calls, [('normalize', 0), ('fetch_details', 0), ('persist', 0),
+            ('normalize', 1), ('fetch_details', 1), ('persist', 1),
+            ('normalize', 2), ('fetch_details', 2), ('persist', 2)])
+
+    def test_twitter_link_pages(self):
+        import leapfrog.poll.embedlam
+        import leapfrog.poll.resolve
+        from leapfrog.poll.twitter import raw_object_for_tweet
+
+        class Page(object):
+            def __init__(self, url, title):
+                self.permalink_url, self.title = url, title
+
+        tweetdata = {
+            'id': 1000,
+            'text': 'two links http://a.example/ and http://b.example/',
+            'created_at': 'Tue Mar 01 12:00:00 +0000 2011',
+            'user': {'id': 10, 'name': 'Tweeter', 'screen_name': 'tweeter', 'protected': False,
+                'profile_image_url': 'http://a0.twimg.com/tweeter.png'},
+            'entities': {'urls': [
+                {'url': 'http://a.example/', 'expanded_url': None, 'indices': [10, 27]},
+                {'url': 'http://b.example/', 'expanded_url': None, 'indices': [32, 49]},
+            ]},
+        }
+        link_pages = {
+            'http://a.example/': Page('http://a.example/canonical', 'Page A'),
+            'http://b.example/': leapfrog.poll.embedlam.RequestError("Couldn't fetch it"),
+        }
+
+        def fetch_pages(urls, timeout=None):
+            self.fail("Fetched %r again" % list(urls))
+        real_fetch_pages, leapfrog.poll.resolve.fetch_pages = leapfrog.poll.resolve.fetch_pages, fetch_pages
+        try:
+            really_a_share, tweet = raw_object_for_tweet(tweetdata, None, link_pages)
+        finally:
+            leapfrog.poll.resolve.fetch_pages = real_fetch_pages
+
+        self.failIf(really_a_share)
+        self.assert_('href="http://a.example/" title="http://a.example/canonical">Page A</a>' in tweet.body)
+        self.assert_('title="http://b.example/">http://b.example/</a>' in tweet.body)
+
+
+class ThrottledPollTest(TestCase):
+
+    def test_item_handlers_let_throttled_through(self):
+        from leapfrog.poll.httpclient import Throttled
+        from leapfrog.poll.runner import poll_account, pollers
+
+        def poll_throttled(account, pages=None):
+            # Like a poller's handler for problems with one item.
+            try:
+                raise Throttled('api.twitter.com', 300)
+            except Exception:
+                self.fail("Throttled was caught as an Exception")
+
+        account = make_account(authinfo='token:secret')
+        real_poller, pollers['twitter.com'] = pollers['twitter.com'], poll_throttled
+        try:
+            before = datetime.utcnow()
+            outcome = poll_account(account, 'test:1')
+        finally:
+            pollers['twitter.com'] = real_poller
+
+        self.assertEqual(outcome, 'throttled')
+        account = Account.objects.get(pk=account.pk)
+        self.assert_(account.next_poll >= before + timedelta(seconds=300))
+        self.assertEqual(account.failure_count, 0)
+        self.assertEqual(account.lease_owner, '')
+        self.assertEqual(account.poll_state, 'done')
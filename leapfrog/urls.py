@@ -3,6 +3,12 @@ from os.path import join, dirname
 from django.conf.urls.defaults import *
 from django.http import HttpResponse
 
+from leapfrog.poll.metrics import install_pool_hook
+
+
+# Let the views reuse their connections to the services.
+install_pool_hook()
+
 
 urlpatterns = patterns('leapfrog.views',
     url(r'^$', 'home', name='home'),
@@ -26,6 +26,7 @@ from leapfrog.models import Person, Account, UserSetting, Object
 from leapfrog.poll.facebook import account_for_facebook_user
 from leapfrog.poll.flickr import sign_flickr_query, account_for_flickr_id, call_flickr
 from leapfrog.poll.mlkshk import account_for_mlkshk_userinfo, call_mlkshk
+from leapfrog.poll.runner import backfill_progress, request_backfill, request_catchup, request_polls, viewed_horizon
 from leapfrog.poll.tumblr import account_for_tumblr_userinfo
 from leapfrog.poll.twitter import account_for_twitter_user
 from leapfrog.poll.typepad import account_for_typepad_user
@@ -73,12 +74,22 @@ def home(request):
     except Person.DoesNotExist:
         display_name = user.get_full_name()
         accounts = {}
+        backfills = []
     else:
         display_name = person.display_name
         accounts = dict((acc.service, acc) for acc in person.accounts.all() if acc.authinfo)
 
-        person.last_viewed_home = datetime.utcnow()
+        now = datetime.utcnow()
+        if person.last_viewed_home < now - viewed_horizon:
+            # We stopped polling while they were away, so catch them up.
+            request_catchup(person, now)
+        else:
+            # Get the reader's stale accounts polled now, so new_items can show what's new.
+            request_polls(person, now)
+
+        person.last_viewed_home = now
         person.save()
+        backfills = backfill_progress(person)
 
     stream_items = stream_items_for_user(user, limit=500)
     try:
@@ -202,6 +213,7 @@ def home(request):
         'pagecolor': pagecolor,
         'maxstreamitem': maxstreamitem,
         'maxreplyitem': maxreplyitem,
+        'backfills': backfills,
     }
 
     template = 'leapfrog/index.jj'
@@ -219,7 +231,15 @@ def mobile_home(request):
     else:
         display_name = person.display_name
 
-        person.last_viewed_home = datetime.utcnow()
+        now = datetime.utcnow()
+        if person.last_viewed_home < now - viewed_horizon:
+            # We stopped polling while they were away, so catch them up.
+            request_catchup(person, now)
+        else:
+            # Get the reader's stale accounts polled now, so new_items can show what's new.
+            request_polls(person, now)
+
+        person.last_viewed_home = now
         person.save()
 
     try:
@@ -313,6 +333,7 @@ def complete_twitter(request):
     log.debug('Updating authinfo for Twitter account %s to have token %s : %s', account.display_name, access_token['oauth_token'], access_token['oauth_token_secret'])
     account.authinfo = ':'.join((access_token['oauth_token'], access_token['oauth_token_secret']))
     account.save()
+    request_backfill(account)
 
     return HttpResponseRedirect(reverse('home'))
 
@@ -399,6 +420,7 @@ def complete_typepad(request):
 
     account.authinfo = ':'.join((access_token_data['oauth_token'], access_token_data['oauth_token_secret']))
     account.save()
+    request_backfill(account)
 
     return HttpResponseRedirect(reverse('home'))
 
@@ -474,6 +496,7 @@ def complete_facebook(request):
 
     account.authinfo = access_token
     account.save()
+    request_backfill(account)
 
     return HttpResponseRedirect(reverse('home'))
 
@@ -532,6 +555,7 @@ def complete_flickr(request):
 
     account.authinfo = token
     account.save()
+    request_backfill(account)
 
     return HttpResponseRedirect(reverse('home'))
 
@@ -605,6 +629,7 @@ def complete_vimeo(request):
 
     account.authinfo = ':'.join((access_token_data['oauth_token'], access_token_data['oauth_token_secret']))
     account.save()
+    request_backfill(account)
 
     return HttpResponseRedirect(reverse('home'))
 
@@ -717,6 +742,7 @@ def complete_tumblr(request):
 
     account.authinfo = ':'.join((access_token_data['oauth_token'], access_token_data['oauth_token_secret']))
     account.save()
+    request_backfill(account)
 
     return HttpResponseRedirect(reverse('home'))
 
@@ -787,6 +813,7 @@ def complete_mlkshk(request):
 
     account.authinfo = ':'.join((token_data['access_token'], token_data['secret']))
     account.save()
+    request_backfill(account)
 
     return HttpResponseRedirect(reverse('home'))
 
@@ -1126,10 +1153,15 @@ def new_items(request):
 
     streamitems = request.user.stream_items.filter(id__gt=maxstreamitem).count()
     replies = request.user.reply_stream_items.filter(id__gt=maxreplyitem).count()
+    try:
+        backfills = backfill_progress(request.user.person)
+    except Person.DoesNotExist:
+        backfills = []
 
     return HttpResponse(json.dumps({
         'streamitems': streamitems,
         'replyitems': replies,
+        'backfills': backfills,
     }), content_type='application/json')
 
 